@@ -0,0 +1,203 @@
+from collections import deque
+
+import numpy as np
+
+from band_power import POW_LAYOUT
+
+
+class ArtifactGate:
+    """
+    Gate EEG and band power samples on head movement and electrode contact.
+
+    Motion samples are kept in a ring buffer and checked as a window, vectorized with
+    NumPy, for the spread of acceleration magnitude, jerk (rate of change of
+    acceleration) and head rotation (angle between the first and last orientation
+    quaternions). A window over any threshold is a motion artifact, which affects
+    samples up to ``hold_s`` later because band powers are computed over a window too.
+    Device samples give contact quality per channel and the wireless signal strength.
+
+    In 'mask' mode affected samples get weight 0 and channels with poor contact are
+    excluded; in 'weight' mode they are down-weighted in proportion to how far the
+    thresholds are exceeded and to contact quality.
+
+    Attributes
+    ----------
+    mode : string
+        'mask' or 'weight'
+    stats : dict
+        samples gated, rejected (weight 0) and down-weighted, and rejection reasons
+    """
+    def __init__(self, cortex=None, mode='mask', window_s=1.0, max_motion_rate=128, accel_std_threshold=0.05,
+                 jerk_threshold=4.0, rotation_threshold_deg=10.0, hold_s=2.0, min_contact=3, good_contact=4,
+                 min_signal=0.5):
+        if mode not in ('mask', 'weight'):
+            raise ValueError('Unknown artifact gate mode ' + mode)
+        self.mode = mode
+        self.window_s = window_s
+        self.accel_std_threshold = accel_std_threshold
+        self.jerk_threshold = jerk_threshold
+        self.rotation_threshold = np.radians(rotation_threshold_deg)
+        self.hold_s = hold_s
+        self.min_contact = min_contact
+        self.good_contact = good_contact
+        self.min_signal = min_signal
+
+        size = int(window_s * max_motion_rate) + 1
+        self.motion_times = np.zeros(size)
+        self.accel = np.zeros((size, 3))
+        self.quaternions = np.zeros((size, 4))
+        self.motion_count = 0
+        self.evaluated_count = 0
+        self.accel_index = None
+        self.quaternion_index = None
+        self.artifacts = deque()  # (time, weight) of recent motion artifacts
+
+        self.dev_channels = []
+        self.contact = None
+        self.signal = 1.0
+        self.weight_index = {}
+        self.pow_channels = []
+
+        self.stats = {'samples': 0, 'rejected': 0, 'downweighted': 0, 'motion': 0, 'contact': 0, 'signal': 0}
+        if cortex is not None:
+            cortex.bind(new_data_labels=self.on_new_data_labels)
+            cortex.bind(new_mot_data=self.on_new_mot_data)
+            cortex.bind(new_dev_data=self.on_new_dev_data)
+
+    def on_new_data_labels(self, *args, **kwargs):
+        data = kwargs.get('data')
+        labels = data['labels']
+        if data['streamName'] == 'mot':
+            self.accel_index = [labels.index(name) for name in ('ACCX', 'ACCY', 'ACCZ') if name in labels] or None
+            self.quaternion_index = [labels.index(name) for name in ('Q0', 'Q1', 'Q2', 'Q3') if name in labels] or None
+        elif data['streamName'] == 'dev':
+            self.dev_channels = [name for name in labels if name != 'OVERALL']
+            self.weight_index = {}
+        elif data['streamName'] == 'pow':
+            self.pow_channels = list(dict.fromkeys(label.split('/')[0] for label in labels))
+
+    def on_new_mot_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        if self.accel_index is None and self.quaternion_index is None:
+            return
+        index = self.motion_count % len(self.motion_times)
+        values = data['mot']
+        self.motion_times[index] = data['time']
+        if self.accel_index:
+            self.accel[index] = [values[i] for i in self.accel_index]
+        if self.quaternion_index:
+            self.quaternions[index] = [values[i] for i in self.quaternion_index]
+        self.motion_count += 1
+
+    def on_new_dev_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        self.signal = data['signal']
+        self.contact = np.asarray(data['dev'][:len(self.dev_channels)], dtype=np.float64)
+
+    def _motion_window(self):
+        count = min(self.motion_count, len(self.motion_times))
+        # rows in time order
+        order = (np.arange(self.motion_count - count, self.motion_count)) % len(self.motion_times)
+        times = self.motion_times[order]
+        keep = times >= times[-1] - self.window_s
+        return times[keep], self.accel[order][keep], self.quaternions[order][keep]
+
+    def evaluate_motion(self):
+        """Check the motion window if new motion samples arrived since the last check"""
+        if self.motion_count == self.evaluated_count or self.motion_count < 3:
+            return
+        self.evaluated_count = self.motion_count
+        times, accel, quaternions = self._motion_window()
+        if len(times) < 3:
+            return
+
+        ratios = []
+        if self.accel_index:
+            ratios.append(np.std(np.linalg.norm(accel, axis=1)) / self.accel_std_threshold)
+            dt = np.maximum(np.diff(times), 1e-3)
+            jerk = np.linalg.norm(np.diff(accel, axis=0), axis=1) / dt
+            ratios.append(jerk.max() / self.jerk_threshold)
+        if self.quaternion_index:
+            dot = abs(float(np.dot(quaternions[0], quaternions[-1])))
+            norms = np.linalg.norm(quaternions[0]) * np.linalg.norm(quaternions[-1])
+            if norms > 0:
+                ratios.append(2 * np.arccos(min(1.0, dot / norms)) / self.rotation_threshold)
+
+        worst = max(ratios, default=0.0)
+        if worst > 1:
+            weight = 0.0 if self.mode == 'mask' else 1 / worst
+            self.artifacts.append((times[-1], weight))
+
+    def motion_weight(self, timestamp):
+        """Weight of a sample at ``timestamp`` given recent motion artifacts"""
+        self.evaluate_motion()
+        while self.artifacts and self.artifacts[0][0] < timestamp - self.hold_s:
+            self.artifacts.popleft()
+        return min((weight for _, weight in self.artifacts), default=1.0)
+
+    def contact_weights(self, channels):
+        """Per channel weights from contact quality, in the order of ``channels``"""
+        if self.contact is None:
+            return np.ones(len(channels))
+        key = tuple(channels)
+        if key not in self.weight_index:
+            # channels without a contact reading count as good
+            self.weight_index[key] = np.array([self.dev_channels.index(c) if c in self.dev_channels else -1
+                                               for c in channels])
+        index = self.weight_index[key]
+        contact = np.where(index >= 0, self.contact[index], self.good_contact)
+        if self.mode == 'mask':
+            return (contact >= self.min_contact).astype(np.float64)
+        return np.clip(contact / self.good_contact, 0.0, 1.0)
+
+    def weights(self, timestamp, channels):
+        """
+        Gate one sample.
+
+        Returns
+        -------
+        weights : ndarray
+            weight of each channel in [0, 1], all zero if the sample is rejected
+        """
+        self.stats['samples'] += 1
+        if self.signal < self.min_signal:
+            self.stats['signal'] += 1
+            self.stats['rejected'] += 1
+            return np.zeros(len(channels))
+
+        motion = self.motion_weight(timestamp)
+        weights = self.contact_weights(channels) * motion
+        if motion < 1:
+            self.stats['motion'] += 1
+        if np.any(weights < motion):
+            self.stats['contact'] += 1
+        if not weights.any():
+            self.stats['rejected'] += 1
+        elif np.any(weights < 1):
+            self.stats['downweighted'] += 1
+        return weights
+
+    def rejection_rate(self):
+        samples = self.stats['samples']
+        return self.stats['rejected'] / samples if samples else 0.0
+
+
+def weighted_band_averages(pow_values, weights, layout=POW_LAYOUT):
+    """
+    Average alpha and beta over channels weighted by the gate.
+
+    ``layout`` is (values per channel, alpha, low beta, high beta) as in band_power.
+
+    Returns
+    -------
+    (avg_alpha, avg_beta) : (float, float)
+        or None if every channel has weight 0
+    """
+    total = weights.sum()
+    if total <= 0:
+        return None
+    width, alpha_index, low_index, high_index = layout
+    bands = np.asarray(pow_values, dtype=np.float64).reshape(len(weights), width)
+    alpha = bands[:, alpha_index] @ weights / total
+    beta = (bands[:, low_index] + bands[:, high_index]) / 2 @ weights / total
+    return float(alpha), float(beta)
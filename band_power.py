@@ -0,0 +1,194 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# (name, low edge, high edge) in Hz, in the order of the Cortex pow stream
+DEFAULT_BANDS = (('theta', 4, 8), ('alpha', 8, 12), ('betaL', 12, 16), ('betaH', 16, 25), ('gamma', 25, 45))
+
+# values per channel and the positions of alpha, low beta and high beta among them,
+# for full pow samples and for samples projected to FOCUS_BAND_PATTERNS
+POW_LAYOUT = (5, 1, 2, 3)
+FOCUS_BAND_PATTERNS = ['*/alpha', '*/betaL', '*/betaH']
+PROJECTED_POW_LAYOUT = (3, 0, 1, 2)
+
+
+
+def focus_columns(labels):
+    """
+    Column indices of alpha, low beta and high beta of every channel of a pow stream
+
+    Selecting these columns from a pow sample with the given labels gives values in
+    PROJECTED_POW_LAYOUT, whatever other columns the stream carries, e.g. bands
+    projected by another consumer of the same Cortex session.
+
+    Returns
+    -------
+    list
+        indices, channel by channel in label order
+    """
+    index = {label: i for i, label in enumerate(labels)}
+    bands = [pattern.split('/')[1] for pattern in FOCUS_BAND_PATTERNS]
+    columns = []
+    for channel in dict.fromkeys(label.split('/')[0] for label in labels):
+        for band in bands:
+            name = '{0}/{1}'.format(channel, band)
+            if name not in index:
+                raise ValueError('The pow stream has no {0} column'.format(name))
+            columns.append(index[name])
+    return columns
+
+
+# eeg stream columns that are not electrodes
+NON_CHANNEL_LABELS = {'COUNTER', 'INTERPOLATED', 'RAW_CQ', 'MARKER_HARDWARE', 'MARKERS'}
+
+
+class BandPowerEstimator:
+    """
+    Welch band powers of a sliding window of raw EEG, vectorized across channels.
+
+    Samples go into a mirrored ring buffer so the analysis window is always one
+    contiguous view. Each update splits the window into overlapping segments (as
+    strided views, not copies), removes their mean, applies the precomputed taper and
+    takes one batched real FFT over all segments and channels. Band powers are the
+    averaged periodogram, a density in uV^2/Hz like the Cortex pow stream, averaged
+    over the bins of each band with a precomputed band matrix.
+
+    scipy is imported here rather than at module level, so importing this module
+    (and live_advance_pow) stays cheap when band powers come from Cortex.
+
+    Attributes
+    ----------
+    n_channels : int
+        number of EEG channels
+    sampling_rate : float
+        samples per second of the eeg stream
+    window_s : float
+        length of the analysed window in seconds
+    segment_s : float
+        length of each Welch segment in seconds, which sets the frequency resolution
+    overlap : float
+        fraction of overlap between Welch segments
+    bands : tuple
+        (name, low, high) frequency bands, high edge exclusive
+    """
+    def __init__(self, n_channels, sampling_rate=128.0, window_s=2.0, segment_s=1.0, overlap=0.5,
+                 bands=DEFAULT_BANDS, taper='hann'):
+        self.n_channels = n_channels
+        self.sampling_rate = sampling_rate
+        self.bands = tuple(bands)
+        self.window_len = int(round(window_s * sampling_rate))
+        self.segment_len = int(round(segment_s * sampling_rate))
+        if self.segment_len > self.window_len:
+            raise ValueError('Welch segments must not be longer than the window')
+        self.step = max(1, int(round(self.segment_len * (1 - overlap))))
+
+        import scipy.fft
+        self.rfft = scipy.fft.rfft
+        if taper == 'hann':
+            # periodic Hann window, as scipy.signal.get_window returns, without importing scipy.signal
+            self.taper = np.hanning(self.segment_len + 1)[:-1]
+        else:
+            from scipy.signal import get_window
+            self.taper = get_window(taper, self.segment_len).astype(np.float64)
+        # one-sided density scaling, with the DC and Nyquist bins counted once
+        freqs = np.fft.rfftfreq(self.segment_len, 1 / sampling_rate)
+        scale = np.full(len(freqs), 2.0 / (sampling_rate * np.sum(self.taper ** 2)))
+        scale[0] /= 2
+        if self.segment_len % 2 == 0:
+            scale[-1] /= 2
+        self.scale = scale
+        masks = np.array([(freqs >= low) & (freqs < high) for _, low, high in self.bands], dtype=np.float64)
+        if not masks.sum(axis=1).all():
+            raise ValueError('Every band needs at least one frequency bin, use longer Welch segments')
+        # mean density over each band's bins
+        self.band_matrix = (masks / masks.sum(axis=1, keepdims=True)).T
+
+        self.buffer = np.zeros((2 * self.window_len, n_channels))
+        self.count = 0
+
+    @property
+    def band_names(self):
+        return [name for name, _, _ in self.bands]
+
+    def push(self, samples):
+        """Append one sample (n_channels values) or a block of shape (n, n_channels)"""
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, self.n_channels)
+        # only the last window's worth of a long block can matter
+        self.count += max(0, len(samples) - self.window_len)
+        for sample in samples[-self.window_len:]:
+            index = self.count % self.window_len
+            self.buffer[index] = sample
+            self.buffer[index + self.window_len] = sample
+            self.count += 1
+
+    def ready(self):
+        return self.count >= self.window_len
+
+    def compute(self):
+        """
+        Band powers of the current window.
+
+        Returns
+        -------
+        powers : ndarray
+            shape (n_channels, n_bands), mean power density of each band in uV^2/Hz
+        """
+        start = self.count % self.window_len
+        window = self.buffer[start:start + self.window_len]
+        # (n_segments, n_channels, segment_len) strided view of the window
+        segments = sliding_window_view(window, self.segment_len, axis=0)[::self.step]
+        segments = (segments - segments.mean(axis=-1, keepdims=True)) * self.taper
+        spectrum = self.rfft(segments, axis=-1)
+        psd = (spectrum.real ** 2 + spectrum.imag ** 2).mean(axis=0) * self.scale
+        return psd @ self.band_matrix
+
+
+class LiveBandPower:
+    """
+    Compute band powers locally from the Cortex eeg stream.
+
+    Binds to ``new_data_labels`` and ``new_eeg_data`` of a Cortex instance, if one is
+    given, and calls ``callback(data)`` every ``update_s`` seconds of signal with data
+    in the format of the Cortex pow stream, {'pow': [...], 'time': ...}, channel by
+    channel and band by band, so it can replace a ``new_pow_data`` handler.
+    """
+    def __init__(self, cortex, callback, sampling_rate=128.0, update_s=0.125, channels=None, **estimator_options):
+        self.callback = callback
+        self.sampling_rate = sampling_rate
+        self.update_every = max(1, int(round(update_s * sampling_rate)))
+        self.wanted_channels = channels
+        self.estimator_options = estimator_options
+        self.estimator = None
+        self.channel_index = None
+        self.channel_names = []
+        self.since_update = 0
+        if cortex is not None:
+            cortex.bind(new_data_labels=self.on_new_data_labels)
+            cortex.bind(new_eeg_data=self.on_new_eeg_data)
+
+    def on_new_data_labels(self, *args, **kwargs):
+        data = kwargs.get('data')
+        if data['streamName'] != 'eeg':
+            return
+        labels = data['labels']
+        if self.wanted_channels:
+            self.channel_names = [name for name in self.wanted_channels if name in labels]
+        else:
+            self.channel_names = [name for name in labels if name not in NON_CHANNEL_LABELS]
+        self.channel_index = np.array([labels.index(name) for name in self.channel_names])
+        self.estimator = BandPowerEstimator(len(self.channel_names), self.sampling_rate, **self.estimator_options)
+        print('Local band power over {0} at {1} Hz updates'.format(
+            self.channel_names, round(self.sampling_rate / self.update_every, 2)))
+
+    def pow_labels(self):
+        """Column labels of the emitted pow list, e.g. 'AF3/alpha'"""
+        return ['{0}/{1}'.format(channel, band) for channel in self.channel_names for band in self.estimator.band_names]
+
+    def on_new_eeg_data(self, *args, **kwargs):
+        if self.estimator is None:
+            return
+        data = kwargs.get('data')
+        self.estimator.push(np.asarray(data['eeg'], dtype=np.float64)[self.channel_index])
+        self.since_update += 1
+        if self.since_update >= self.update_every and self.estimator.ready():
+            self.since_update = 0
+            self.callback({'pow': self.estimator.compute().ravel().tolist(), 'time': data['time']})
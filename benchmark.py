@@ -0,0 +1,187 @@
+import argparse
+import asyncio
+import csv
+import math
+import statistics
+import time
+
+from composition_cache import CompositionCache
+from music_generation import MusicGenerator, EEGCollector, run_music_generation, DuetResources
+from note_events import NoteSequence
+from offline_model import OfflineModel
+from osc_transport import OscBundleTransport
+from prompt_context import ContextBuilder
+from speculation import SpeculativeScheduler
+
+
+class RecordingClient:
+    """OSC client that records what would have been sent to Sonic Pi"""
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def send_message(self, address, value):
+        self.messages += 1
+
+    def send(self, content):
+        self.messages += 1
+        self.bytes += content.size
+
+
+class ReplayConnection:
+    """DB-API stand-in that answers EEGCollector's query from a replayed alpha/beta series"""
+    def __init__(self, series, rate_hz=8.0):
+        self.series = series
+        self.rate_hz = rate_hz
+        self.started = time.monotonic()
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, sql, values=None):
+        pass
+
+    def fetchone(self):
+        # the tick stands in for the timestamp column
+        tick = int((time.monotonic() - self.started) * self.rate_hz)
+        avg_alpha, avg_beta = self.series[tick % len(self.series)]
+        return avg_alpha, avg_beta, tick
+
+
+def synthetic_series(seconds=120, rate_hz=8.0):
+    """Slowly drifting alpha/beta powers with some noise"""
+    series = []
+    for i in range(int(seconds * rate_hz)):
+        t = i / rate_hz
+        series.append((1.0 + 0.8 * math.sin(t / 9), 0.5 + 0.3 * math.sin(t / 4 + 1)))
+    return series
+
+
+def load_series(path):
+    """Read avg_alpha,avg_beta rows from a CSV file"""
+    with open(path, newline='') as file:
+        return [(float(row['avg_alpha']), float(row['avg_beta'])) for row in csv.DictReader(file)]
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(int(p * len(ordered)), len(ordered) - 1)]
+
+
+class BenchmarkGenerator(MusicGenerator):
+    """MusicGenerator that records timings of the pipeline"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.started = time.monotonic()
+        self.first_note_s = None
+        self.composed = set()
+        self.played = set()
+        self.generation_latencies = []
+        self.queueing_delays = []
+        self.underruns = 0
+        self.dead_air_s = 0.0
+        self.buffer_end = None
+
+    async def compose(self, average_focus):
+        started = time.monotonic()
+        result = await super().compose(average_focus)
+        self.generation_latencies.append(time.monotonic() - started)
+        self.composed.add(id(result))
+        return result
+
+    def remember(self, result, average_focus):
+        self.played.add(id(result))
+        super().remember(result, average_focus)
+
+    def send(self, result, address="/synth"):
+        now = time.monotonic()
+        if self.first_note_s is None:
+            self.first_note_s = now - self.started
+        if address == "/synth":
+            # a new segment starts when the buffered music runs out, or now if it already has
+            if self.buffer_end is not None and now > self.buffer_end:
+                self.underruns += 1
+                self.dead_air_s += now - self.buffer_end
+            start = now if self.buffer_end is None else max(now, self.buffer_end)
+            self.queueing_delays.append(start - now)
+            self.buffer_end = start + result.duration
+        elif self.buffer_end is not None:
+            self.buffer_end += result.duration
+        super().send(result, address)
+
+
+async def run_benchmark(args):
+    model = OfflineModel(latency=args.latency, latency_s=args.latency_s, latency_spread=args.latency_spread,
+                         failure_rate=args.failure_rate, seed=args.seed)
+    series = load_series(args.focus_file) if args.focus_file else synthetic_series()
+    client = RecordingClient()
+    resources = DuetResources(model=model, conn=ReplayConnection(series), osc_client=client,
+                              prompt_path=args.prompt)
+    transport = OscBundleTransport(client, ack_port=None)
+
+    cache = CompositionCache(encode=NoteSequence.to_prompt_text, decode=NoteSequence.parse)
+    generator = BenchmarkGenerator(cache=cache, streaming=args.streaming, transport=transport,
+                                   deadline_s=args.deadline, context_builder=ContextBuilder(resources.prompt),
+                                   resources=resources)
+    collector = EEGCollector(resources=resources)
+
+    if args.scheduler == 'speculative':
+        generation = SpeculativeScheduler(generator, collector).run()
+    else:
+        generation = run_music_generation(generator, collector, transport)
+
+    cpu_started = time.process_time()
+    tasks = [asyncio.ensure_future(collector.collect_data()), asyncio.ensure_future(generation)]
+    await asyncio.sleep(args.duration)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    cpu_s = time.process_time() - cpu_started
+
+    segments = generator.segment_count
+    print('\n---------------- benchmark ----------------')
+    print('scheduler: {0}, latency: {1} {2}s, failure rate: {3}, streaming: {4}'.format(
+        args.scheduler, args.latency, args.latency_s, args.failure_rate, args.streaming))
+    print('segments played: {0}, model calls: {1}, model failures: {2}'.format(segments, model.calls, model.failures))
+    print('time to first note: {0:.3f}s'.format(generator.first_note_s or float('nan')))
+    print('generation latency p50/p90: {0:.3f}s / {1:.3f}s'.format(
+        percentile(generator.generation_latencies, 0.5), percentile(generator.generation_latencies, 0.9)))
+    print('segments dropped (boundary missed): {0}, dead air: {1:.2f}s'.format(generator.underruns, generator.dead_air_s))
+    print('wasted generations: {0}'.format(len(generator.composed - generator.played)))
+    if generator.queueing_delays:
+        print('queueing delay mean/max: {0:.3f}s / {1:.3f}s'.format(
+            statistics.mean(generator.queueing_delays), max(generator.queueing_delays)))
+    print('cpu per segment: {0:.2f} ms'.format(1000 * cpu_s / segments if segments else float('nan')))
+    print('cache: {0}'.format(generator.cache.stats()))
+    print('osc: {0} sends, {1} bytes'.format(client.messages, client.bytes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the music pipeline against an offline model')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run')
+    parser.add_argument('--scheduler', choices=['paced', 'speculative'], default='paced')
+    parser.add_argument('--latency', choices=['constant', 'uniform', 'lognormal'], default='lognormal')
+    parser.add_argument('--latency-s', type=float, default=3.0, help='mean model latency')
+    parser.add_argument('--latency-spread', type=float, default=0.5)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--deadline', type=float, default=6.0, help='latency budget before the local composer')
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--focus-file', help='CSV file with avg_alpha,avg_beta columns to replay')
+    parser.add_argument('--prompt', default='music_generation_prompt.txt')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    if args.streaming and args.scheduler == 'speculative':
+        parser.error('--streaming only applies to the paced scheduler')
+    asyncio.run(run_benchmark(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+
+class CompositionCache():
+    """
+    An LRU/TTL cache of parsed compositions keyed by focus bucket and musical context.
+
+    Attributes
+    ----------
+    bucket_size : float
+        width of a focus bucket on the [1, 100] focus scale
+    max_entries : int
+        size cap; the least recently used entry is evicted beyond it
+    ttl_s : float
+        entries older than this many seconds are treated as missing. None disables expiry
+    path : string
+        optional JSON file used to persist the cache between runs
+    encode, decode : callable
+        optional conversion of cached results to and from JSON-compatible values
+    """
+    def __init__(self, bucket_size=5, max_entries=256, ttl_s=3600, path=None, encode=None, decode=None):
+        self.bucket_size = bucket_size
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.path = path
+        self.encode = encode or (lambda result: result)
+        self.decode = decode or (lambda value: value)
+        self.entries = OrderedDict()  # key -> (created_at, result)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        if self.path:
+            self.load()
+
+    def bucket(self, focus):
+        return int(focus // self.bucket_size)
+
+    def make_key(self, focus, context):
+        """Build the cache key from the focus level and the text of the previous segment"""
+        context_hash = hashlib.sha1((context or '').encode('utf-8')).hexdigest()[:16]
+        return f"{self.bucket(focus)}:{context_hash}"
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        created_at, result = entry
+        if self.ttl_s is not None and time.time() - created_at > self.ttl_s:
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        self.entries[key] = (time.time(), result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations,
+                'hit_rate': self.hit_rate()}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as file:
+                data = json.load(file)
+            now = time.time()
+            fresh = [row for row in data if self.ttl_s is None or now - row[1] <= self.ttl_s]
+            # the file is in LRU order, so the most recently used entries come last
+            kept = fresh[len(fresh) - self.max_entries:] if len(fresh) > self.max_entries else fresh
+            for key, created_at, result in kept:
+                self.entries[key] = (created_at, self.decode(result))
+            print(f"Loaded {len(self.entries)} cached compositions from {self.path} "
+                  f"({len(data) - len(fresh)} expired, {len(fresh) - len(kept)} over the size cap)")
+        except (OSError, ValueError) as e:
+            print(f"Error loading composition cache: {e}")
+
+    def save(self):
+        """Persist the cache in LRU order, atomically"""
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump([[key, created_at, self.encode(result)] for key, (created_at, result) in self.entries.items()], file)
+        os.replace(tmp_path, self.path)
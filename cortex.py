@@ -7,6 +7,10 @@ import sys
 from pydispatch import Dispatcher
 import warnings
 import threading
+from fnmatch import fnmatchcase
+from operator import itemgetter
+
+from metrics import Counter, Histogram
 
 
 # define request id
@@ -35,6 +39,18 @@ GET_CORTEX_INFO_ID                  =   22
 UPDATE_MARKER_REQUEST_ID            =   23
 UNSUB_REQUEST_ID                    =   24
 REFRESH_HEADSET_LIST_ID             =   25
+QUERY_RECORDS_ID                    =   26
+
+# injectMarker requests may use an id from this range instead of INJECT_MARKER_REQUEST_ID,
+# so each response can be matched to its marker while many are in flight
+MARKER_REQUEST_IDS = range(1000, 1000000)
+
+# metrics, see metrics.py
+STREAM_FRAMES = Counter('cortex_frames_total', 'Stream data messages received', ['stream'])
+DECODE_SECONDS = Histogram('cortex_decode_seconds', 'Time to decode one websocket message')
+EMIT_SECONDS = Histogram('cortex_emit_seconds', 'Time to turn one data message into events and run their handlers',
+                         ['stream'])
+CORTEX_ERRORS = Counter('cortex_errors_total', 'Error responses from Cortex')
 
 #define error_code
 ERR_PROFILE_ACCESS_DENIED = -32046
@@ -60,14 +76,66 @@ HEADSET_CANNOT_WORK_WITH_BTLE = 112
 HEADSET_CANNOT_CONNECT_DISABLE_MOTION = 113
 HEADSET_SCANNING_FINISHED = 142
 
+class ActionEdge():
+    """
+    Turn (action, power) samples of the com or fac stream into action transitions.
+
+    A sample counts as its action while its power is at least ``on_power``, and the
+    current action keeps counting until its power drops below ``off_power``; other
+    samples count as neutral. A new action must last ``debounce_s`` before it is
+    reported, and a reported action is kept for at least ``hold_s``.
+    """
+    def __init__(self, on_power=0.5, off_power=None, debounce_s=0.25, hold_s=0.5, neutral='neutral'):
+        self.on_power = on_power
+        self.off_power = on_power if off_power is None else off_power
+        self.debounce_s = debounce_s
+        self.hold_s = hold_s
+        self.neutral = neutral
+        self.action = neutral
+        self.changed_at = None
+        self.candidate = None
+        self.candidate_since = None
+
+    def update(self, timestamp, action, power=1.0):
+        """
+        To feed one sample
+
+        Returns
+        -------
+        dict
+            {'action', 'previous', 'power', 'time'} when the action changed, else None
+        """
+        threshold = self.off_power if action == self.action else self.on_power
+        effective = action if power >= threshold else self.neutral
+        if effective == self.action:
+            self.candidate = None
+            return None
+        if effective != self.candidate:
+            self.candidate = effective
+            self.candidate_since = timestamp
+        if timestamp - self.candidate_since < self.debounce_s:
+            return None
+        if self.changed_at is not None and timestamp - self.changed_at < self.hold_s:
+            return None
+        transition = {'action': effective, 'previous': self.action, 'power': power, 'time': timestamp}
+        self.action = effective
+        self.changed_at = timestamp
+        self.candidate = None
+        return transition
+
+
 class Cortex(Dispatcher):
 
-    _events_ = ['inform_error','create_session_done', 'query_profile_done', 'load_unload_profile_done', 
+    _events_ = ['inform_error', 'authorize_done', 'create_session_done', 'query_profile_done', 'load_unload_profile_done', 
                 'save_profile_done', 'get_mc_active_action_done','mc_brainmap_done', 'mc_action_sensitivity_done', 
                 'mc_training_threshold_done', 'create_record_done', 'stop_record_done','warn_cortex_stop_all_sub', 'warn_record_post_processing_done',
-                'inject_marker_done', 'update_marker_done', 'export_record_done', 'new_data_labels', 
+                'inject_marker_done', 'update_marker_done', 'export_record_done', 'export_record_failed',
+                'query_records_done', 'new_data_labels', 
                 'new_com_data', 'new_fe_data', 'new_eeg_data', 'new_mot_data', 'new_dev_data', 
-                'new_met_data', 'new_pow_data', 'new_sys_data']
+                'new_met_data', 'new_pow_data', 'new_sys_data', 'com_action_changed', 'fe_action_changed']
+    # emit_hook(event, seconds) is called after the handlers of each event ran, see profiler.py
+    emit_hook = None
+
     def __init__(self, client_id, client_secret, debug_mode=False, **kwargs):
         
         self.session_id = ''
@@ -76,6 +144,13 @@ class Cortex(Dispatcher):
         self.debit = 10
         self.license = ''
         self.isHeadsetConnected = False
+        # column projections: stream name -> label patterns, and the resolved getters
+        self.projections = {}
+        self.projectors = {}
+        self.stream_labels = {}
+        # edge triggers: stream name -> [(channel, action index, power index, ActionEdge)]
+        self.edge_triggers = {}
+        self.sample_events = {'com': True, 'fac': True}
 
         if client_id == '':
             raise ValueError('Empty your_app_client_id. Please fill in your_app_client_id before running the example.')
@@ -96,6 +171,16 @@ class Cortex(Dispatcher):
             elif  key == 'headset_id':
                 self.headset_id = value
 
+    def emit(self, name, *args, **kwargs):
+        hook = Cortex.emit_hook
+        if hook is None:
+            return super().emit(name, *args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return super().emit(name, *args, **kwargs)
+        finally:
+            hook(name, time.perf_counter() - started)
+
     def open(self):
         url = "wss://localhost:6868"
         # websocket.enableTrace(True)
@@ -164,6 +249,7 @@ class Cortex(Dispatcher):
         elif req_id == AUTHORIZE_ID:
             print("Authorize successfully.")
             self.auth = result_dic['cortexToken']
+            self.emit('authorize_done', data=self.auth)
             #After successful authorization, the app will call the API refresh headset list for the first time
             self.refresh_headset_list()
             # query headsets
@@ -298,23 +384,31 @@ class Cortex(Dispatcher):
                 record_id = record['recordId']
                 success_export.append(record_id)
 
+            failure_export = []
             for record in result_dic['failure']:
                 record_id = record['recordId']
                 failure_msg = record['message']
                 print('export_record resp failure cases: '+ record_id + ":" + failure_msg)
+                failure_export.append({'recordId': record_id, 'message': failure_msg})
 
             self.emit('export_record_done', data=success_export)
-        elif req_id == INJECT_MARKER_REQUEST_ID:
-            self.emit('inject_marker_done', data=result_dic['marker'])
-        elif req_id == INJECT_MARKER_REQUEST_ID:
-            self.emit('update_marker_done', data=result_dic['marker'])
+            if failure_export:
+                self.emit('export_record_failed', data=failure_export)
+        elif req_id == QUERY_RECORDS_ID:
+            self.emit('query_records_done', data=result_dic['records'],
+                      count=result_dic['count'], offset=result_dic['offset'])
+        elif req_id == INJECT_MARKER_REQUEST_ID or req_id in MARKER_REQUEST_IDS:
+            self.emit('inject_marker_done', data=result_dic['marker'], request_id=req_id)
+        elif req_id == UPDATE_MARKER_REQUEST_ID:
+            self.emit('update_marker_done', data=result_dic['marker'], request_id=req_id)
         else:
             print('No handling for response of request ' + str(req_id))
 
     def handle_error(self, recv_dic):
         req_id = recv_dic['id']
         print('handle_error: request Id ' + str(req_id))
-        self.emit('inform_error', error_data=recv_dic['error'])
+        CORTEX_ERRORS.inc()
+        self.emit('inform_error', error_data=recv_dic['error'], request_id=req_id)
     
     def handle_warning(self, warning_dic):
 
@@ -347,12 +441,21 @@ class Cortex(Dispatcher):
 
     def handle_stream_data(self, result_dic):
         if result_dic.get('com') != None:
+            # edges go out before the per sample event, so reactions to commands come first
+            if 'com' in self.edge_triggers:
+                self.trigger_edges('com', result_dic['com'], result_dic['time'])
+                if not self.sample_events['com']:
+                    return
             com_data = {}
             com_data['action'] = result_dic['com'][0]
             com_data['power'] = result_dic['com'][1]
             com_data['time'] = result_dic['time']
             self.emit('new_com_data', data=com_data)
         elif result_dic.get('fac') != None:
+            if 'fac' in self.edge_triggers:
+                self.trigger_edges('fac', result_dic['fac'], result_dic['time'])
+                if not self.sample_events['fac']:
+                    return
             fe_data = {}
             fe_data['eyeAct'] = result_dic['fac'][0]    #eye action
             fe_data['uAct'] = result_dic['fac'][1]      #upper action
@@ -363,30 +466,34 @@ class Cortex(Dispatcher):
             self.emit('new_fe_data', data=fe_data)
         elif result_dic.get('eeg') != None:
             eeg_data = {}
-            eeg_data['eeg'] = result_dic['eeg']
-            eeg_data['eeg'].pop() # remove markers
+            projector = self.projectors.get('eeg')
+            if projector:
+                eeg_data['eeg'] = projector(result_dic['eeg'])
+            else:
+                eeg_data['eeg'] = result_dic['eeg']
+                eeg_data['eeg'].pop() # remove markers
             eeg_data['time'] = result_dic['time']
             self.emit('new_eeg_data', data=eeg_data)
         elif result_dic.get('mot') != None:
             mot_data = {}
-            mot_data['mot'] = result_dic['mot']
+            mot_data['mot'] = self.project_row('mot', result_dic['mot'])
             mot_data['time'] = result_dic['time']
             self.emit('new_mot_data', data=mot_data)
         elif result_dic.get('dev') != None:
             dev_data = {}
             dev_data['signal'] = result_dic['dev'][1]
-            dev_data['dev'] = result_dic['dev'][2]
+            dev_data['dev'] = self.project_row('dev', result_dic['dev'][2])
             dev_data['batteryPercent'] = result_dic['dev'][3]
             dev_data['time'] = result_dic['time']
             self.emit('new_dev_data', data=dev_data)
         elif result_dic.get('met') != None:
             met_data = {}
-            met_data['met'] = result_dic['met']
+            met_data['met'] = self.project_row('met', result_dic['met'])
             met_data['time'] = result_dic['time']
             self.emit('new_met_data', data=met_data)
         elif result_dic.get('pow') != None:
             pow_data = {}
-            pow_data['pow'] = result_dic['pow']
+            pow_data['pow'] = self.project_row('pow', result_dic['pow'])
             pow_data['time'] = result_dic['time']
             self.emit('new_pow_data', data=pow_data)
         elif result_dic.get('sys') != None:
@@ -395,10 +502,55 @@ class Cortex(Dispatcher):
         else :
             print(result_dic)
 
+    def set_edge_trigger(self, stream_name, sample_events=True, **options):
+        """
+        To emit an event only when the detected action changes
+
+        com samples emit com_action_changed, and fac samples emit fe_action_changed for
+        each of the eye, upper face and lower face actions, with data
+        {'action', 'previous', 'power', 'time', 'channel'}.
+
+        Parameters
+        ----------
+        stream_name : string, required
+            'com' or 'fac'
+        sample_events : bool, optional
+            keep emitting new_com_data or new_fe_data for every sample as well
+        other optional params are passed to ActionEdge: on_power, off_power, debounce_s, hold_s
+        Returns
+        -------
+        None
+        """
+        if stream_name == 'com':
+            self.edge_triggers['com'] = [('action', 0, 1, ActionEdge(**options))]
+        elif stream_name == 'fac':
+            # eye actions have no power
+            self.edge_triggers['fac'] = [('eye', 0, None, ActionEdge(**options)),
+                                         ('upper', 1, 2, ActionEdge(**options)),
+                                         ('lower', 3, 4, ActionEdge(**options))]
+        else:
+            raise ValueError('Edge triggers are for the com and fac streams, not ' + stream_name)
+        self.sample_events[stream_name] = sample_events
+
+    def trigger_edges(self, stream_name, values, timestamp):
+        event = 'com_action_changed' if stream_name == 'com' else 'fe_action_changed'
+        for channel, action_index, power_index, edge in self.edge_triggers[stream_name]:
+            power = 1.0 if power_index is None else values[power_index]
+            transition = edge.update(timestamp, values[action_index], power)
+            if transition is not None:
+                transition['channel'] = channel
+                self.emit(event, data=transition)
+
     def on_message(self, *args):
+        started = time.perf_counter()
         recv_dic = json.loads(args[1])
+        decoded = time.perf_counter()
+        DECODE_SECONDS.observe(decoded - started)
         if 'sid' in recv_dic:
+            stream_name = next(key for key in recv_dic if key != 'sid' and key != 'time')
+            STREAM_FRAMES.labels(stream_name).inc()
             self.handle_stream_data(recv_dic)
+            EMIT_SECONDS.labels(stream_name).observe(time.perf_counter() - decoded)
         elif 'result' in recv_dic:
             self.handle_result(recv_dic)
         elif 'error' in recv_dic:
@@ -611,10 +763,67 @@ class Cortex(Dispatcher):
         else:
             data_labels = stream_cols
 
+        self.stream_labels[stream_name] = data_labels
+        if stream_name in self.projections:
+            data_labels = self.resolve_projection(stream_name)
+
         labels['labels'] = data_labels
         print(labels)
         self.emit('new_data_labels', data=labels)
 
+    def project(self, stream_name, patterns):
+        """
+        To deliver only some columns of a stream
+
+        The patterns are matched against the stream's labels (shell-style, e.g. 'AF3/alpha',
+        '*/betaL' or 'AF3') when the subscription succeeds, and new_[stream]_data then
+        carries only the matching columns, in label order. new_data_labels reports the
+        projected labels. Projections of several consumers of a stream are combined.
+
+        Parameters
+        ----------
+        stream_name : string, required
+            'eeg', 'mot', 'dev', 'met' or 'pow'
+        patterns : list, required
+            label patterns of the wanted columns
+
+        Returns
+        -------
+        None
+        """
+        self.projections.setdefault(stream_name, [])
+        self.projections[stream_name].extend(patterns)
+        if stream_name in self.stream_labels:
+            self.resolve_projection(stream_name)
+
+    def resolve_projection(self, stream_name):
+        """
+        To precompute the column indices of a stream's projection
+
+        Returns
+        -------
+        list
+            the projected labels
+        """
+        labels = self.stream_labels[stream_name]
+        patterns = self.projections[stream_name]
+        indices = [i for i, label in enumerate(labels) if any(fnmatchcase(label, pattern) for pattern in patterns)]
+        if not indices:
+            warnings.warn('No {0} columns match {1}, delivering all columns'.format(stream_name, patterns))
+            self.projectors.pop(stream_name, None)
+            return labels
+        if len(indices) == 1:
+            index = indices[0]
+            self.projectors[stream_name] = lambda row: [row[index]]
+        else:
+            getter = itemgetter(*indices)
+            self.projectors[stream_name] = lambda row: list(getter(row))
+        return [labels[i] for i in indices]
+
+    def project_row(self, stream_name, row):
+        projector = self.projectors.get(stream_name)
+        return projector(row) if projector else row
+
     def query_profile(self):
         print('query profile --------------------------------')
         query_profile_json = {
@@ -766,8 +975,46 @@ class Cortex(Dispatcher):
         
         self.ws.send(json.dumps(export_record_request))
 
-    def inject_marker_request(self, time, value, label, **kwargs):
-        print('inject marker --------------------------------')
+    def query_records(self, query, order_by=None, limit=0, offset=0, **kwargs):
+        """
+        To query the records of the user
+
+        Parameters
+        ----------
+        query : dict, required
+            filter of the records, e.g. {"startDatetime": {"from": ..., "to": ...}}
+        order_by : list, optional
+            e.g. [{"startDatetime": "ASC"}], default is by start time
+        limit, offset : int, optional
+            page of the result, limit 0 means no limit
+        other optional params: Please reference to https://emotiv.gitbook.io/cortex-api/records/queryrecords
+        Returns
+        -------
+        None
+        """
+        print('query records --------------------------------')
+        params_val = {"cortexToken": self.auth,
+                      "query": query,
+                      "orderBy": order_by or [{"startDatetime": "ASC"}],
+                      "limit": limit,
+                      "offset": offset}
+
+        for key, value in kwargs.items():
+            params_val.update({key: value})
+
+        query_records_request = {
+            "jsonrpc": "2.0",
+            "id": QUERY_RECORDS_ID,
+            "method": "queryRecords",
+            "params": params_val
+        }
+        if self.debug:
+            print('query records request \n', json.dumps(query_records_request, indent=4))
+        self.ws.send(json.dumps(query_records_request))
+
+    def inject_marker_request(self, time, value, label, request_id=INJECT_MARKER_REQUEST_ID, **kwargs):
+        if self.debug or request_id == INJECT_MARKER_REQUEST_ID:
+            print('inject marker --------------------------------')
         params_val = {"cortexToken": self.auth, 
                       "session": self.session_id, 
                       "time": time,
@@ -779,7 +1026,7 @@ class Cortex(Dispatcher):
 
         inject_marker_request = {
             "jsonrpc": "2.0",
-            "id": INJECT_MARKER_REQUEST_ID,
+            "id": request_id,
             "method": "injectMarker", 
             "params": params_val
         }
@@ -0,0 +1,324 @@
+import argparse
+import concurrent.futures
+import importlib
+import json
+import os
+import threading
+
+from dotenv import load_dotenv
+
+from cortex import Cortex, EXPORT_RECORD_ID, QUERY_RECORDS_ID
+
+
+class ExportState():
+    """
+    Export progress of every record, saved as JSON after each change so an interrupted
+    export resumes where it stopped.
+
+    Attributes
+    ----------
+    records : dict
+        record id -> {'title', 'startDatetime', 'status', 'attempts', 'message', 'post'}
+        where status is 'pending', 'exporting', 'exported' or 'failed', and post is
+        None, 'done' or the post-processing error
+    """
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.lock = threading.RLock()
+        if path and os.path.exists(path):
+            with open(path, 'r') as file:
+                self.records = json.load(file)['records']
+            for entry in self.records.values():
+                # no response came for these before the interruption
+                if entry['status'] == 'exporting':
+                    entry['status'] = 'pending'
+
+    def add(self, record):
+        with self.lock:
+            if record['uuid'] not in self.records:
+                self.records[record['uuid']] = {'title': record.get('title'),
+                                                'startDatetime': record.get('startDatetime'),
+                                                'status': 'pending', 'attempts': 0,
+                                                'message': None, 'post': None}
+
+    def update(self, record_id, **fields):
+        with self.lock:
+            self.records[record_id].update(fields)
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump({'records': self.records}, file, indent=1)
+            os.replace(temp_path, self.path)
+
+    def counts(self):
+        with self.lock:
+            counts = {}
+            for entry in self.records.values():
+                counts[entry['status']] = counts.get(entry['status'], 0) + 1
+            return counts
+
+
+def run_post_process(target, folder, record_id, record):
+    """Worker side of post-processing: import ``module:function`` and call it"""
+    module_name, _, function_name = target.partition(':')
+    function = getattr(importlib.import_module(module_name), function_name)
+    function(folder, record_id, record)
+
+
+class BatchExporter():
+    """
+    Export all records in a time range, several records per exportRecord request.
+
+    Records are found with queryRecords, page by page, then exported in batches of
+    ``batch_size`` record ids with up to ``parallel`` requests in flight. Cortex reports
+    success or failure per record id, so each record is tracked on its own whichever
+    request it came back from. Failed records are retried up to ``max_attempts`` times,
+    and a batch with no response after ``batch_timeout_s`` counts as failed.
+
+    With ``post_process`` set to 'module:function', each exported record is handed to a
+    process pool which calls ``function(folder, record_id, record)``.
+    """
+    def __init__(self, app_client_id, app_client_secret, folder, stream_types, export_format='CSV',
+                 version='V2', start=None, end=None, batch_size=10, parallel=2, max_attempts=3,
+                 batch_timeout_s=600, state_path='export_state.json', post_process=None, workers=2,
+                 page_size=50, **kwargs):
+        self.c = Cortex(app_client_id, app_client_secret, debug_mode=False, **kwargs)
+        self.c.bind(authorize_done=self.on_authorize_done)
+        self.c.bind(query_records_done=self.on_query_records_done)
+        self.c.bind(export_record_done=self.on_export_record_done)
+        self.c.bind(export_record_failed=self.on_export_record_failed)
+        self.c.bind(inform_error=self.on_inform_error)
+
+        self.folder = folder
+        self.stream_types = stream_types
+        self.export_format = export_format
+        self.version = version
+        self.start_datetime = start
+        self.end_datetime = end
+        self.batch_size = batch_size
+        self.parallel = parallel
+        self.max_attempts = max_attempts
+        self.batch_timeout_s = batch_timeout_s
+        self.page_size = page_size
+
+        self.state = ExportState(state_path)
+        self.queue = []
+        self.batches = {}  # batch number -> {'ids': unanswered record ids, 'timer': Timer}
+        self.batch_count = 0
+        self.querying = False
+        self.lock = threading.RLock()
+
+        self.post_process = post_process
+        self.pool = concurrent.futures.ProcessPoolExecutor(workers) if post_process else None
+
+    def start(self, headsetId=''):
+        """
+        To export the records, returns when all exports are answered and post-processed
+        """
+        if headsetId != '':
+            self.c.set_wanted_headset(headsetId)
+        try:
+            self.c.open()
+        finally:
+            with self.lock:
+                for batch in self.batches.values():
+                    batch['timer'].cancel()
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
+            self.state.save()
+            print('Export finished: {0}'.format(self.state.counts()))
+
+    def query_page(self, offset):
+        query = {}
+        if self.start_datetime or self.end_datetime:
+            query['startDatetime'] = {key: value for key, value in
+                                      (('from', self.start_datetime), ('to', self.end_datetime)) if value}
+        self.c.query_records(query, limit=self.page_size, offset=offset)
+
+    def submit(self):
+        """To send batches until ``parallel`` are in flight"""
+        with self.lock:
+            while self.queue and len(self.batches) < self.parallel:
+                record_ids = self.queue[:self.batch_size]
+                del self.queue[:self.batch_size]
+                for record_id in record_ids:
+                    entry = self.state.records[record_id]
+                    entry['status'] = 'exporting'
+                    entry['attempts'] += 1
+                self.state.save()
+
+                self.batch_count += 1
+                timer = threading.Timer(self.batch_timeout_s, self.on_batch_timeout, (self.batch_count,))
+                timer.daemon = True
+                self.batches[self.batch_count] = {'ids': set(record_ids), 'timer': timer}
+                timer.start()
+                print('Exporting batch {0} of {1} records, {2} queued'.format(
+                    self.batch_count, len(record_ids), len(self.queue)))
+                self.c.export_record(self.folder, self.stream_types, self.export_format, record_ids, self.version)
+
+    def resolve(self, record_id, status, message=None):
+        with self.lock:
+            if record_id not in self.state.records:
+                return
+            for number, batch in list(self.batches.items()):
+                if record_id in batch['ids']:
+                    batch['ids'].discard(record_id)
+                    if not batch['ids']:
+                        batch['timer'].cancel()
+                        del self.batches[number]
+                    break
+
+            entry = self.state.records[record_id]
+            if status == 'failed' and entry['attempts'] < self.max_attempts:
+                print('Export of {0} failed, retrying: {1}'.format(record_id, message))
+                status = 'pending'
+                self.queue.append(record_id)
+            self.state.update(record_id, status=status, message=message)
+        if status == 'exported':
+            self.hand_off(record_id)
+
+    def hand_off(self, record_id):
+        if self.pool is None:
+            return
+        with self.lock:
+            self.state.update(record_id, post=None)
+            future = self.pool.submit(run_post_process, self.post_process, self.folder, record_id,
+                                      self.state.records[record_id])
+        future.add_done_callback(lambda done: self.on_post_process_done(record_id, done))
+
+    def finish_if_done(self):
+        with self.lock:
+            if not self.querying and not self.queue and not self.batches:
+                self.c.close()
+
+    # callbacks functions
+    def on_authorize_done(self, *args, **kwargs):
+        with self.lock:
+            if self.querying:
+                return
+            self.querying = True
+        self.query_page(0)
+
+    def on_query_records_done(self, *args, **kwargs):
+        records = kwargs.get('data')
+        count = kwargs.get('count')
+        offset = kwargs.get('offset')
+        for record in records:
+            self.state.add(record)
+        self.state.save()
+        print('Found {0} of {1} records'.format(offset + len(records), count))
+        if records and offset + len(records) < count:
+            self.query_page(offset + len(records))
+            return
+
+        with self.lock:
+            self.querying = False
+            self.queue = [record_id for record_id, entry in self.state.records.items()
+                          if entry['status'] == 'pending'
+                          or (entry['status'] == 'failed' and entry['attempts'] < self.max_attempts)]
+            # exported before the interruption but not post-processed
+            unprocessed = [record_id for record_id, entry in self.state.records.items()
+                           if entry['status'] == 'exported' and entry['post'] != 'done']
+        print('{0} records to export'.format(len(self.queue)))
+        for record_id in unprocessed:
+            self.hand_off(record_id)
+        self.submit()
+        self.finish_if_done()
+
+    def on_export_record_done(self, *args, **kwargs):
+        for record_id in kwargs.get('data'):
+            self.resolve(record_id, 'exported')
+        self.submit()
+        self.finish_if_done()
+
+    def on_export_record_failed(self, *args, **kwargs):
+        for failure in kwargs.get('data'):
+            self.resolve(failure['recordId'], 'failed', failure['message'])
+        self.submit()
+        self.finish_if_done()
+
+    def on_batch_timeout(self, number):
+        with self.lock:
+            batch = self.batches.get(number)
+            record_ids = list(batch['ids']) if batch else []
+        for record_id in record_ids:
+            self.resolve(record_id, 'failed', 'no export response after {0} s'.format(self.batch_timeout_s))
+        self.submit()
+        self.finish_if_done()
+
+    def on_inform_error(self, *args, **kwargs):
+        error_data = kwargs.get('error_data')
+        request_id = kwargs.get('request_id')
+        print(error_data)
+        if request_id == EXPORT_RECORD_ID:
+            # the error does not say which request it answers, so fail every batch in flight;
+            # a late success from another batch still marks its records exported
+            with self.lock:
+                record_ids = [record_id for batch in self.batches.values() for record_id in batch['ids']]
+            for record_id in record_ids:
+                self.resolve(record_id, 'failed', error_data.get('message'))
+            self.submit()
+            self.finish_if_done()
+        elif request_id == QUERY_RECORDS_ID:
+            with self.lock:
+                self.querying = False
+            self.finish_if_done()
+
+    def on_post_process_done(self, record_id, future):
+        try:
+            future.result()
+        except Exception as e:
+            print('Post-processing of {0} failed: {1}'.format(record_id, e))
+            self.state.update(record_id, post=str(e))
+            return
+        self.state.update(record_id, post='done')
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Set EMOTIV_CLIENT_ID and EMOTIV_CLIENT_SECRET as for live_advance_pow.py.
+#   - Records must be post-processed by Cortex before they can be exported, which is the
+#     case for records of earlier sessions.
+#   - Progress is kept in the --state file. Run the same command again after an interruption
+#     and only records not exported yet are exported. Delete the file to export everything again.
+#   - --post-process mymodule:convert calls convert(folder, record_id, record) in a worker
+#     process for each exported record, where record has the title and startDatetime.
+# RESULT
+#   - one csv or edf file per record and stream type in the export folder
+#
+# -----------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the Cortex records of a time range in parallel batches')
+    parser.add_argument('--folder', required=True, help='destination folder, must be writable')
+    parser.add_argument('--from', dest='start', help='earliest record start, ISO 8601')
+    parser.add_argument('--to', dest='end', help='latest record start, ISO 8601')
+    parser.add_argument('--streams', default='EEG,MOTION,PM,BP', help='comma separated stream types to export')
+    parser.add_argument('--format', default='CSV', choices=['CSV', 'EDF'])
+    parser.add_argument('--version', default='V2', help='CSV format version')
+    parser.add_argument('--batch-size', type=int, default=10, help='records per exportRecord request')
+    parser.add_argument('--parallel', type=int, default=2, help='exportRecord requests in flight')
+    parser.add_argument('--state', default='export_state.json', help='JSON file to resume from')
+    parser.add_argument('--post-process', metavar='MODULE:FUNCTION', help='called for each exported record')
+    parser.add_argument('--workers', type=int, default=2, help='post-processing worker processes')
+    args = parser.parse_args()
+    load_dotenv()
+
+    exporter = BatchExporter(os.getenv('EMOTIV_CLIENT_ID'), os.getenv('EMOTIV_CLIENT_SECRET'),
+                             args.folder, args.streams.split(','), args.format, args.version,
+                             start=args.start, end=args.end, batch_size=args.batch_size,
+                             parallel=args.parallel, state_path=args.state,
+                             post_process=args.post_process, workers=args.workers)
+    try:
+        exporter.start()
+    except KeyboardInterrupt:
+        print("Program stopped by user")
+
+if __name__ == '__main__':
+    main()
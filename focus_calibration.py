@@ -0,0 +1,211 @@
+import bisect
+import json
+import os
+import re
+
+# Default location of the per-user calibration files
+CALIBRATION_DIR = 'calibration'
+
+
+class QuantileSketch():
+    """
+    A streaming quantile sketch with bounded memory (P-square histogram, Jain & Chlamtac).
+
+    The sketch keeps ``cells + 1`` markers that track equally spaced quantiles of
+    everything seen so far. Each update costs O(cells) regardless of how many
+    samples have been added, so it can run for hours at full stream rate.
+
+    Attributes
+    ----------
+    cells : int
+        number of equal-probability cells tracked by the sketch
+    count : int
+        number of samples added so far
+    """
+    def __init__(self, cells=20):
+        if cells < 2:
+            raise ValueError('QuantileSketch needs at least 2 cells.')
+        self.cells = cells
+        self.count = 0
+        self.heights = []    # marker heights (quantile estimates)
+        self.positions = []  # marker positions (1-based ranks)
+
+    def is_ready(self):
+        return self.count > self.cells
+
+    def add(self, x):
+        """Add one sample to the sketch"""
+        x = float(x)
+        self.count += 1
+        b = self.cells
+
+        # warm up: collect the first b + 1 samples exactly
+        if self.count <= b + 1:
+            bisect.insort(self.heights, x)
+            if self.count == b + 1:
+                self.positions = list(range(1, b + 2))
+            return
+
+        q = self.heights
+        n = self.positions
+
+        # find the cell k such that q[k] <= x < q[k + 1]
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[b]:
+            q[b] = x
+            k = b - 1
+        else:
+            k = bisect.bisect_right(q, x) - 1
+
+        for i in range(k + 1, b + 1):
+            n[i] += 1
+
+        # adjust the interior markers towards their desired positions
+        step = (self.count - 1) / b
+        for i in range(1, b):
+            d = 1 + i * step - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                s = 1 if d > 0 else -1
+                candidate = self._parabolic(i, s)
+                if q[i - 1] < candidate < q[i + 1]:
+                    q[i] = candidate
+                else:
+                    q[i] = q[i] + s * (q[i + s] - q[i]) / (n[i + s] - n[i])
+                n[i] += s
+
+    def _parabolic(self, i, s):
+        q = self.heights
+        n = self.positions
+        return q[i] + s / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + s) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - s) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def quantile(self, p):
+        """Estimate the value at quantile p in [0, 1]"""
+        if not self.heights:
+            raise ValueError('QuantileSketch is empty.')
+        if not self.is_ready():
+            index = min(int(p * len(self.heights)), len(self.heights) - 1)
+            return self.heights[index]
+        position = p * self.cells
+        k = min(int(position), self.cells - 1)
+        return self.heights[k] + (position - k) * (self.heights[k + 1] - self.heights[k])
+
+    def percentile(self, x):
+        """Estimate the fraction of samples below x, in [0, 1]"""
+        q = self.heights
+        if not q:
+            return 0.5
+        if x <= q[0]:
+            return 0.0
+        if x >= q[-1]:
+            return 1.0
+        k = bisect.bisect_right(q, x) - 1
+        span = q[k + 1] - q[k]
+        fraction = (x - q[k]) / span if span > 0 else 0.0
+        return (k + fraction) / (len(q) - 1)
+
+    def to_dict(self):
+        return {'cells': self.cells, 'count': self.count,
+                'heights': self.heights, 'positions': self.positions}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['cells'])
+        sketch.count = data['count']
+        sketch.heights = list(data['heights'])
+        sketch.positions = list(data['positions'])
+        return sketch
+
+
+class FocusCalibrator():
+    """
+    Adaptive per-user mapping from alpha/beta band power to a focus value.
+
+    Raw band powers are mapped to their percentile within the user's own history,
+    so the output uses the whole [1, 100] range instead of sitting pinned at one
+    end of a fixed clip range. Until enough samples are seen the fixed mapping is used.
+
+    Attributes
+    ----------
+    user_id : string
+        identifier of the user, used as the calibration file name
+    alpha : QuantileSketch
+        sketch of the average alpha band power
+    beta : QuantileSketch
+        sketch of the average beta band power
+    """
+    def __init__(self, user_id, cells=20, save_every=300, directory=CALIBRATION_DIR):
+        self.user_id = user_id
+        self.alpha = QuantileSketch(cells)
+        self.beta = QuantileSketch(cells)
+        self.save_every = save_every
+        self.directory = directory
+        self.updates_since_save = 0
+
+    @classmethod
+    def load(cls, user_id, directory=CALIBRATION_DIR, **kwargs):
+        """Load the calibration of a returning user, or start a new one"""
+        calibrator = cls(user_id, directory=directory, **kwargs)
+        path = calibrator.path()
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as file:
+                    data = json.load(file)
+                calibrator.alpha = QuantileSketch.from_dict(data['alpha'])
+                calibrator.beta = QuantileSketch.from_dict(data['beta'])
+                print(f"Loaded focus calibration for {user_id} ({calibrator.alpha.count} samples)")
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error loading focus calibration for {user_id}: {e}")
+        return calibrator
+
+    def path(self):
+        safe_id = re.sub(r'[^\w.-]', '_', str(self.user_id))
+        return os.path.join(self.directory, safe_id + '.json')
+
+    def save(self):
+        """Persist the calibration atomically"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'user_id': self.user_id,
+                       'alpha': self.alpha.to_dict(),
+                       'beta': self.beta.to_dict()}, file)
+        os.replace(tmp_path, path)
+        self.updates_since_save = 0
+
+    def update(self, avg_alpha, avg_beta):
+        """Add a sample and return the calibrated focus in [1, 100]"""
+        self.alpha.add(avg_alpha)
+        self.beta.add(avg_beta)
+
+        self.updates_since_save += 1
+        if self.save_every and self.updates_since_save >= self.save_every:
+            try:
+                self.save()
+            except OSError as e:
+                print(f"Error saving focus calibration: {e}")
+
+        return self.map_focus(avg_alpha, avg_beta)
+
+    def map_focus(self, avg_alpha, avg_beta):
+        """Map band powers to focus without updating the calibration"""
+        if not (self.alpha.is_ready() and self.beta.is_ready()):
+            return fixed_focus(avg_alpha, avg_beta)
+        # alpha carries two thirds of the weight, as in the fixed [0, 2] + [0, 1] mapping
+        combined = (2 * self.alpha.percentile(avg_alpha) + self.beta.percentile(avg_beta)) / 3
+        return linear_map(combined, 0, 1, 1, 100)
+
+
+def linear_map(x, in_min, in_max, out_min, out_max):
+    return out_min + (x - in_min) * (out_max - out_min) / (in_max - in_min)
+
+
+def fixed_focus(avg_alpha, avg_beta):
+    """The uncalibrated mapping: clip alpha to [0, 2], beta to [0, 1] and scale to [1, 100]"""
+    clipped_alpha = min(max(avg_alpha, 0), 2)
+    clipped_beta = min(max(avg_beta, 0), 1)
+    return linear_map(clipped_alpha + clipped_beta, 0, 3, 1, 100)
@@ -1,19 +1,50 @@
 import cortex
 from cortex import Cortex
 
-import singlestoredb as s2
 from dotenv import load_dotenv
+from resources import connect_singlestore
+from band_power import LiveBandPower, POW_LAYOUT, PROJECTED_POW_LAYOUT, FOCUS_BAND_PATTERNS, focus_columns
+from artifact_gate import ArtifactGate, weighted_band_averages
+from metrics import Counter, Gauge, Histogram, serve_from_env
+import profiler
 import os
+import time
+from operator import itemgetter
 
-load_dotenv()
+FOCUS_UPDATES = Counter('duet_focus_updates_total', 'Alpha and beta averages computed from pow samples')
+FOCUS_REJECTED = Counter('duet_focus_rejected_total', 'Pow samples rejected by the artifact gate')
+FOCUS_LAST_UPDATE = Gauge('duet_focus_last_update_seconds', 'Time of the last alpha and beta averages')
+DB_FLUSH_SECONDS = Histogram('duet_db_flush_seconds', 'Time to insert and commit one row of averages')
+DB_ERRORS = Counter('duet_db_errors_total', 'Failed inserts into SingleStore')
 
-SINGLESTORE_HOST = os.getenv('SINGLESTORE_HOST')
-SINGLESTORE_USER = os.getenv('SINGLESTORE_USER')
-SINGLESTORE_PORT = os.getenv('SINGLESTORE_PORT')
-SINGLESTORE_DATABASE = os.getenv('SINGLESTORE_DATABASE')
-SINGLESTORE_PASSWORD = os.getenv('SINGLESTORE_PASSWORD')
 
-conn = s2.connect(f'{SINGLESTORE_USER}:{SINGLESTORE_PASSWORD}@{SINGLESTORE_HOST}:{SINGLESTORE_PORT}/{SINGLESTORE_DATABASE}')
+def band_averages(pow_values, channels=None, layout=POW_LAYOUT):
+    """
+    To reduce one pow sample to the average alpha and beta over all channels
+
+    Parameters
+    ----------
+    pow_values : list
+        [theta, alpha, lowBeta, highBeta, gamma] for each channel
+    channels : int, optional
+        number of channels in the sample, by default inferred from the layout
+    layout : tuple, optional
+        (values per channel, alpha, low beta, high beta) positions, see band_power
+
+    Returns
+    -------
+    (avg_alpha, avg_beta) : (float, float)
+        beta is the mean of low and high beta
+    """
+    width, alpha_index, low_index, high_index = layout
+    channels = channels or len(pow_values) // width
+    alpha = 0
+    beta = 0
+    for node in range(channels):
+        alpha += pow_values[node * width + alpha_index]
+        beta += (pow_values[node * width + low_index] + pow_values[node * width + high_index]) / 2
+
+    return alpha / channels, beta / channels
 
 
 class LivePowerBands():
@@ -24,6 +55,12 @@ class LivePowerBands():
     ----------
     c : Cortex
         Cortex communicate with Emotiv Cortex Service
+    conn : connection
+        SingleStore connection, opened on first use unless one is passed in
+    dsp : LiveBandPower
+        local band power from the raw eeg stream, or None to use the Cortex pow stream
+    gate : ArtifactGate
+        drops or down-weights samples during head movement and poor contact, or None
 
     Methods
     -------
@@ -32,12 +69,35 @@ class LivePowerBands():
     subscribe_data():
         To subscribe to power band data stream
     """
-    def __init__(self, app_client_id, app_client_secret, **kwargs):
+    def __init__(self, app_client_id, app_client_secret, conn=None, local_dsp=None, artifact_gate=None, **kwargs):
+        self._conn = conn
         self.c = Cortex(app_client_id, app_client_secret, debug_mode=True, **kwargs)
         self.c.bind(create_session_done=self.on_create_session_done)
-        self.c.bind(new_pow_data=self.on_new_pow_data)
+        self.focus_getter = None
+        if local_dsp is not None:
+            # local_dsp holds LiveBandPower options, e.g. {'sampling_rate': 256, 'window_s': 1.0}
+            self.dsp = LiveBandPower(self.c, lambda data: self.on_new_pow_data(data=data), **local_dsp)
+            self.layout = POW_LAYOUT
+        else:
+            self.dsp = None
+            self.c.bind(new_pow_data=self.on_new_pow_data)
+            # only alpha and beta are used, so only they are delivered; other consumers
+            # may add columns to the projection, so they are picked out by label
+            self.c.bind(new_data_labels=self.on_new_data_labels)
+            self.c.project('pow', FOCUS_BAND_PATTERNS)
+            self.layout = PROJECTED_POW_LAYOUT
+        # artifact_gate holds ArtifactGate options, e.g. {'mode': 'weight'}
+        self.gate = ArtifactGate(self.c, **artifact_gate) if artifact_gate is not None else None
         self.c.bind(inform_error=self.on_inform_error)
 
+    @property
+    def conn(self):
+        if self._conn is None:
+            started = time.perf_counter()
+            self._conn = connect_singlestore()
+            print('Connected to SingleStore in {:.3f}s'.format(time.perf_counter() - started))
+        return self._conn
+
     def start(self, headsetId=''):
         """
         To start live process as below workflow
@@ -72,10 +132,17 @@ class LivePowerBands():
         self.c.sub_request(streams)
 
     # callbacks functions
+    def on_new_data_labels(self, *args, **kwargs):
+        data = kwargs.get('data')
+        if data['streamName'] == 'pow':
+            self.focus_getter = itemgetter(*focus_columns(data['labels']))
+
     def on_create_session_done(self, *args, **kwargs):
         print('Session created')
-        # Subscribe to band power stream
-        stream = ['pow']
+        # Subscribe to band power stream, or raw eeg when band power is computed locally
+        stream = ['eeg'] if self.dsp else ['pow']
+        if self.gate:
+            stream += ['mot', 'dev']
         self.subscribe_data(stream)
 
     def on_new_pow_data(self, *args, **kwargs):
@@ -91,28 +158,59 @@ class LivePowerBands():
             for each channel
         """
         data = kwargs.get('data')
-        
-        # Calculate the average alpha and beta values
-        alpha = 0
-        beta = 0
-        for node in range(14):
-            alpha += data['pow'][node * 5 + 1]
-            beta += (data['pow'][node * 5 + 2] + data['pow'][node * 5 + 3]) / 2
-        
-        avg_alpha = alpha / 14
-        avg_beta = beta / 14
-        
+        averages = self.gated_averages(data)
+        if averages is not None:
+            self.store(*averages)
+
+    def gated_averages(self, data):
+        """
+        To reduce a pow sample to average alpha and beta, weighted by the artifact gate
+
+        Returns
+        -------
+        (avg_alpha, avg_beta) : (float, float)
+            or None if the gate rejected the sample
+        """
+        pow_values = self.focus_pow(data['pow'])
+        if self.gate is None:
+            averages = band_averages(pow_values, layout=self.layout)
+        else:
+            channels = self.dsp.channel_names if self.dsp else self.gate.pow_channels
+            averages = weighted_band_averages(pow_values, self.gate.weights(data['time'], channels), self.layout)
+            if self.gate.stats['samples'] % 100 == 0:
+                print("Artifact rejection rate: {:.1%} {}".format(self.gate.rejection_rate(), self.gate.stats))
+
+        if averages is None:
+            FOCUS_REJECTED.inc()
+        else:
+            FOCUS_UPDATES.inc()
+            FOCUS_LAST_UPDATE.set_to_current_time()
+        return averages
+
+    def focus_pow(self, pow_values):
+        """
+        To pick the alpha and beta columns out of a projected pow sample, in ``self.layout``
+        """
+        return list(self.focus_getter(pow_values)) if self.focus_getter else pow_values
+
+    def store(self, avg_alpha, avg_beta):
+        """
+        To insert one pair of averages into SingleStore
+        """
         # Prepare the data for insertion
         sql = "INSERT INTO brain_wave_data (avg_alpha, avg_beta) VALUES (%s, %s)"
         values = (avg_alpha, avg_beta)
 
+        started = time.perf_counter()
         try:
             # Use the established connection to execute the SQL command
-            with conn.cursor() as cursor:
+            with self.conn.cursor() as cursor:
                 cursor.execute(sql, values)
-                conn.commit()  # Commit the transaction
+                self.conn.commit()  # Commit the transaction
         except Exception as e:
+            DB_ERRORS.inc()
             print("Error uploading data to SingleStore: {}".format(e))
+        DB_FLUSH_SECONDS.observe(time.perf_counter() - started)
 
         # Print the values (optional)
         print("Average Alpha: {}, Average Beta: {}".format(avg_alpha, avg_beta))
@@ -141,16 +239,42 @@ class LivePowerBands():
 # RESULT
 #    You will receive live band power data in the format:
 #    {'pow': [0.5, 0.6, 0.7, 0.4, 0.3, 0.2, 0.1, 0.3], 'time': 1647525819.0223}
+#   - Set DUET_LOCAL_DSP=1 to compute the band powers from the raw eeg stream instead
+#     (band_power.py), with DUET_EEG_RATE (default 128) and DUET_DSP_UPDATE_S (default 0.125)
+#   - Set DUET_ARTIFACT_GATE=mask (or weight) to drop (or down-weight) samples taken during
+#     head movement or with poor electrode contact (artifact_gate.py)
+#   - Set DUET_METRICS_PORT (e.g. 9108) to serve counters and latencies at
+#     http://127.0.0.1:9108/metrics in the Prometheus text format (metrics.py)
+#   - Send SIGUSR1 (kill -USR1 <pid>) to start profiling and again to write a flame graph
+#     profile, or set DUET_PROFILE_PORT and send 'start' / 'stop' to it (profiler.py)
 # 
 # -----------------------------------------------------------
 
+def local_dsp_options():
+    """LiveBandPower options from the environment, or None to use the Cortex pow stream"""
+    if os.getenv('DUET_LOCAL_DSP') != '1':
+        return None
+    return {'sampling_rate': float(os.getenv('DUET_EEG_RATE', '128')),
+            'update_s': float(os.getenv('DUET_DSP_UPDATE_S', '0.125'))}
+
+def artifact_gate_options():
+    """ArtifactGate options from the environment, or None to use every sample"""
+    mode = os.getenv('DUET_ARTIFACT_GATE')
+    return {'mode': mode} if mode else None
+
 def main():
+    load_dotenv()
+    serve_from_env()
+    # SIGUSR1 or DUET_PROFILE_PORT start and stop a sampling profiler (profiler.py)
+    profiler.install()
+
     # Please fill your application clientId and clientSecret before running script
     your_app_client_id = os.getenv('EMOTIV_CLIENT_ID')
     your_app_client_secret = os.getenv('EMOTIV_CLIENT_SECRET')
 
     # Init live power bands
-    l = LivePowerBands(your_app_client_id, your_app_client_secret)
+    l = LivePowerBands(your_app_client_id, your_app_client_secret, local_dsp=local_dsp_options(),
+                       artifact_gate=artifact_gate_options())
     
     # Start the session
     l.start()
@@ -0,0 +1,253 @@
+import heapq
+import threading
+import time
+from bisect import bisect_left, bisect_right
+
+from cortex import MARKER_REQUEST_IDS
+
+
+class Marker():
+    """
+    One instant marker.
+
+    Attributes
+    ----------
+    time : float
+        epoch time of the marker, in seconds like the time of stream samples
+    label, value :
+        label and value as sent to injectMarker
+    extras : dict
+        extra fields sent with the marker, e.g. synth and segment of a note
+    uuid : string
+        Cortex id of the marker once injected
+    state : string
+        'queued', 'sending', 'sent', 'failed', or 'local' if no record was running
+    """
+    __slots__ = ('time', 'label', 'value', 'extras', 'uuid', 'state')
+
+    def __init__(self, time, label, value, extras):
+        self.time = time
+        self.label = label
+        self.value = value
+        self.extras = extras
+        self.uuid = None
+        self.state = 'queued'
+
+    def __repr__(self):
+        return 'Marker({0:.3f}, {1!r}, {2!r}, {3})'.format(self.time, self.label, self.value, self.state)
+
+
+def note_markers(segment_id, start, sequence):
+    """(time, label, value, extras) of every note onset of a NoteSequence played from ``start``"""
+    for i in range(len(sequence)):
+        yield (start + sequence.onsets[i], sequence.note_name(i), sequence.pitches[i],
+               {'synth': sequence.instrument_name(i), 'segment': segment_id})
+
+
+class MarkerStore():
+    """
+    Markers kept sorted by time.
+
+    Markers mostly arrive in time order, so adding one is usually an append; an out of
+    order marker is inserted at its place. Range queries bisect the time list, so they
+    take O(log n) plus the number of markers returned.
+    """
+    def __init__(self):
+        self.times = []
+        self.markers = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, marker):
+        with self.lock:
+            if not self.times or marker.time >= self.times[-1]:
+                self.times.append(marker.time)
+                self.markers.append(marker)
+            else:
+                index = bisect_right(self.times, marker.time)
+                self.times.insert(index, marker.time)
+                self.markers.insert(index, marker)
+
+    def between(self, start, end):
+        """Markers with start <= time <= end, in time order"""
+        with self.lock:
+            return self.markers[bisect_left(self.times, start):bisect_right(self.times, end)]
+
+    def count_between(self, start, end):
+        with self.lock:
+            return bisect_right(self.times, end) - bisect_left(self.times, start)
+
+    def join(self, windows):
+        """
+        Markers falling in each window.
+
+        Parameters
+        ----------
+        windows : iterable
+            (start, end) pairs, e.g. the spans of EEG or band power windows
+
+        Returns
+        -------
+        list
+            one list of markers per window
+        """
+        with self.lock:
+            return [self.markers[bisect_left(self.times, start):bisect_right(self.times, end)]
+                    for start, end in windows]
+
+
+class MarkerService():
+    """
+    Queue markers and inject them into the running Cortex record from a sender thread.
+
+    ``mark`` only stores the marker and queues it, so it can be called at a high rate
+    from the music or websocket threads. The sender injects each marker when its time
+    has come (note onsets are known before they sound), with up to ``max_in_flight``
+    injectMarker requests outstanding. Every request gets its own id from
+    MARKER_REQUEST_IDS, so each response or error is matched to its marker.
+
+    Cortex only accepts markers while a record is running in the session; markers due
+    outside a record are kept in the local store only, with state 'local'. A request
+    with no response after ``response_timeout_s`` counts as failed and frees its slot.
+
+    Attributes
+    ----------
+    store : MarkerStore
+        every marker, for time range queries
+    stats : dict
+        markers queued, sent, failed (timeouts included) and kept local only
+    """
+    def __init__(self, cortex, max_in_flight=16, port='duet', response_timeout_s=5.0, clock=time.time):
+        self.c = cortex
+        self.max_in_flight = max_in_flight
+        self.port = port
+        self.response_timeout_s = response_timeout_s
+        self.clock = clock
+        self.store = MarkerStore()
+        self.queue = []  # heap of (time, sequence, marker)
+        self.sequence = 0
+        self.in_flight = {}  # request id -> (marker, sent_at)
+        self.recording = False
+        self.running = True
+        self.condition = threading.Condition()
+        self.stats = {'queued': 0, 'sent': 0, 'failed': 0, 'local': 0, 'timeouts': 0}
+
+        self.c.bind(inject_marker_done=self.on_inject_marker_done)
+        self.c.bind(inform_error=self.on_inform_error)
+        self.c.bind(create_record_done=self.on_create_record_done)
+        self.c.bind(stop_record_done=self.on_stop_record_done)
+        self.thread = threading.Thread(target=self.send_loop, name='MarkerThread', daemon=True)
+        self.thread.start()
+
+    def mark(self, label, value, timestamp=None, **extras):
+        """
+        To add a marker at ``timestamp`` (epoch seconds, default now)
+
+        Returns
+        -------
+        Marker
+        """
+        marker = Marker(self.clock() if timestamp is None else timestamp, label, value, extras)
+        self.store.add(marker)
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.queue, (marker.time, self.sequence, marker))
+            self.stats['queued'] += 1
+            self.condition.notify()
+        return marker
+
+    def mark_notes(self, segment_id, start, sequence):
+        """
+        To mark every note onset of a NoteSequence played from ``start``
+
+        Has the signature of an OscBundleTransport listener.
+        """
+        for timestamp, label, value, extras in note_markers(segment_id, start, sequence):
+            self.mark(label, value, timestamp, **extras)
+
+    def between(self, start, end):
+        return self.store.between(start, end)
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+    def next_due(self):
+        """The next marker to send, waiting until it is due and a request slot is free"""
+        with self.condition:
+            while self.running:
+                now = self.clock()
+                self.expire(now)
+                waits = []
+                if self.in_flight:
+                    oldest = min(sent_at for _, sent_at in self.in_flight.values())
+                    waits.append(oldest + self.response_timeout_s - now)
+                if self.queue and len(self.in_flight) < self.max_in_flight:
+                    wait_s = self.queue[0][0] - now
+                    if wait_s <= 0:
+                        marker = heapq.heappop(self.queue)[2]
+                        if not self.recording:
+                            marker.state = 'local'
+                            self.stats['local'] += 1
+                            continue
+                        request_id = MARKER_REQUEST_IDS[self.sequence % len(MARKER_REQUEST_IDS)]
+                        self.sequence += 1
+                        marker.state = 'sending'
+                        self.in_flight[request_id] = (marker, now)
+                        return request_id, marker
+                    waits.append(wait_s)
+                self.condition.wait(max(0.0, min(waits)) if waits else None)
+            return None
+
+    def expire(self, now):
+        """To fail the requests that got no response in time, so their slots are reused"""
+        for request_id, (marker, sent_at) in list(self.in_flight.items()):
+            if now - sent_at >= self.response_timeout_s:
+                del self.in_flight[request_id]
+                marker.state = 'failed'
+                self.stats['failed'] += 1
+                self.stats['timeouts'] += 1
+
+    def send_loop(self):
+        while True:
+            due = self.next_due()
+            if due is None:
+                return
+            request_id, marker = due
+            extras = {'extras': marker.extras} if marker.extras else {}
+            self.c.inject_marker_request(int(round(marker.time * 1000)), marker.value, marker.label,
+                                         request_id=request_id, port=self.port, **extras)
+
+    def resolve(self, request_id, state, uuid=None):
+        with self.condition:
+            entry = self.in_flight.pop(request_id, None)
+            if entry is None:
+                # unknown, or answered after its timeout
+                return
+            marker = entry[0]
+            marker.state = state
+            marker.uuid = uuid
+            self.stats[state] += 1
+            self.condition.notify()
+
+    # callbacks functions
+    def on_inject_marker_done(self, *args, **kwargs):
+        self.resolve(kwargs.get('request_id'), 'sent', kwargs.get('data')['uuid'])
+
+    def on_inform_error(self, *args, **kwargs):
+        if kwargs.get('request_id') in self.in_flight:
+            print('inject marker failed: {0}'.format(kwargs.get('error_data')))
+            self.resolve(kwargs.get('request_id'), 'failed')
+
+    def on_create_record_done(self, *args, **kwargs):
+        with self.condition:
+            self.recording = True
+            self.condition.notify()
+
+    def on_stop_record_done(self, *args, **kwargs):
+        with self.condition:
+            self.recording = False
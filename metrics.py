@@ -0,0 +1,256 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# default histogram buckets in seconds, from sub millisecond decoding to slow model calls
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values, extra=''):
+    pairs = ['{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Registry():
+    """The metrics of this process, rendered in the Prometheus text exposition format"""
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is None:
+                self.metrics[metric.name] = metric
+            elif existing.kind == metric.kind and existing.labelnames == metric.labelnames:
+                # the same module imported twice, e.g. as __main__ and by name: share the values
+                metric.children = existing.children
+                metric.lock = existing.lock
+            else:
+                raise ValueError('Duplicate metric ' + metric.name)
+
+    def exposition(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric():
+    """
+    A metric family: one child per combination of label values.
+
+    Children are created on first use and cached, so the hot path is a dict lookup
+    (``labels``) and a locked update. Keep the child returned by ``labels`` to skip
+    the lookup too.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            self.children[()] = self.new_child()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('{0} takes labels {1}'.format(self.name, self.labelnames))
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def samples(self):
+        with self.lock:
+            children = list(self.children.items())
+        lines = []
+        for values, child in children:
+            lines.extend(child.samples(self.name, self.labelnames, values))
+        return lines
+
+
+class CounterChild():
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labelnames, values):
+        return ['{0}{1} {2}'.format(name, format_labels(labelnames, values), format_value(self.value))]
+
+
+class GaugeChild(CounterChild):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_to_current_time(self):
+        self.value = time.time()
+
+
+class HistogramChild():
+    __slots__ = ('buckets', 'counts', 'sum', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name, labelnames, values):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append('{0}_bucket{1} {2}'.format(
+                name, format_labels(labelnames, values, 'le="{0}"'.format(format_value(bound))), cumulative))
+        lines.append('{0}_sum{1} {2}'.format(name, format_labels(labelnames, values), format_value(total)))
+        lines.append('{0}_count{1} {2}'.format(name, format_labels(labelnames, values), cumulative))
+        return lines
+
+
+class Counter(Metric):
+    """A count that only goes up, e.g. frames received"""
+    kind = 'counter'
+
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+
+class Gauge(Metric):
+    """A value that goes up and down, e.g. queue length or the time of the last update"""
+    kind = 'gauge'
+
+    def new_child(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self.children[()].set(value)
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self.children[()].dec(amount)
+
+    def set_to_current_time(self):
+        self.children[()].set_to_current_time()
+
+
+class Histogram(Metric):
+    """
+    Observations counted into fixed buckets, e.g. latencies.
+
+    ``buckets`` are the upper bounds in increasing order; +Inf is added.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames, registry)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would flood the console
+        pass
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    """
+    To serve the metrics on http://host:port/metrics from a daemon thread
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        call shutdown() to stop serving
+    """
+    handler = type('Handler', (MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='MetricsThread', daemon=True).start()
+    print('Serving metrics on http://{0}:{1}/metrics'.format(host, server.server_address[1]))
+    return server
+
+
+def serve_from_env(offset=0):
+    """
+    To serve the metrics if DUET_METRICS_PORT is set
+
+    ``offset`` is added to the port, so processes started together do not collide.
+    """
+    port = os.getenv('DUET_METRICS_PORT')
+    if not port:
+        return None
+    try:
+        return serve(int(port) + offset)
+    except OSError as e:
+        print('Could not serve metrics: {0}'.format(e))
+        return None
@@ -1,54 +1,336 @@
 import random
-from pythonosc import udp_client
-import google.generativeai as genai
-from dotenv import load_dotenv
 import os
-import re
-import math
 import asyncio
 import statistics
-import singlestoredb as s2
-
-load_dotenv()
-
-# Initialize Gemini
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-model = genai.GenerativeModel('gemini-pro')
-
-# Initialize database connection
-SINGLESTORE_HOST = os.getenv('SINGLESTORE_HOST')
-SINGLESTORE_USER = os.getenv('SINGLESTORE_USER')
-SINGLESTORE_PORT = os.getenv('SINGLESTORE_PORT')
-SINGLESTORE_DATABASE = os.getenv('SINGLESTORE_DATABASE')
-SINGLESTORE_PASSWORD = os.getenv('SINGLESTORE_PASSWORD')
-
-conn = s2.connect(f'{SINGLESTORE_USER}:{SINGLESTORE_PASSWORD}@{SINGLESTORE_HOST}:{SINGLESTORE_PORT}/{SINGLESTORE_DATABASE}')
-
-# Read the prompt file
-with open('music_generation_prompt.txt', 'r') as file:
-    prompt = file.read()
-
-# Create an OSC client
-ip = "127.0.0.1"
-port = 4560
-client = udp_client.SimpleUDPClient(ip, port)
+import time
+from focus_calibration import FocusCalibrator, fixed_focus
+from composition_cache import CompositionCache
+from speculation import SpeculativeScheduler
+from note_events import NoteSequence, MIDI_TO_NOTE
+from osc_transport import OscBundleTransport
+from pacing import PacingScheduler
+from prompt_context import ContextBuilder
+from resources import DuetResources
+from metrics import Counter, Histogram, serve_from_env
+import profiler
+
+LLM_SECONDS = Histogram('duet_llm_seconds', 'Time for the model to return a whole composition', ['mode'])
+LLM_FIRST_PHRASE_SECONDS = Histogram('duet_llm_first_phrase_seconds', 'Time to the first streamed phrase')
+LLM_ERRORS = Counter('duet_llm_errors_total', 'Failed model calls')
+OSC_SENDS = Counter('duet_osc_sends_total', 'Sequences and phrases sent to Sonic Pi', ['address'])
+
+# Model, database, prompt and OSC client are created on first use (see resources.py)
+default_resources = DuetResources()
+
+class StreamingMusicParser:
+    """Incrementally parse streamed model output into musically complete phrases"""
+    def __init__(self, phrase_duration=1.0):
+        self.phrase_duration = phrase_duration  # one measure, as requested by the prompt
+        self.partial_line = ""
+        self.phrase_start = 0.0
+        self.result = NoteSequence()
+
+    def feed(self, text):
+        """Consume a chunk of text and return the phrases it completed"""
+        text = self.partial_line + text
+        cut = text.rfind('\n') + 1
+        self.partial_line = text[cut:]
+        self.result.extend(text[:cut])
+
+        phrases = []
+        while self.result.duration - self.phrase_start >= self.phrase_duration - 1e-6:
+            phrases.append(self.result.slice(self.phrase_start, self.result.duration))
+            self.phrase_start = self.result.duration
+        return phrases
+
+    def close(self):
+        """Flush the remaining text and return the last, possibly partial, phrase"""
+        self.result.extend(self.partial_line)
+        self.partial_line = ""
+        phrase = self.result.slice(self.phrase_start, float('inf'))
+        self.phrase_start = self.result.duration
+        return phrase
+
+def focus_instruction(average_focus):
+    """The part of the prompt that asks for a given focus level"""
+    return f"Generate music that, on a scale of 1 (very very slow and sad) to 100 (extremely fast, happy, and exciting, with lots of notes), has a value of {average_focus}/100. For higher values of focus, use triplets, 16th notes, sextuplets, and 32nd notes, in increasing order. For lower values of focus, use half notes, whole notes, and dotted half notes, in decreasing order. Use a variety of instruments and dynamics to create a piece that is engaging and exciting."
+
+class ProceduralComposer:
+    """Deterministic rule-based composer used when the model misses its deadline"""
+    MAJOR_SCALE = (0, 2, 4, 5, 7, 9, 11)
+    MINOR_SCALE = (0, 2, 3, 5, 7, 8, 10)
+    # chord roots as scale degrees: I-V-vi-IV in major, i-VI-III-VII in minor
+    MAJOR_PROGRESSION = (0, 4, 5, 3)
+    MINOR_PROGRESSION = (0, 5, 2, 6)
+
+    def __init__(self, measures=4, measure_duration=1.0):
+        self.measures = measures
+        self.measure_duration = measure_duration
+
+    def note(self, midi):
+        return MIDI_TO_NOTE[midi]
+
+    def tonic(self, last_generation):
+        """Keep the key of the previous segment: its most common pitch class, weighted to the bass"""
+        if not last_generation:
+            return 0
+        counts = [0] * 12
+        for pitch in last_generation.pitches:
+            counts[pitch % 12] += 2 if pitch < 55 else 1
+        return counts.index(max(counts))
+
+    def compose(self, average_focus, last_generation=None):
+        """Compose a segment as synth/sleep lines and parse it"""
+        context = last_generation.to_prompt_text() if last_generation else ""
+        rng = random.Random(f"{round(average_focus)}:{context}")
+
+        minor = average_focus < 50
+        scale = self.MINOR_SCALE if minor else self.MAJOR_SCALE
+        progression = self.MINOR_PROGRESSION if minor else self.MAJOR_PROGRESSION
+        tonic = self.tonic(last_generation)
+
+        # slower subdivisions for low focus, faster ones for high focus
+        subdivisions = (1, 2, 3, 4, 6, 8)[min(int(average_focus // 17), 5)]
+        step = round(self.measure_duration / subdivisions, 4)
+        amp = round(0.15 + 0.25 * average_focus / 100, 2)
+        lead = 'piano' if average_focus < 40 else ('pluck' if average_focus < 75 else 'saw')
+        bass = 'sine' if average_focus < 60 else 'tb303'
+
+        def scale_note(degree, octave):
+            return 12 * (octave + 1) + tonic + scale[degree % 7] + 12 * (degree // 7)
+
+        lines = []
+        melody_degree = 7
+        for measure in range(self.measures):
+            root = progression[measure % len(progression)]
+            chord = (root, root + 2, root + 4)
+            for beat in range(subdivisions):
+                if beat == 0:
+                    lines.append(f"synth :{bass}, note: :{self.note(scale_note(root, 2))}, release: {self.measure_duration}, amp: {amp}")
+                    melody_degree = chord[rng.randrange(3)] + 7
+                else:
+                    melody_degree += rng.choice((-2, -1, 1, 2))
+                    melody_degree = min(max(melody_degree, 5), 13)
+                lines.append(f"synth :{lead}, note: :{self.note(scale_note(melody_degree, 4))}, release: {step}, amp: {amp}")
+                if beat * 2 == subdivisions or (subdivisions == 1 and beat == 0):
+                    lines.append(f"synth :hollow, note: :{self.note(scale_note(chord[1], 3))}, release: {self.measure_duration / 2}, amp: {round(amp * 0.7, 2)}")
+                # the last step absorbs rounding so every measure sums to measure_duration
+                if beat == subdivisions - 1:
+                    lines.append(f"sleep {round(self.measure_duration - step * (subdivisions - 1), 4)}")
+                else:
+                    lines.append(f"sleep {step}")
+        return NoteSequence.parse("\n".join(lines))
 
 class MusicGenerator:
-    def __init__(self):
+    def __init__(self, cache=None, streaming=False, transport=None, deadline_s=None, context_builder=None,
+                 resources=None):
         self.last_generation = None
         self.last_focus = None
+        self.last_duration = 0.0
+        self.segment_count = 0
         self.is_generating = False
         self.lock = asyncio.Lock()
+        self.cache = cache
+        self.streaming = streaming
+        self.transport = transport
+        self.deadline_s = deadline_s  # latency budget before the local composer takes over
+        self.composer = ProceduralComposer()
+        self.context_builder = context_builder
+        self.resources = resources or default_resources
 
     def format_music_for_prompt(self, result):
         """Convert the music result into a readable format for the prompt"""
-        formatted_lines = []
-        for item in result:
-            if item[0] == 'synth':
-                formatted_lines.append(f"synth :{item[1]}, note: :{item[2]}, release: {item[3]}, amp: {item[4]}")
-            elif item[0] == 'sleep':
-                formatted_lines.append(f"sleep {item[3]}")
-        return "\n".join(formatted_lines)
+        return result.to_prompt_text()
+
+    def build_prompt(self, average_focus):
+        """Build the complete prompt for a focus level, continuing from the last generation"""
+        if self.context_builder is not None:
+            return self.context_builder.build(focus_instruction(average_focus), self.last_generation, self.last_focus)
+
+        continuation_prompt = ""
+        if self.last_generation and self.last_focus is not None:
+            continuation_prompt = f"""
+                The previous music segment (at focus level {self.last_focus}/100) was:
+
+                {self.format_music_for_prompt(self.last_generation)}
+
+                Please create a natural musical continuation that transitions smoothly to the new focus level, maintaining thematic elements where appropriate while adjusting to the new intensity.
+                """
+
+        return f"{self.resources.prompt}\n\n{focus_instruction(average_focus)}{continuation_prompt}"
+
+    async def call_model(self, complete_prompt):
+        """Generate response text using Gemini"""
+        model = self.resources.model
+        started = time.perf_counter()
+        try:
+            return await asyncio.to_thread(
+                lambda: model.generate_content(complete_prompt).text
+            )
+        except Exception:
+            LLM_ERRORS.inc()
+            raise
+        finally:
+            LLM_SECONDS.labels('complete').observe(time.perf_counter() - started)
+
+    async def compose(self, average_focus):
+        """Compose a parsed sequence for the focus level, using the cache when possible"""
+        key = self.cache_key(average_focus)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                print(f"Composition cache hit (hit rate {self.cache.hit_rate():.0%})")
+                return cached
+
+        complete_prompt = self.build_prompt(average_focus)
+        response = await self.call_model(complete_prompt)
+        result = NoteSequence.parse(response)
+        if result.rejected:
+            print(f"Dropped {result.rejected} lines with unknown instruments or notes")
+
+        if key is not None and result:
+            self.cache.put(key, result)
+        return result
+
+    def compose_local(self, average_focus):
+        """Compose with the local procedural composer"""
+        result = self.composer.compose(average_focus, self.last_generation)
+        print(f"Composed locally for focus level {average_focus}")
+        return result
+
+    async def compose_with_deadline(self, average_focus):
+        """Race the model against the deadline and fall back to the local composer"""
+        if self.deadline_s is None:
+            return await self.compose(average_focus)
+
+        # the model keeps running after the deadline so its result still reaches the cache
+        task = asyncio.create_task(self.compose(average_focus))
+        task.add_done_callback(self.on_compose_done)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(task), self.deadline_s)
+            if result:
+                return result
+        except asyncio.TimeoutError:
+            print(f"Model missed the {self.deadline_s}s deadline")
+        except Exception:
+            pass  # logged by on_compose_done
+        return self.compose_local(average_focus)
+
+    @staticmethod
+    def on_compose_done(task):
+        # the task can fail after the deadline when nothing awaits it any more,
+        # so its exception is retrieved and logged here rather than left unretrieved
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error generating music: {task.exception()}")
+
+    def cache_key(self, average_focus):
+        if self.cache is None:
+            return None
+        context = self.format_music_for_prompt(self.last_generation) if self.last_generation else ""
+        return self.cache.make_key(average_focus, context)
+
+    async def stream_compose(self, average_focus):
+        """
+        Stream the model output and send each phrase to Sonic Pi as soon as it is parsed
+
+        Returns None, having sent nothing, when no phrase arrived within deadline_s; the
+        stream then finishes in the background so its result still reaches the cache.
+        """
+        key = self.cache_key(average_focus)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                print(f"Composition cache hit (hit rate {self.cache.hit_rate():.0%})")
+                self.send(cached)
+                return cached
+
+        complete_prompt = self.build_prompt(average_focus)
+        parser = StreamingMusicParser()
+        loop = asyncio.get_running_loop()
+        phrases = asyncio.Queue()
+        model = self.resources.model
+
+        def consume_stream():
+            try:
+                for chunk in model.generate_content(complete_prompt, stream=True):
+                    for phrase in parser.feed(chunk.text):
+                        loop.call_soon_threadsafe(phrases.put_nowait, phrase)
+                loop.call_soon_threadsafe(phrases.put_nowait, parser.close())
+            finally:
+                loop.call_soon_threadsafe(phrases.put_nowait, None)
+
+        started = time.perf_counter()
+        producer = asyncio.create_task(asyncio.to_thread(consume_stream))
+        first = True
+        while True:
+            if first and self.deadline_s is not None:
+                try:
+                    remaining = started + self.deadline_s - time.perf_counter()
+                    phrase = await asyncio.wait_for(phrases.get(), max(0.0, remaining))
+                except asyncio.TimeoutError:
+                    print(f"Model missed the {self.deadline_s}s deadline")
+                    task = asyncio.create_task(self.finish_stream(producer, parser, key, started))
+                    task.add_done_callback(self.on_compose_done)
+                    return None
+            else:
+                phrase = await phrases.get()
+            if phrase is None:
+                break
+            if not phrase:
+                continue
+            if first:
+                LLM_FIRST_PHRASE_SECONDS.observe(time.perf_counter() - started)
+            # the first phrase replaces the playing sequence, the rest are appended to it
+            self.send(phrase, "/synth" if first else "/synth_append")
+            first = False
+        return await self.finish_stream(producer, parser, key, started)
+
+    async def finish_stream(self, producer, parser, key, started):
+        """Wait for the end of the stream and cache the parsed sequence"""
+        try:
+            await producer
+        except Exception:
+            LLM_ERRORS.inc()
+            raise
+        finally:
+            LLM_SECONDS.labels('stream').observe(time.perf_counter() - started)
+
+        result = parser.result
+        if key is not None and result:
+            self.cache.put(key, result)
+        return result
+
+    def remember(self, result, average_focus):
+        """Remember a played sequence for the next continuation"""
+        # Store this generation for next time
+        self.last_generation = result
+        self.last_focus = average_focus
+
+        # Calculate total duration of the sequence
+        total_duration = result.duration
+        self.last_duration = total_duration
+        self.segment_count += 1
+        print(f"Generated sequence with duration: {total_duration} seconds")
+
+    def send(self, result, address="/synth"):
+        """Send a sequence, or a phrase of one, to Sonic Pi"""
+        # Send OSC message(s)
+        if self.transport is not None:
+            if address == "/synth":
+                self.transport.send_segment(result)
+            else:
+                self.transport.append(result)
+        else:
+            self.resources.osc_client.send_message(address, result.to_osc_payload())
+        OSC_SENDS.labels(address).inc()
+        if len(result) and address == "/synth":  # Only send ambient when a new sequence starts
+            self.resources.osc_client.send_message("/ambient", result.first_note())
+            OSC_SENDS.labels("/ambient").inc()
+
+    def play(self, result, average_focus):
+        """Send a composed sequence to Sonic Pi and remember it for the next continuation"""
+        self.remember(result, average_focus)
+        self.send(result)
 
     async def generate_music(self, average_focus):
         """Asynchronous function to generate music using Gemini"""
@@ -56,64 +338,21 @@ class MusicGenerator:
             try:
                 print("Starting music generation for focus level:", average_focus)
                 self.is_generating = True
-                
-                continuation_prompt = ""
-                if self.last_generation and self.last_focus is not None:
-                    continuation_prompt = f"""
-                        The previous music segment (at focus level {self.last_focus}/100) was:
-
-                        {self.format_music_for_prompt(self.last_generation)}
-
-                        Please create a natural musical continuation that transitions smoothly to the new focus level, maintaining thematic elements where appropriate while adjusting to the new intensity.
-                        """
-                
-                # Create the complete prompt
-                complete_prompt = f"{prompt}\n\nGenerate music that, on a scale of 1 (very very slow and sad) to 100 (extremely fast, happy, and exciting, with lots of notes), has a value of {average_focus}/100. For higher values of focus, use triplets, 16th notes, sextuplets, and 32nd notes, in increasing order. For lower values of focus, use half notes, whole notes, and dotted half notes, in decreasing order. Use a variety of instruments and dynamics to create a piece that is engaging and exciting.{continuation_prompt}"
-
-                # Generate response using Gemini
-                response = await asyncio.to_thread(
-                    lambda: model.generate_content(complete_prompt).text
-                )
-
-                result = []
-                lines = response.split('\n')
-
-                synth_pattern = re.compile(r"synth :(\w+), note: :(\w+), release: ([\d.]+), amp: ([\d.]+)")
-                sleep_pattern = re.compile(r"sleep ([\d.]+)")
-                
-                for line in lines:
-                    line = line.split('#')[0].strip()
-                    
-                    match = synth_pattern.match(line)
-                    if match:
-                        instrument, note, release, amp = match.groups()
-                        result.append(['synth', instrument, note, float(release), float(amp)])
-                        continue
-                    
-                    match = sleep_pattern.match(line)
-                    if match:
-                        duration = float(match.group(1))
-                        result.append(['sleep', '', '', duration, ''])
-
-                # Store this generation for next time
-                self.last_generation = result
-                self.last_focus = average_focus
-
-                # Calculate total duration of the sequence
-                total_duration = sum(item[3] for item in result if item[0] == 'sleep')
-                print(f"Generated sequence with duration: {total_duration} seconds")
-
-                # Flatten the array
-                flattened_data = []
-                for sub_array in result:
-                    flattened_data.append("START")
-                    flattened_data.extend(sub_array)
-
-                # Send OSC message
-                client.send_message("/synth", flattened_data)
-                if result:  # Only send ambient if we have a result
-                    client.send_message("/ambient", result[0][2])
-                
+
+                if self.streaming:
+                    try:
+                        result = await self.stream_compose(average_focus)
+                    except Exception as e:
+                        print(f"Error generating music: {e}")
+                        result = None
+                    if result is None:
+                        self.play(self.compose_local(average_focus), average_focus)
+                    else:
+                        self.remember(result, average_focus)
+                else:
+                    result = await self.compose_with_deadline(average_focus)
+                    self.play(result, average_focus)
+
             except Exception as e:
                 print(f"Error generating music: {e}")
             finally:
@@ -121,52 +360,54 @@ class MusicGenerator:
 
 # EEGCollector class and the rest of the code remains the same
 class EEGCollector:
-    def __init__(self):
+    def __init__(self, user_id=None, resources=None, table='brain_wave_data'):
         self.previous_10_focus = [50]
         self.current_average = 50
         self.lock = asyncio.Lock()
+        # Per-user percentile calibration, warm-started from disk for returning users
+        self.calibrator = FocusCalibrator.load(user_id) if user_id else None
+        self.resources = resources or default_resources
+        self.table = table
+        self.last_key = None  # timestamp or sequence of the last row counted
+
+    def fetch_latest(self):
+        """Latest (avg_alpha, avg_beta, key) row, or None if there is none; key identifies the row"""
+        # Query the latest alpha and beta values from the database
+        sql = f"SELECT avg_alpha, avg_beta, timestamp FROM {self.table} ORDER BY timestamp DESC LIMIT 1"
+
+        with self.resources.conn.cursor() as cursor:
+            cursor.execute(sql)
+            return cursor.fetchone()
 
     async def collect_data(self):
         """Collect and update EEG data continuously"""
         while True:
             async with self.lock:
                 try:
-                    # Query the latest alpha and beta values from the database
-                    sql = "SELECT avg_alpha, avg_beta FROM brain_wave_data ORDER BY timestamp DESC LIMIT 1"
-                    
-                    with conn.cursor() as cursor:
-                        cursor.execute(sql)
-                        result = cursor.fetchone()
-                        
-                        if result:
-                            avg_alpha, avg_beta = result
-                            print(f"Retrieved - Average Alpha: {avg_alpha}, Average Beta: {avg_beta}")
-
-                            # Clip alpha and beta values
-                            clipped_alpha = min(max(avg_alpha, 0), 2)  # Clip alpha to [0, 2]
-                            clipped_beta = min(max(avg_beta, 0), 1)    # Clip beta to [0, 1]
-
-                            # Combine alpha and beta into a focus value (scaled between [0, 3])
-                            combined_focus = clipped_alpha + clipped_beta
-
-                            # Linearly map combined_focus from [0, 3] to [1, 100]
-                            def linear_map(x, in_min, in_max, out_min, out_max):
-                                return out_min + (x - in_min) * (out_max - out_min) / (in_max - in_min)
-
-                            mapped_focus = linear_map(combined_focus, 0, 3, 1, 100)
-                            print("Mapped current focus:", mapped_focus)
-
-                            # Update focus history
-                            self.previous_10_focus.append(mapped_focus)
-                            if len(self.previous_10_focus) > 10:
-                                self.previous_10_focus.pop(0)
-
-                            # Calculate and store the average focus
-                            self.current_average = statistics.mean(self.previous_10_focus)
-                            print("Current average recent focus:", self.current_average)
+                    result = self.fetch_latest()
+
+                    # the table is polled faster than it is written, count each row once
+                    if result and result[2] != self.last_key:
+                        avg_alpha, avg_beta, self.last_key = result
+                        print(f"Retrieved - Average Alpha: {avg_alpha}, Average Beta: {avg_beta}")
+
+                        if self.calibrator:
+                            mapped_focus = self.calibrator.update(avg_alpha, avg_beta)
+                        else:
+                            mapped_focus = fixed_focus(avg_alpha, avg_beta)
+                        print("Mapped current focus:", mapped_focus)
+
+                        # Update focus history
+                        self.previous_10_focus.append(mapped_focus)
+                        if len(self.previous_10_focus) > 10:
+                            self.previous_10_focus.pop(0)
+
+                        # Calculate and store the average focus
+                        self.current_average = statistics.mean(self.previous_10_focus)
+                        print("Current average recent focus:", self.current_average)
 
                 except Exception as e:
-                    print("Error retrieving data from database:", e)
+                    print("Error retrieving EEG data:", e)
 
             await asyncio.sleep(0.2)  # Collection interval
 
@@ -175,32 +416,73 @@ class EEGCollector:
         async with self.lock:
             return self.current_average
 
-async def run_music_generation(music_generator, eeg_collector):
-    """Run continuous music generation based on EEG data"""
-    while True:
-        if not music_generator.is_generating:
-            average_focus = await eeg_collector.get_average()
-            await music_generator.generate_music(average_focus)
-        else:
-            await asyncio.sleep(0.1)  # Small delay to prevent busy waiting
-
-async def main():
+async def run_music_generation(music_generator, eeg_collector, transport=None):
+    """Run continuous music generation based on EEG data, paced by playback"""
+    await PacingScheduler(music_generator, eeg_collector, transport).run()
+
+def create_music_generator(resources, transport=None):
+    """Create a MusicGenerator configured from the environment"""
+    # Set DUET_CACHE_PATH to keep cached compositions between runs
+    # Set DUET_STREAMING=1 to send each phrase to Sonic Pi while the model is still writing
+    cache = CompositionCache(path=os.getenv('DUET_CACHE_PATH'),
+                             encode=NoteSequence.to_prompt_text, decode=NoteSequence.parse)
+    return MusicGenerator(cache=cache,
+                          streaming=os.getenv('DUET_STREAMING') == '1',
+                          transport=transport,
+                          deadline_s=float(os.getenv('DUET_DEADLINE_S', '6')),
+                          context_builder=ContextBuilder(resources.prompt, budget_tokens=int(os.getenv('DUET_CONTEXT_TOKENS', '150'))),
+                          resources=resources)
+
+async def main(resources=None, eeg_collector=None, note_listener=None):
     """Main async function to run both tasks concurrently"""
-    music_generator = MusicGenerator()
-    eeg_collector = EEGCollector()
+    started = time.perf_counter()
+    resources = resources or default_resources
+    # SIGUSR1 or DUET_PROFILE_PORT start and stop a sampling profiler (profiler.py)
+    loop_watch = asyncio.create_task(profiler.watch_event_loop(profiler.install()))
+    transport = OscBundleTransport(resources.osc_client)
+    if note_listener is not None:
+        # e.g. MarkerService.mark_notes, to mark every note onset in the Cortex record
+        transport.listeners.append(note_listener)
+    transport.start()
+    music_generator = create_music_generator(resources, transport)
+    eeg_collector = eeg_collector or EEGCollector(user_id=os.getenv('DUET_USER_ID'), resources=resources)
+    print(f"Music generation set up in {time.perf_counter() - started:.3f}s")
     
+    # Set DUET_SPECULATE=0 to generate one segment at a time, paced by playback.
+    # Speculative candidates are composed whole before their boundary, so streaming
+    # (DUET_STREAMING=1) only applies with the paced scheduler and selects it.
+    speculate = os.getenv('DUET_SPECULATE', '1') != '0'
+    if speculate and music_generator.streaming:
+        print("DUET_STREAMING=1: generating one segment at a time instead of speculatively")
+        speculate = False
+    if speculate:
+        generation = SpeculativeScheduler(music_generator, eeg_collector).run()
+    else:
+        generation = run_music_generation(music_generator, eeg_collector, transport)
+
     try:
         # Run both tasks concurrently
         await asyncio.gather(
             eeg_collector.collect_data(),
-            run_music_generation(music_generator, eeg_collector)
+            generation
         )
     except asyncio.CancelledError:
         print("Tasks cancelled")
     except Exception as e:
         print(f"An error occurred: {e}")
+    finally:
+        if eeg_collector.calibrator:
+            eeg_collector.calibrator.save()
+        music_generator.cache.save()
+        print("Composition cache:", music_generator.cache.stats())
+        print("OSC transport:", transport.stats)
+        print("Startup timings:", resources.startup_timings)
+        transport.close()
+        loop_watch.cancel()
 
 if __name__ == '__main__':
+    # Set DUET_METRICS_PORT to serve model latency and OSC counters (metrics.py)
+    serve_from_env()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -0,0 +1,160 @@
+import re
+from array import array
+
+# Instruments listed in music_generation_prompt.txt, in a fixed order so their index is a stable id
+SYNTHS = ('dull_bell', 'pretty_bell', 'beep', 'sine', 'saw', 'pulse', 'subpulse', 'square', 'tri',
+          'dsaw', 'dpulse', 'dtri', 'fm', 'mod_fm', 'mod_saw', 'mod_dsaw', 'mod_sine', 'mod_beep',
+          'mod_tri', 'mod_pulse', 'tb303', 'supersaw', 'hoover', 'prophet', 'zawa', 'dark_ambience',
+          'growl', 'hollow', 'mono_player', 'stereo_player', 'blade', 'piano', 'pluck', 'sound_in',
+          'noise', 'pnoise', 'bnoise', 'gnoise', 'cnoise', 'basic_mono_player', 'basic_stereo_player',
+          'basic_mixer', 'main_mixer')
+SYNTH_IDS = {name: index for index, name in enumerate(SYNTHS)}
+
+# Sonic Pi note names (C4 = 60) in every spelling the prompt allows, and the canonical name per pitch
+_PITCH_CLASSES = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+NOTE_TO_MIDI = {}
+MIDI_TO_NOTE = {}
+for _octave in range(-1, 10):
+    for _letter, _pitch_class in _PITCH_CLASSES.items():
+        for _accidental, _shift in (('', 0), ('s', 1), ('b', -1)):
+            _midi = (_octave + 1) * 12 + _pitch_class + _shift
+            if 0 <= _midi <= 127:
+                NOTE_TO_MIDI[f"{_letter}{_accidental}{_octave}"] = _midi
+_SHARP_NAMES = ('C', 'Cs', 'D', 'Ds', 'E', 'F', 'Fs', 'G', 'Gs', 'A', 'As', 'B')
+for _midi in range(128):
+    MIDI_TO_NOTE[_midi] = f"{_SHARP_NAMES[_midi % 12]}{_midi // 12 - 1}"
+
+# One pattern for both line kinds, matched across the whole response in a single pass
+_LINE_PATTERN = re.compile(
+    r"^[ \t]*(?:synth :(\w+), note: :(\w+), release: ([\d.]+), amp: ([\d.]+)|sleep ([\d.]+))",
+    re.MULTILINE)
+
+
+class NoteSequence:
+    """
+    A composition as parallel typed arrays of note events.
+
+    Sleeps are folded into onset times, so the duration of a sequence is a field
+    rather than a sum, and both encoders walk the arrays once.
+
+    Attributes
+    ----------
+    instruments : array('B')
+        index of each event's synth in SYNTHS
+    pitches : array('B')
+        MIDI pitch of each event
+    releases : array('f')
+        release time of each event in seconds
+    amps : array('f')
+        amplitude of each event
+    onsets : array('d')
+        start time of each event in seconds from the start of the sequence
+    duration : float
+        total duration, the sum of all sleeps
+    rejected : int
+        number of lines dropped because of an unknown instrument or note
+    """
+    __slots__ = ('instruments', 'pitches', 'releases', 'amps', 'onsets', 'duration', 'rejected')
+
+    def __init__(self):
+        self.instruments = array('B')
+        self.pitches = array('B')
+        self.releases = array('f')
+        self.amps = array('f')
+        self.onsets = array('d')
+        self.duration = 0.0
+        self.rejected = 0
+
+    @classmethod
+    def parse(cls, text):
+        """Parse model output into a validated sequence"""
+        sequence = cls()
+        sequence.extend(text)
+        return sequence
+
+    def extend(self, text):
+        """Parse more synth/sleep lines, continuing from the end of the sequence"""
+        synth_ids = SYNTH_IDS
+        note_to_midi = NOTE_TO_MIDI
+        onset = self.duration
+        for match in _LINE_PATTERN.finditer(text):
+            instrument, note, release, amp, sleep = match.groups()
+            try:
+                if sleep is not None:
+                    onset += float(sleep)
+                    continue
+                synth_id = synth_ids[instrument]
+                pitch = note_to_midi[note]
+                release = float(release)
+                amp = float(amp)
+            except (KeyError, ValueError):
+                self.rejected += 1
+                continue
+            self.instruments.append(synth_id)
+            self.pitches.append(pitch)
+            self.releases.append(release)
+            self.amps.append(amp)
+            self.onsets.append(onset)
+        self.duration = onset
+
+    def __len__(self):
+        return len(self.onsets)
+
+    def __bool__(self):
+        return len(self.onsets) > 0 or self.duration > 0
+
+    def instrument_name(self, i):
+        return SYNTHS[self.instruments[i]]
+
+    def note_name(self, i):
+        return MIDI_TO_NOTE[self.pitches[i]]
+
+    def first_note(self):
+        return MIDI_TO_NOTE[self.pitches[0]] if self.pitches else ''
+
+    def slice(self, start, end):
+        """Return the events with start <= onset < end, shifted to start at zero"""
+        sequence = NoteSequence()
+        for i, onset in enumerate(self.onsets):
+            if start <= onset < end:
+                sequence.instruments.append(self.instruments[i])
+                sequence.pitches.append(self.pitches[i])
+                sequence.releases.append(self.releases[i])
+                sequence.amps.append(self.amps[i])
+                sequence.onsets.append(onset - start)
+        sequence.duration = min(end, self.duration) - start
+        return sequence
+
+    def _lines(self):
+        """Yield ('synth', index) and ('sleep', seconds) steps in playing order"""
+        position = 0.0
+        for i, onset in enumerate(self.onsets):
+            if onset > position:
+                yield 'sleep', round(onset - position, 6)
+                position = onset
+            yield 'synth', i
+        if self.duration > position:
+            yield 'sleep', round(self.duration - position, 6)
+
+    def to_osc_payload(self):
+        """Encode as the flat START-separated list reconstructed by sonic_pi_script.rb"""
+        payload = []
+        for kind, value in self._lines():
+            if kind == 'synth':
+                payload.extend(("START", 'synth', SYNTHS[self.instruments[value]],
+                                MIDI_TO_NOTE[self.pitches[value]],
+                                round(self.releases[value], 4), round(self.amps[value], 4)))
+            else:
+                payload.extend(("START", 'sleep', '', '', value, ''))
+        return payload
+
+    def to_prompt_text(self):
+        """Encode as synth/sleep lines in the format the model writes"""
+        lines = []
+        for kind, value in self._lines():
+            if kind == 'synth':
+                lines.append(f"synth :{SYNTHS[self.instruments[value]]}, note: :{MIDI_TO_NOTE[self.pitches[value]]}, "
+                             f"release: {round(self.releases[value], 4)}, amp: {round(self.amps[value], 4)}")
+            else:
+                lines.append(f"sleep {value}")
+        return "\n".join(lines)
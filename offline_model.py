@@ -0,0 +1,90 @@
+import math
+import random
+import re
+import time
+
+from music_generation import ProceduralComposer
+
+focus_pattern = re.compile(r"has a value of ([\d.]+)/100")
+
+
+class OfflineResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class OfflineModel:
+    """
+    A local stand-in for the Gemini model with configurable latency and failures.
+
+    It has the ``generate_content(prompt, stream=False)`` interface MusicGenerator uses.
+    Responses are either taken from ``canned`` texts in turn or synthesized by the
+    procedural composer for the focus level found in the prompt.
+
+    Attributes
+    ----------
+    latency : string
+        'constant', 'uniform' or 'lognormal'
+    latency_s : float
+        mean latency in seconds (the constant value, or the mean of the distribution)
+    latency_spread : float
+        half width for 'uniform', sigma of the underlying normal for 'lognormal'
+    failure_rate : float
+        probability that a call raises instead of answering
+    """
+    def __init__(self, latency='lognormal', latency_s=3.0, latency_spread=0.5, failure_rate=0.0,
+                 canned=None, stream_chunk_chars=80, seed=None):
+        if latency not in ('constant', 'uniform', 'lognormal'):
+            raise ValueError('Unknown latency distribution ' + latency)
+        self.latency = latency
+        self.latency_s = latency_s
+        self.latency_spread = latency_spread
+        self.failure_rate = failure_rate
+        self.canned = list(canned or [])
+        self.stream_chunk_chars = stream_chunk_chars
+        self.rng = random.Random(seed)
+        self.composer = ProceduralComposer()
+        self.calls = 0
+        self.failures = 0
+
+    def sample_latency(self):
+        if self.latency == 'constant':
+            return self.latency_s
+        if self.latency == 'uniform':
+            return max(0.0, self.rng.uniform(self.latency_s - self.latency_spread, self.latency_s + self.latency_spread))
+        # lognormal with the requested mean
+        sigma = self.latency_spread
+        mu = math.log(self.latency_s) - sigma ** 2 / 2
+        return self.rng.lognormvariate(mu, sigma)
+
+    def respond(self, prompt):
+        if self.canned:
+            return self.canned[self.calls % len(self.canned)]
+        match = focus_pattern.search(prompt)
+        focus = float(match.group(1)) if match else 50
+        return self.composer.compose(focus + self.rng.random()).to_prompt_text()
+
+    def generate_content(self, prompt, stream=False):
+        self.calls += 1
+        latency = self.sample_latency()
+        fails = self.rng.random() < self.failure_rate
+        text = self.respond(prompt)
+
+        if not stream:
+            time.sleep(latency)
+            if fails:
+                self.failures += 1
+                raise RuntimeError('offline model failure')
+            return OfflineResponse(text)
+        return self._stream(text, latency, fails)
+
+    def _stream(self, text, latency, fails):
+        # half of the latency before the first chunk, the rest spread over the chunks
+        chunks = [text[i:i + self.stream_chunk_chars] for i in range(0, len(text), self.stream_chunk_chars)]
+        time.sleep(latency / 2)
+        for index, chunk in enumerate(chunks):
+            if fails and index == len(chunks) // 2:
+                self.failures += 1
+                raise RuntimeError('offline model failure')
+            time.sleep(latency / 2 / max(len(chunks), 1))
+            yield OfflineResponse(chunk)
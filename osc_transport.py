@@ -0,0 +1,190 @@
+import threading
+import time
+
+from pythonosc import osc_bundle_builder, osc_message_builder
+from pythonosc.dispatcher import Dispatcher
+from pythonosc.osc_server import ThreadingOSCUDPServer
+
+# Fixed size of an OSC bundle header ("#bundle\0" + timetag) and of each element's size prefix
+BUNDLE_HEADER_SIZE = 16
+ELEMENT_SIZE_PREFIX = 4
+
+
+class OscBundleTransport():
+    """
+    Send note sequences to Sonic Pi as size-bounded, timetagged OSC bundles.
+
+    Every event becomes one compact ``/duet/note`` message carrying its absolute
+    play time, so Sonic Pi schedules notes at their exact onsets instead of
+    walking a list of sleeps. Events are packed into bundles below ``max_datagram``
+    bytes; each bundle starts with a ``/duet/chunk`` header that Sonic Pi
+    acknowledges on ``/duet/ack`` when it handles the bundle at its timetag. Bundles
+    not acknowledged ``resend_after_s`` after their timetag are resent.
+
+    Message formats
+    ---------------
+    /duet/chunk segment_id chunk_index segment_start segment_end
+    /duet/note  segment_id event_index play_time synth note release amp
+    /duet/ack   segment_id chunk_index     (Sonic Pi -> Python)
+    /duet/heartbeat segment_id position remaining     (Sonic Pi -> Python)
+
+    Attributes
+    ----------
+    client : SimpleUDPClient
+        OSC client connected to Sonic Pi
+    ack_port : int
+        local UDP port where acknowledgments are received. None disables resending
+    max_datagram : int
+        upper bound on the size of one bundle in bytes
+    lead_s : float
+        how far ahead of now a new segment is scheduled when nothing is playing
+    listeners : list
+        callables ``listener(segment_id, start, sequence)`` called for every sequence sent,
+        with the absolute time its first onset is counted from, e.g. MarkerService.mark_notes
+    """
+    def __init__(self, client, ack_ip="127.0.0.1", ack_port=4561, max_datagram=1400, lead_s=0.2,
+                 resend_after_s=0.2, max_retries=3):
+        self.client = client
+        self.ack_ip = ack_ip
+        self.ack_port = ack_port
+        self.max_datagram = max_datagram
+        self.lead_s = lead_s
+        self.resend_after_s = resend_after_s
+        self.max_retries = max_retries
+
+        self.segment_id = int(time.time())  # increasing across restarts, so Sonic Pi accepts the first segment
+        self.segment_start = 0.0
+        self.segment_end = 0.0
+        self.event_index = 0
+        self.chunk_index = 0
+
+        self.pending = {}  # (segment_id, chunk_index) -> [bundle, ack_expected_from, retries]
+        self.pending_lock = threading.Lock()
+        self.stats = {'bundles': 0, 'acked': 0, 'resent': 0, 'dropped': 0}
+        self.server = None
+        self.heartbeat = None  # (received_at, segment_id, remaining_s) of the last playback report
+        self.listeners = []
+
+    def start(self):
+        """Start listening for acknowledgments and heartbeats, and resending lost bundles"""
+        if self.ack_port is None:
+            return
+        dispatcher = Dispatcher()
+        dispatcher.map("/duet/ack", self.on_ack)
+        dispatcher.map("/duet/heartbeat", self.on_heartbeat)
+        self.server = ThreadingOSCUDPServer((self.ack_ip, self.ack_port), dispatcher)
+        threading.Thread(target=self.server.serve_forever, name="OscAckThread", daemon=True).start()
+        threading.Thread(target=self.resend_loop, name="OscResendThread", daemon=True).start()
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server = None
+
+    def send_segment(self, sequence):
+        """Send a new segment, starting when the current one ends (or right away if none is playing)"""
+        self.segment_id += 1
+        self.event_index = 0
+        self.chunk_index = 0
+        self.segment_start = max(time.time() + self.lead_s, self.segment_end)
+        self.segment_end = self.segment_start + sequence.duration
+        self._send_events(sequence, self.segment_start)
+        return self.segment_id
+
+    def append(self, sequence):
+        """Append a continuation to the current segment"""
+        start = self.segment_end
+        self.segment_end += sequence.duration
+        self._send_events(sequence, start)
+
+    def _send_events(self, sequence, start):
+        notes = []
+        for i in range(len(sequence)):
+            message = osc_message_builder.OscMessageBuilder(address="/duet/note")
+            message.add_arg(self.segment_id)
+            message.add_arg(self.event_index)
+            message.add_arg(start + sequence.onsets[i], 'd')
+            message.add_arg(sequence.instrument_name(i))
+            message.add_arg(sequence.note_name(i))
+            message.add_arg(round(sequence.releases[i], 4))
+            message.add_arg(round(sequence.amps[i], 4))
+            notes.append((start + sequence.onsets[i], message.build()))
+            self.event_index += 1
+
+        # the header has a fixed size, so it can be accounted for before it is built
+        header_size = len(self._chunk_header().dgram)
+        budget = self.max_datagram - BUNDLE_HEADER_SIZE - ELEMENT_SIZE_PREFIX - header_size
+
+        chunk = []
+        used = 0
+        for play_time, message in notes:
+            size = ELEMENT_SIZE_PREFIX + len(message.dgram)
+            if chunk and used + size > budget:
+                self._send_chunk(chunk)
+                chunk = []
+                used = 0
+            chunk.append((play_time, message))
+            used += size
+        if chunk or not notes:
+            self._send_chunk(chunk)
+
+        for listener in self.listeners:
+            listener(self.segment_id, start, sequence)
+
+    def _chunk_header(self):
+        header = osc_message_builder.OscMessageBuilder(address="/duet/chunk")
+        header.add_arg(self.segment_id)
+        header.add_arg(self.chunk_index)
+        header.add_arg(self.segment_start, 'd')
+        header.add_arg(self.segment_end, 'd')
+        return header.build()
+
+    def _send_chunk(self, chunk):
+        # timetag the bundle with the moment its first note must sound, minus the lead
+        first_time = chunk[0][0] if chunk else self.segment_start
+        timetag = max(first_time - self.lead_s, time.time())
+        builder = osc_bundle_builder.OscBundleBuilder(timetag)
+        builder.add_content(self._chunk_header())
+        for _, message in chunk:
+            builder.add_content(message)
+        bundle = builder.build()
+
+        if self.ack_port is not None:
+            with self.pending_lock:
+                # Sonic Pi only handles, and acknowledges, the bundle at its timetag
+                self.pending[(self.segment_id, self.chunk_index)] = [bundle, timetag, 0]
+        self.client.send(bundle)
+        self.stats['bundles'] += 1
+        self.chunk_index += 1
+
+    def on_ack(self, address, *args):
+        if len(args) < 2:
+            return
+        with self.pending_lock:
+            if self.pending.pop((int(args[0]), int(args[1])), None) is not None:
+                self.stats['acked'] += 1
+
+    def on_heartbeat(self, address, *args):
+        if len(args) < 3:
+            return
+        self.heartbeat = (time.time(), int(args[0]), float(args[2]))
+
+    def resend_loop(self):
+        while self.server is not None:
+            time.sleep(self.resend_after_s / 2)
+            # wall clock, like the timetags the first wait is counted from
+            now = time.time()
+            with self.pending_lock:
+                for key, entry in list(self.pending.items()):
+                    bundle, expected_from, retries = entry
+                    if now - expected_from < self.resend_after_s:
+                        continue
+                    if retries >= self.max_retries:
+                        del self.pending[key]
+                        self.stats['dropped'] += 1
+                        print('OSC bundle {0} chunk {1} dropped after {2} retries'.format(key[0], key[1], retries))
+                        continue
+                    self.client.send(bundle)
+                    entry[1] = now
+                    entry[2] += 1
+                    self.stats['resent'] += 1
@@ -0,0 +1,95 @@
+import asyncio
+import time
+from collections import deque
+
+
+class LatencyTracker:
+    """Rolling window of generation latencies with percentile estimates"""
+    def __init__(self, window=50, default_s=5.0):
+        self.samples = deque(maxlen=window)
+        self.default_s = default_s
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, p):
+        if not self.samples:
+            return self.default_s
+        ordered = sorted(self.samples)
+        index = min(int(p * len(ordered)), len(ordered) - 1)
+        return ordered[index]
+
+
+class PlaybackTracker:
+    """
+    Estimate how much queued music is left to play.
+
+    The estimate starts from send time plus ``total_duration`` of each segment and is
+    corrected by the ``/duet/heartbeat`` messages Sonic Pi sends back through the
+    transport, which report the real remaining time of the segment being played.
+    """
+    def __init__(self, transport=None, heartbeat_timeout_s=1.0):
+        self.transport = transport
+        self.heartbeat_timeout_s = heartbeat_timeout_s
+        self.buffer_end = 0.0
+
+    def on_segment(self, duration):
+        # segments are queued back to back, starting now if nothing is playing
+        self.buffer_end = max(time.time(), self.buffer_end) + duration
+
+    def remaining(self):
+        """Seconds of music left before playback runs out"""
+        now = time.time()
+        end = self.buffer_end
+        heartbeat = self.transport.heartbeat if self.transport is not None else None
+        if heartbeat is not None:
+            received_at, segment_id, remaining = heartbeat
+            if now - received_at < self.heartbeat_timeout_s and segment_id == self.transport.segment_id:
+                end = received_at + remaining
+                self.buffer_end = end
+        return end - now
+
+
+class PacingScheduler:
+    """
+    Start each generation just in time for the next segment boundary.
+
+    A new generation starts when the music left to play drops below a high
+    percentile of the measured generation latency plus a safety margin, so
+    segments are neither generated and never heard nor left looping stale.
+    """
+    def __init__(self, music_generator, eeg_collector, transport=None, latency_percentile=0.9,
+                 margin_s=0.5, poll_interval_s=0.1):
+        self.music_generator = music_generator
+        self.eeg_collector = eeg_collector
+        self.latency = LatencyTracker()
+        self.playback = PlaybackTracker(transport)
+        self.latency_percentile = latency_percentile
+        self.margin_s = margin_s
+        self.poll_interval_s = poll_interval_s
+
+    def lead_time(self):
+        return self.latency.percentile(self.latency_percentile) + self.margin_s
+
+    async def run(self):
+        """Run continuous paced generation based on EEG data"""
+        generator = self.music_generator
+        while True:
+            remaining = self.playback.remaining()
+            lead = self.lead_time()
+            if generator.last_generation is not None and remaining > lead:
+                await asyncio.sleep(min(remaining - lead, self.poll_interval_s))
+                continue
+
+            average_focus = await self.eeg_collector.get_average()
+            segments_before = generator.segment_count
+            started = time.monotonic()
+            await generator.generate_music(average_focus)
+            if generator.segment_count == segments_before:
+                # the generation failed, back off briefly before retrying
+                await asyncio.sleep(self.poll_interval_s)
+                continue
+
+            self.latency.record(time.monotonic() - started)
+            self.playback.on_segment(generator.last_duration)
+            print(f"Paced generation: {remaining:.2f}s left at start, p{int(self.latency_percentile * 100)} latency {self.latency.percentile(self.latency_percentile):.2f}s")
@@ -0,0 +1,476 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from artifact_gate import ArtifactGate, weighted_band_averages
+from band_power import LiveBandPower
+from focus_calibration import FocusCalibrator, fixed_focus
+from live_advance_pow import band_averages
+
+# Items flowing through the graph are dicts in the format of the Cortex new_*_data
+# events plus a 'stream' key, e.g. {'stream': 'pow', 'pow': [...], 'time': ...}.
+# Column labels travel as {'stream': 'pow', 'labels': [...]} ahead of the data.
+
+
+class Stage:
+    """
+    A node of the pipeline graph.
+
+    Items pushed into a stage are processed either inline on the pushing thread, one
+    at a time, or with ``threaded`` on the stage's own worker thread behind a bounded
+    queue that drops items when full, in batches of up to ``batch_size`` items (or
+    whatever arrived within ``flush_s``). Batching needs the worker thread, since
+    only it can flush a partial batch when no further item arrives. Subclasses
+    implement ``process(items)`` and return the items to pass downstream.
+
+    Attributes
+    ----------
+    name : string
+        stage name, used by other stages' inputs and in reports
+    outputs : list
+        downstream stages
+    stats : dict
+        items received, emitted and dropped, batches, busy time and latency
+    """
+    def __init__(self, name, threaded=False, batch_size=1, flush_s=0.5, max_queue=10000, **options):
+        if batch_size > 1 and not threaded:
+            raise ValueError('Stage {0} needs "threaded": true to batch items'.format(name))
+        self.name = name
+        self.threaded = threaded
+        self.batch_size = batch_size
+        self.flush_s = flush_s
+        self.options = options
+        self.outputs = []
+        self.queue = queue.Queue(max_queue) if threaded else None
+        self.worker = None
+        self.running = False
+        self.stats = {'received': 0, 'emitted': 0, 'dropped': 0, 'batches': 0, 'busy_s': 0.0,
+                      'latency_sum_s': 0.0, 'max_latency_s': 0.0}
+
+    def start(self):
+        self.running = True
+        if self.threaded:
+            self.worker = threading.Thread(target=self.run_worker, name=self.name, daemon=True)
+            self.worker.start()
+
+    def stop(self):
+        self.running = False
+        if self.worker is not None:
+            self.worker.join(5)
+        self.close()
+
+    def close(self):
+        pass
+
+    def push(self, item):
+        self.stats['received'] += 1
+        arrived = time.monotonic()
+        if self.threaded:
+            try:
+                self.queue.put_nowait((arrived, item))
+            except queue.Full:
+                self.stats['dropped'] += 1
+            return
+        self.handle([(arrived, item)])
+
+    def run_worker(self):
+        batch = []
+        while self.running or not self.queue.empty():
+            timeout = self.flush_s if not batch else max(0.0, self.flush_s - (time.monotonic() - batch[0][0]))
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                pass
+            if batch and (len(batch) >= self.batch_size or time.monotonic() - batch[0][0] >= self.flush_s
+                          or not self.running):
+                self.handle(batch)
+                batch = []
+
+    def handle(self, batch):
+        started = time.monotonic()
+        try:
+            results = self.process([item for _, item in batch])
+        except Exception as e:
+            print('Stage {0} failed on a batch of {1}: {2}'.format(self.name, len(batch), e))
+            results = []
+        finished = time.monotonic()
+        self.stats['batches'] += 1
+        self.stats['busy_s'] += finished - started
+        latency = finished - batch[0][0]
+        self.stats['latency_sum_s'] += latency
+        self.stats['max_latency_s'] = max(self.stats['max_latency_s'], latency)
+        self.emit(results)
+
+    def emit(self, items):
+        for item in items or ():
+            self.stats['emitted'] += 1
+            for output in self.outputs:
+                output.push(item)
+
+    def process(self, items):
+        return items
+
+    def report(self, elapsed_s):
+        stats = self.stats
+        batches = stats['batches'] or 1
+        return ('{0}: {1} in ({2:.1f}/s), {3} out, {4} dropped, {5} batches, '
+                'busy {6:.1%}, latency avg {7:.1f} ms max {8:.1f} ms').format(
+            self.name, stats['received'], stats['received'] / elapsed_s, stats['emitted'], stats['dropped'],
+            stats['batches'], stats['busy_s'] / elapsed_s, 1000 * stats['latency_sum_s'] / batches,
+            1000 * stats['max_latency_s'])
+
+
+# sources
+
+class CortexSource(Stage):
+    """One stream of the pipeline's shared Cortex session"""
+    def __init__(self, name, stream, **kwargs):
+        super().__init__(name, **kwargs)
+        self.stream = stream
+
+    def attach(self, cortex):
+        cortex.bind(**{'new_{0}_data'.format(self.stream): self.on_new_data})
+
+    def on_new_data(self, *args, **kwargs):
+        item = dict(kwargs.get('data'))
+        item['stream'] = self.stream
+        self.push(item)
+
+    def on_labels(self, labels):
+        self.push({'stream': self.stream, 'labels': labels})
+
+
+class ReplaySource(Stage):
+    """
+    Replay a spool file written by a SpoolSink, keeping the original timing.
+
+    Options: path, streams (default all), speed (default 1.0, 0 for as fast as possible)
+    """
+    def start(self):
+        super().start()
+        self.reader = threading.Thread(target=self.replay, name=self.name + '-replay', daemon=True)
+        self.reader.start()
+
+    def replay(self):
+        streams = self.options.get('streams')
+        speed = self.options.get('speed', 1.0)
+        first = None
+        started = time.monotonic()
+        with open(self.options['path'], 'r') as file:
+            for line in file:
+                if not self.running:
+                    break
+                item = json.loads(line)
+                if streams and item['stream'] not in streams:
+                    continue
+                if speed and 'time' in item:
+                    first = item['time'] if first is None else first
+                    delay = (item['time'] - first) / speed - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+                self.push(item)
+        print('Replay of {0} finished'.format(self.options['path']))
+
+
+# transforms
+
+class BandPowerStage(Stage):
+    """eeg items in, pow items computed locally out (band_power.py). Options are LiveBandPower options."""
+    def __init__(self, name, **kwargs):
+        super().__init__(name, **kwargs)
+        self.results = []
+        self.dsp = LiveBandPower(None, self.results.append, **self.options)
+
+    def process(self, items):
+        for item in items:
+            if item['stream'] != 'eeg':
+                continue
+            if 'labels' in item:
+                self.dsp.on_new_data_labels(data={'streamName': 'eeg', 'labels': item['labels']})
+                self.results.append({'stream': 'pow', 'labels': self.dsp.pow_labels()})
+            else:
+                self.dsp.on_new_eeg_data(data=item)
+        results, self.results[:] = list(self.results), []
+        for result in results:
+            result['stream'] = 'pow'
+        return results
+
+
+class ArtifactGateStage(Stage):
+    """pow, mot and dev items in, gated averages items out (artifact_gate.py). Options are ArtifactGate options."""
+    def __init__(self, name, **kwargs):
+        super().__init__(name, **kwargs)
+        self.gate = ArtifactGate(**self.options)
+
+    def process(self, items):
+        results = []
+        for item in items:
+            stream = item['stream']
+            if 'labels' in item:
+                self.gate.on_new_data_labels(data={'streamName': stream, 'labels': item['labels']})
+            elif stream == 'mot':
+                self.gate.on_new_mot_data(data=item)
+            elif stream == 'dev':
+                self.gate.on_new_dev_data(data=item)
+            elif stream == 'pow':
+                weights = self.gate.weights(item['time'], self.gate.pow_channels)
+                averages = weighted_band_averages(item['pow'], weights)
+                if averages is not None:
+                    results.append({'stream': 'averages', 'avg_alpha': averages[0], 'avg_beta': averages[1],
+                                    'time': item['time']})
+        return results
+
+
+class FocusStage(Stage):
+    """
+    pow or averages items in, focus items out.
+
+    Options: user_id for per-user calibration (focus_calibration.py), otherwise the fixed mapping
+    """
+    def __init__(self, name, **kwargs):
+        super().__init__(name, **kwargs)
+        user_id = self.options.get('user_id')
+        self.calibrator = FocusCalibrator.load(user_id) if user_id else None
+
+    def process(self, items):
+        results = []
+        for item in items:
+            if item['stream'] == 'pow' and 'pow' in item:
+                avg_alpha, avg_beta = band_averages(item['pow'])
+            elif item['stream'] == 'averages':
+                avg_alpha, avg_beta = item['avg_alpha'], item['avg_beta']
+            else:
+                continue
+            if self.calibrator:
+                focus = self.calibrator.update(avg_alpha, avg_beta)
+            else:
+                focus = fixed_focus(avg_alpha, avg_beta)
+            results.append({'stream': 'focus', 'focus': focus, 'avg_alpha': avg_alpha, 'avg_beta': avg_beta,
+                            'time': item['time']})
+        return results
+
+    def close(self):
+        if self.calibrator:
+            self.calibrator.save()
+
+
+# sinks
+
+class SingleStoreSink(Stage):
+    """
+    averages or focus items in, one INSERT per batch into SingleStore.
+
+    Options: table (default brain_wave_data)
+    """
+    def __init__(self, name, **kwargs):
+        super().__init__(name, **kwargs)
+        self.conn = None
+
+    def process(self, items):
+        rows = [(item['avg_alpha'], item['avg_beta']) for item in items if 'avg_alpha' in item]
+        if not rows:
+            return []
+        if self.conn is None:
+            from resources import connect_singlestore
+            self.conn = connect_singlestore()
+        sql = "INSERT INTO {0} (avg_alpha, avg_beta) VALUES (%s, %s)".format(self.options.get('table', 'brain_wave_data'))
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.executemany(sql, rows)
+                self.conn.commit()
+        except Exception as e:
+            print("Error uploading data to SingleStore: {}".format(e))
+        return []
+
+
+class SpoolSink(Stage):
+    """Append items as JSON lines, readable by ReplaySource. Options: path"""
+    def __init__(self, name, **kwargs):
+        super().__init__(name, **kwargs)
+        self.file = open(self.options['path'], 'a', buffering=1 << 16)
+
+    def process(self, items):
+        self.file.write(''.join(json.dumps(item) + '\n' for item in items))
+        return []
+
+    def close(self):
+        self.file.close()
+
+
+class OscSink(Stage):
+    """
+    Send one field of each item over OSC.
+
+    Options: ip (default 127.0.0.1), port (default 4560), address (default /focus), field (default focus)
+    """
+    def __init__(self, name, **kwargs):
+        super().__init__(name, **kwargs)
+        from pythonosc import udp_client
+        self.client = udp_client.SimpleUDPClient(self.options.get('ip', '127.0.0.1'), self.options.get('port', 4560))
+        self.address = self.options.get('address', '/focus')
+        self.field = self.options.get('field', 'focus')
+
+    def process(self, items):
+        for item in items:
+            if self.field in item:
+                self.client.send_message(self.address, item[self.field])
+        return []
+
+
+class StdoutSink(Stage):
+    """Print each item"""
+    def process(self, items):
+        print('\n'.join('{0} data: {1}'.format(item['stream'], item) for item in items))
+        return []
+
+
+STAGE_TYPES = {
+    'cortex': CortexSource,
+    'replay': ReplaySource,
+    'band_power': BandPowerStage,
+    'artifact_gate': ArtifactGateStage,
+    'focus': FocusStage,
+    'singlestore': SingleStoreSink,
+    'spool': SpoolSink,
+    'osc': OscSink,
+    'stdout': StdoutSink,
+}
+
+
+class Pipeline:
+    """
+    A graph of stages built from a config, fed by one Cortex session.
+
+    Each stage config has a unique ``name``, a ``type`` from STAGE_TYPES, the names of
+    the stages it reads from in ``input`` (a name or a list), the stage options
+    ``threaded``, ``batch_size``, ``flush_s`` and ``max_queue``, and options of its type.
+    All 'cortex' sources share one session, which subscribes to all of their streams.
+    """
+    def __init__(self, config, app_client_id=None, app_client_secret=None):
+        self.config = config
+        self.stages = {}
+        for stage_config in config['stages']:
+            options = dict(stage_config)
+            name = options.pop('name')
+            stage_type = options.pop('type')
+            options.pop('input', None)
+            if name in self.stages:
+                raise ValueError('Duplicate stage name ' + name)
+            if stage_type not in STAGE_TYPES:
+                raise ValueError('Unknown stage type {0} for stage {1}'.format(stage_type, name))
+            self.stages[name] = STAGE_TYPES[stage_type](name, **options)
+
+        for stage_config in config['stages']:
+            inputs = stage_config.get('input', [])
+            for input_name in [inputs] if isinstance(inputs, str) else inputs:
+                if input_name not in self.stages:
+                    raise ValueError('Unknown input {0} of stage {1}'.format(input_name, stage_config['name']))
+                self.stages[input_name].outputs.append(self.stages[stage_config['name']])
+
+        self.sources = [stage for stage in self.stages.values() if isinstance(stage, CortexSource)]
+        self.cortex = None
+        if self.sources:
+            from cortex import Cortex
+            self.cortex = Cortex(app_client_id, app_client_secret, debug_mode=config.get('debug', False))
+            self.cortex.bind(create_session_done=self.on_create_session_done)
+            self.cortex.bind(new_data_labels=self.on_new_data_labels)
+            for source in self.sources:
+                source.attach(self.cortex)
+        self.started = None
+
+    def on_create_session_done(self, *args, **kwargs):
+        print('Session created')
+        self.cortex.sub_request(sorted({source.stream for source in self.sources}))
+
+    def on_new_data_labels(self, *args, **kwargs):
+        data = kwargs.get('data')
+        for source in self.sources:
+            if source.stream == data['streamName']:
+                source.on_labels(data['labels'])
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        for stage in self.stages.values():
+            print(stage.report(elapsed))
+
+    def report_loop(self, interval_s):
+        while True:
+            time.sleep(interval_s)
+            if self.started is None:
+                return
+            self.report()
+
+    def run(self, headset_id=''):
+        """Start every stage, then the Cortex session, which blocks until it closes"""
+        self.started = time.monotonic()
+        # start sinks first so nothing is pushed into a stopped stage
+        for stage in reversed(list(self.stages.values())):
+            stage.start()
+        interval = self.config.get('report_interval_s', 10)
+        threading.Thread(target=self.report_loop, args=(interval,), name='pipeline-report', daemon=True).start()
+        try:
+            if self.cortex is not None:
+                if headset_id:
+                    self.cortex.set_wanted_headset(headset_id)
+                self.cortex.open()
+            else:
+                replays = [stage for stage in self.stages.values() if isinstance(stage, ReplaySource)]
+                while any(stage.reader.is_alive() for stage in replays):
+                    time.sleep(0.5)
+        finally:
+            self.stop()
+
+    def stop(self):
+        # stop in graph order so each stage flushes into running downstream stages
+        for stage in self.stages.values():
+            stage.stop()
+        self.report()
+        self.started = None
+
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Set EMOTIV_CLIENT_ID and EMOTIV_CLIENT_SECRET as for live_advance_pow.py when the
+#     config has 'cortex' sources.
+#   - Stages are listed sources first, each after the stages it reads from. For example
+#     this config computes focus from the pow stream and writes it to SingleStore in
+#     batches, sends it to Sonic Pi and spools the raw pow stream for later replay:
+#     {
+#       "stages": [
+#         {"name": "pow", "type": "cortex", "stream": "pow"},
+#         {"name": "focus", "type": "focus", "input": "pow", "user_id": "alice"},
+#         {"name": "db", "type": "singlestore", "input": "focus", "threaded": true, "batch_size": 16},
+#         {"name": "osc", "type": "osc", "input": "focus", "address": "/focus"},
+#         {"name": "spool", "type": "spool", "input": "pow", "path": "session.jsonl",
+#          "threaded": true, "batch_size": 256, "flush_s": 1.0}
+#       ]
+#     }
+#   - Replace the cortex source with {"name": "pow", "type": "replay", "path": "session.jsonl"}
+#     to run the same graph on a recorded session.
+#
+# -----------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a pipeline of Cortex sources, transforms and sinks')
+    parser.add_argument('config', help='JSON pipeline configuration')
+    parser.add_argument('--headset', default='', help='id of the wanted headset')
+    args = parser.parse_args()
+    load_dotenv()
+
+    with open(args.config, 'r') as file:
+        config = json.load(file)
+
+    pipeline = Pipeline(config, os.getenv('EMOTIV_CLIENT_ID'), os.getenv('EMOTIV_CLIENT_SECRET'))
+    try:
+        pipeline.run(args.headset)
+    except KeyboardInterrupt:
+        print("Program stopped by user")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+import asyncio
+import atexit
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+from collections import Counter as Tally
+
+from metrics import Histogram
+
+EMIT_SECONDS = Histogram('cortex_handler_seconds', 'Time spent in the handlers of one Cortex event, while profiling',
+                         ['event'])
+LOOP_LAG_SECONDS = Histogram('duet_event_loop_lag_seconds', 'How late the event loop woke up a sleeping task')
+
+
+class SamplingProfiler():
+    """
+    Sample the stacks of all threads and write them as collapsed stacks.
+
+    While running, a daemon thread reads ``sys._current_frames()`` every ``interval_s``
+    and counts each thread's stack, so the websocket thread, the event loop and the
+    worker threads all show up without being instrumented. ``stop`` writes one line per
+    distinct stack, root first, as expected by flamegraph.pl, speedscope and similar
+    tools:
+
+        MainThread;<module> (sub_data.py:1);main (sub_data.py:248);open (cortex.py:161);... 12
+
+    Alongside it, a ``.txt`` summary lists the time spent in Cortex.emit handlers per
+    event and the event loop lag seen while profiling.
+
+    Attributes
+    ----------
+    path : string
+        output file, '{pid}' and '{n}' are replaced by the process id and the number of the run
+    running : bool
+    """
+    def __init__(self, path='profile-{pid}-{n}.folded', interval_s=0.01):
+        self.path = path
+        self.interval_s = interval_s
+        self.running = False
+        self.runs = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stacks = Tally()
+        self.samples = 0
+        self.sampling_s = 0.0
+        self.started = None
+        self.emits = {}  # event -> [count, total_s, max_s]
+        self.lag = [0, 0.0, 0.0]
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.reset()
+            self.running = True
+            self.started = time.perf_counter()
+            self.thread = threading.Thread(target=self.sample_loop, name='ProfilerThread', daemon=True)
+            self.thread.start()
+        trace_cortex_emits(self)
+        print('Profiling started, sampling every {0} s'.format(self.interval_s))
+
+    def stop(self):
+        """To stop sampling and write the profile, returns the path written or None"""
+        with self.lock:
+            if not self.running:
+                return None
+            self.running = False
+            thread = self.thread
+        trace_cortex_emits(None)
+        thread.join()
+        self.runs += 1
+        return self.write(self.path.format(pid=os.getpid(), n=self.runs))
+
+    def toggle(self):
+        if self.running:
+            return self.stop()
+        self.start()
+        return None
+
+    def sample_loop(self):
+        own = threading.get_ident()
+        names = {}
+        names_at = 0.0
+        while self.running:
+            began = time.perf_counter()
+            if began - names_at > 1.0:
+                names = {thread.ident: thread.name.replace(';', ':') for thread in threading.enumerate()}
+                names_at = began
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                stack.reverse()
+                self.stacks[(names.get(ident, str(ident)), tuple(stack))] += 1
+            self.samples += 1
+            spent = time.perf_counter() - began
+            self.sampling_s += spent
+            time.sleep(max(0.0, self.interval_s - spent))
+
+    def record_emit(self, event, seconds):
+        entry = self.emits.get(event)
+        if entry is None:
+            entry = self.emits[event] = [0, 0.0, 0.0]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+    def record_lag(self, seconds):
+        self.lag[0] += 1
+        self.lag[1] += seconds
+        self.lag[2] = max(self.lag[2], seconds)
+
+    def write(self, path):
+        frame_names = {}
+
+        def frame_name(frame):
+            name = frame_names.get(frame)
+            if name is None:
+                function, filename, line = frame
+                name = frame_names[frame] = '{0} ({1}:{2})'.format(function, os.path.basename(filename), line)
+            return name
+
+        with open(path, 'w') as file:
+            for (thread_name, stack), count in self.stacks.most_common():
+                file.write(';'.join([thread_name] + [frame_name(frame) for frame in stack]))
+                file.write(' {0}\n'.format(count))
+
+        elapsed = time.perf_counter() - self.started
+        with open(path + '.txt', 'w') as file:
+            file.write('{0} samples in {1:.1f} s, {2:.2%} of the time spent sampling\n'.format(
+                self.samples, elapsed, self.sampling_s / elapsed if elapsed else 0.0))
+            count, total, worst = self.lag
+            if count:
+                file.write('event loop lag: mean {0:.4f} s, max {1:.4f} s over {2} checks\n'.format(
+                    total / count, worst, count))
+            file.write('Cortex.emit handlers (event, calls, total s, mean s, max s):\n')
+            for event, (count, total, worst) in sorted(self.emits.items(), key=lambda item: -item[1][1]):
+                file.write('  {0} {1} {2:.4f} {3:.6f} {4:.6f}\n'.format(event, count, total, total / count, worst))
+        print('Profile written to {0} ({1} samples), summary in {0}.txt'.format(path, self.samples))
+        return path
+
+
+def trace_cortex_emits(profiler):
+    """To time the handlers of every Cortex event, or stop timing them with None"""
+    cortex = sys.modules.get('cortex')
+    if cortex is None:
+        return
+    if profiler is None:
+        cortex.Cortex.emit_hook = None
+        return
+
+    def hook(event, seconds):
+        EMIT_SECONDS.labels(event).observe(seconds)
+        profiler.record_emit(event, seconds)
+    cortex.Cortex.emit_hook = hook
+
+
+async def watch_event_loop(profiler, interval_s=0.1):
+    """
+    Measure how late the event loop wakes up this task, as a sign of blocking callbacks.
+
+    Run it as a task next to the others, e.g. asyncio.create_task(watch_event_loop(PROFILER)).
+    """
+    while True:
+        expected = time.perf_counter() + interval_s
+        await asyncio.sleep(interval_s)
+        lag = max(0.0, time.perf_counter() - expected)
+        LOOP_LAG_SECONDS.observe(lag)
+        if profiler is not None and profiler.running:
+            profiler.record_lag(lag)
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        command = self.rfile.readline().decode('utf-8', 'replace').strip()
+        profiler = self.server.profiler
+        if command == 'start':
+            profiler.start()
+            reply = 'started'
+        elif command == 'stop':
+            reply = 'written {0}'.format(profiler.stop())
+        elif command == 'toggle':
+            path = profiler.toggle()
+            reply = 'written {0}'.format(path) if path else 'started'
+        elif command == 'status':
+            reply = 'running' if profiler.running else 'stopped'
+        else:
+            reply = 'unknown command, use start, stop, toggle or status'
+        self.wfile.write((reply + '\n').encode('utf-8'))
+
+
+PROFILER = None
+
+
+def install(interval_s=None, path=None, control_port=None):
+    """
+    To make the profiler of this process controllable, without starting it
+
+    SIGUSR1 toggles profiling. With ``control_port`` (default DUET_PROFILE_PORT), a line
+    'start', 'stop', 'toggle' or 'status' sent to 127.0.0.1:port does the same, e.g.
+    ``echo stop | nc 127.0.0.1 9200``. Set DUET_PROFILE=1 to profile from the start.
+
+    Returns
+    -------
+    SamplingProfiler
+        the profiler of this process, installed once
+    """
+    global PROFILER
+    if PROFILER is not None:
+        return PROFILER
+    PROFILER = SamplingProfiler(path or os.getenv('DUET_PROFILE_PATH', 'profile-{pid}-{n}.folded'),
+                                interval_s or float(os.getenv('DUET_PROFILE_INTERVAL_S', '0.01')))
+
+    # signal handlers can only be set from the main thread
+    if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=PROFILER.toggle).start())
+
+    control_port = control_port or os.getenv('DUET_PROFILE_PORT')
+    if control_port:
+        try:
+            server = socketserver.ThreadingTCPServer(('127.0.0.1', int(control_port)), ControlHandler)
+            server.daemon_threads = True
+            server.profiler = PROFILER
+            threading.Thread(target=server.serve_forever, name='ProfilerControlThread', daemon=True).start()
+            print('Profiler control on 127.0.0.1:{0}'.format(control_port))
+        except OSError as e:
+            print('Could not open the profiler control port: {0}'.format(e))
+
+    # a profile still running when the process exits is written too
+    atexit.register(PROFILER.stop)
+    if os.getenv('DUET_PROFILE') == '1':
+        PROFILER.start()
+    return PROFILER
@@ -0,0 +1,148 @@
+from note_events import MIDI_TO_NOTE
+
+PITCH_CLASS_NAMES = ('C', 'C#', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab', 'A', 'Bb', 'B')
+
+# Krumhansl-Kessler key profiles
+MAJOR_PROFILE = (6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88)
+MINOR_PROFILE = (6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17)
+
+
+def estimate_tokens(text):
+    """Rough token count for budgeting (about four characters per token)"""
+    return (len(text) + 3) // 4
+
+
+def _correlation(xs, ys):
+    n = len(xs)
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    cov = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    var_y = sum((y - mean_y) ** 2 for y in ys)
+    if var_x == 0 or var_y == 0:
+        return 0.0
+    return cov / (var_x * var_y) ** 0.5
+
+
+def _pitch_class_weights(sequence, start=0.0, end=float('inf')):
+    """Release-weighted pitch-class histogram of the events starting in [start, end)"""
+    weights = [0.0] * 12
+    for i, onset in enumerate(sequence.onsets):
+        if start <= onset < end:
+            weights[sequence.pitches[i] % 12] += sequence.releases[i]
+    return weights
+
+
+def detect_key(sequence):
+    weights = _pitch_class_weights(sequence)
+    best = (-2.0, 0, 'major')
+    for tonic in range(12):
+        rotated = weights[tonic:] + weights[:tonic]
+        for profile, mode in ((MAJOR_PROFILE, 'major'), (MINOR_PROFILE, 'minor')):
+            score = _correlation(rotated, profile)
+            if score > best[0]:
+                best = (score, tonic, mode)
+    return f"{PITCH_CLASS_NAMES[best[1]]} {best[2]}"
+
+
+def detect_chord(sequence, start, end):
+    weights = _pitch_class_weights(sequence, start, end)
+    if not any(weights):
+        return '-'
+
+    # the lowest note of the measure counts extra towards the chord root
+    bass = min((sequence.pitches[i] for i, onset in enumerate(sequence.onsets) if start <= onset < end))
+    best = (-1.0, '-')
+    for root in range(12):
+        for third, suffix in ((4, ''), (3, 'm')):
+            score = weights[root] + weights[(root + third) % 12] + weights[(root + 7) % 12]
+            if bass % 12 == root:
+                score *= 1.25
+            if score > best[0]:
+                best = (score, PITCH_CLASS_NAMES[root] + suffix)
+    return best[1]
+
+
+def melody_bars(sequence, measure_duration):
+    """The top line of each measure as 'note duration' pairs"""
+    tops = {}
+    for i, onset in enumerate(sequence.onsets):
+        if onset not in tops or sequence.pitches[i] > tops[onset]:
+            tops[onset] = sequence.pitches[i]
+    onsets = sorted(tops)
+
+    bars = []
+    for i, onset in enumerate(onsets):
+        measure = int(onset // measure_duration)
+        while len(bars) <= measure:
+            bars.append([])
+        next_onset = onsets[i + 1] if i + 1 < len(onsets) else sequence.duration
+        bars[measure].append(f"{MIDI_TO_NOTE[tops[onset]]} {round(next_onset - onset, 3)}")
+    return [", ".join(bar) for bar in bars]
+
+
+class ContextBuilder:
+    """
+    Build generation prompts from a cached static prefix and a compact summary of the previous segment.
+
+    The static instructions are formatted once and always come first, so they form an
+    identical prefix on every call. The previous segment is summarized within
+    ``budget_tokens``: key and length always, then the chord progression, note density,
+    instruments and bars of melody while they fit. Chord and instrument lists are cut
+    short, ending with '(+n more)', when the whole list does not fit.
+    """
+    def __init__(self, instructions, budget_tokens=150, measure_duration=1.0, max_melody_bars=2):
+        self.prefix = f"{instructions}\n\n"
+        self.budget_tokens = budget_tokens
+        self.measure_duration = measure_duration
+        self.max_melody_bars = max_melody_bars
+
+    def summarize(self, sequence, focus):
+        """Summarize a segment within the token budget"""
+        measures = max(1, round(sequence.duration / self.measure_duration))
+        chords = [detect_chord(sequence, m * self.measure_duration, (m + 1) * self.measure_duration)
+                  for m in range(measures)]
+        onsets = len(set(sequence.onsets))
+        notes_per_measure = onsets / measures
+        instruments = sorted({sequence.instrument_name(i) for i in range(len(sequence))})
+
+        clauses = [f"The previous music segment (at focus level {focus}/100) was in {detect_key(sequence)}, "
+                   f"{round(sequence.duration, 2)} seconds long"]
+        self._add_list_clause(clauses, " with chords ", chords, " | ")
+        self._add_clause(clauses, f", about {round(notes_per_measure, 1)} note onsets per measure")
+        self._add_list_clause(clauses, ", played on ", [':' + name for name in instruments], ", ")
+        summary = "".join(clauses) + "."
+
+        # add melody bars while they fit in the budget
+        for count, bar in enumerate(melody_bars(sequence, self.measure_duration)[:self.max_melody_bars]):
+            candidate = f"{summary}\nMelody bar {count + 1}: {bar}."
+            if estimate_tokens(candidate) > self.budget_tokens:
+                break
+            summary = candidate
+        return summary
+
+    def _fits(self, clauses):
+        return estimate_tokens("".join(clauses) + ".") <= self.budget_tokens
+
+    def _add_clause(self, clauses, clause):
+        if self._fits(clauses + [clause]):
+            clauses.append(clause)
+
+    def _add_list_clause(self, clauses, lead, items, separator):
+        """Add as many leading items of a list as fit in the budget"""
+        for count in range(len(items), 0, -1):
+            shown = separator.join(items[:count])
+            if count < len(items):
+                shown += f" (+{len(items) - count} more)"
+            if self._fits(clauses + [lead + shown]):
+                clauses.append(lead + shown)
+                return
+
+    def build(self, focus_instruction, last_generation=None, last_focus=None):
+        """Assemble the complete prompt"""
+        continuation = ""
+        if last_generation and last_focus is not None:
+            continuation = (f"\n\n{self.summarize(last_generation, last_focus)}\n"
+                            "Please create a natural musical continuation that transitions smoothly to the new focus level, "
+                            "maintaining thematic elements where appropriate while adjusting to the new intensity.")
+        return f"{self.prefix}{focus_instruction}{continuation}"
@@ -1,9 +1,12 @@
 from cortex import Cortex
-import time
+from record_scheduler import RecordScheduler
 
 class Record():
     def __init__(self, app_client_id, app_client_secret, **kwargs):
         self.c = Cortex(app_client_id, app_client_secret, debug_mode=True, **kwargs)
+        # records are stopped by timers, so the websocket thread keeps reading while recording
+        self.scheduler = RecordScheduler(self.c, on_job_done=self.on_record_job_done)
+        self.pending_exports = set()
         self.c.bind(create_session_done=self.on_create_session_done)
         self.c.bind(create_record_done=self.on_create_record_done)
         self.c.bind(stop_record_done=self.on_stop_record_done)
@@ -11,7 +14,7 @@ class Record():
         self.c.bind(export_record_done=self.on_export_record_done)
         self.c.bind(inform_error=self.on_inform_error)
 
-    def start(self, record_duration_s=20, headsetId=''):
+    def start(self, record_duration_s=20, headsetId='', segment_s=None):
         """
         To start data recording and exporting process as below
         (1) check access right -> authorize -> connect headset->create session
@@ -21,6 +24,10 @@ class Record():
         record_duration_s: int, optional
             duration of record. default is 20 seconds
 
+        segment_s: int, optional
+            split the recording into consecutive records of this length, each exported
+            when it has been post-processed
+
         headsetId: string , optional
              id of wanted headet which you want to work with it.
              If the headsetId is empty, the first headset in list will be set as wanted headset
@@ -29,6 +36,7 @@ class Record():
         None
         """
         self.record_duration_s = record_duration_s
+        self.segment_s = segment_s
 
         if headsetId != '':
             self.c.set_wanted_headset(headsetId)
@@ -71,21 +79,17 @@ class Record():
         """
         self.c.export_record(folder, stream_types, format, record_ids, version, **kwargs)
 
-    def wait(self, record_duration_s):
-        print('start recording -------------------------')
-        length = 0
-        while length < record_duration_s:
-            print('recording at {0} s'.format(length))
-            time.sleep(1)
-            length+=1
-        print('end recording -------------------------')
-
     # callbacks functions
     def on_create_session_done(self, *args, **kwargs):
         print('on_create_session_done')
 
-        # create a record
-        self.create_record(self.record_title, description=self.record_description)
+        # schedule the record, the scheduler creates and stops it
+        if self.segment_s:
+            self.scheduler.rotate(self.record_title, self.segment_s, self.record_duration_s,
+                                  description=self.record_description)
+        else:
+            self.scheduler.schedule(self.record_title, self.record_duration_s,
+                                    description=self.record_description)
 
     def on_create_record_done(self, *args, **kwargs):
         
@@ -94,12 +98,7 @@ class Record():
         start_time = data['startDatetime']
         title = data['title']
         print('on_create_record_done: recordId: {0}, title: {1}, startTime: {2}'.format(self.record_id, title, start_time))
-
-        # record duration is record_length_s
-        self.wait(self.record_duration_s)
-
-        # stop record
-        self.stop_record()
+        print('start recording -------------------------')
 
     def on_stop_record_done(self, *args, **kwargs):
         
@@ -109,6 +108,13 @@ class Record():
         end_time = data['endDatetime']
         title = data['title']
         print('The record has been stopped: recordId: {0}, title: {1}, startTime: {2}, endTime: {3}'.format(record_id, title, start_time, end_time))
+        self.pending_exports.add(record_id)
+
+    def on_record_job_done(self, job):
+        print('end recording ------------------------- {0}'.format(job))
+        # a failed record has nothing to export, so close here if it was the last job
+        if job.state == 'failed' and self.scheduler.idle() and not self.pending_exports:
+            self.c.close()
 
     def on_warn_record_post_processing_done(self, *args, **kwargs):
         record_id = kwargs.get('data')
@@ -122,7 +128,9 @@ class Record():
         print('on_export_record_done: the successful record exporting as below:')
         data = kwargs.get('data')
         print(data)
-        self.c.close()
+        self.pending_exports.difference_update(data)
+        if self.scheduler.idle() and not self.pending_exports:
+            self.c.close()
 
     def on_inform_error(self, *args, **kwargs):
         error_data = kwargs.get('error_data')
@@ -0,0 +1,235 @@
+import threading
+import time
+
+from cortex import CREATE_RECORD_REQUEST_ID, STOP_RECORD_REQUEST_ID
+
+
+class RecordingJob():
+    """
+    A timed recording requested from the RecordScheduler.
+
+    Attributes
+    ----------
+    title : string
+        title of the record, and marker label when merged into another job's record
+    start_at, end_at : float
+        wall clock start and end times, in seconds
+    record_id : string
+        uuid of the Cortex record holding this job, once it started
+    state : string
+        'scheduled', 'starting', 'recording', 'done', 'failed' or 'cancelled'
+    """
+    def __init__(self, title, start_at, end_at, options):
+        self.title = title
+        self.start_at = start_at
+        self.end_at = end_at
+        self.options = options
+        self.record_id = None
+        self.state = 'scheduled'
+
+    def __repr__(self):
+        return 'RecordingJob({0!r}, {1}, {2:.1f}s)'.format(self.title, self.state, self.end_at - self.start_at)
+
+
+class RecordScheduler():
+    """
+    Start and stop Cortex records on timers, so the websocket thread never waits.
+
+    Jobs are started and stopped by ``threading.Timer`` callbacks that only send the
+    createRecord and stopRecord requests; the responses arrive as usual on the
+    websocket thread. Cortex allows one record per session at a time, so a job that
+    starts while another job's record is running is merged into it: the record is
+    extended to the later end time and the job's start and end are injected as
+    markers labelled with its title. A job starting exactly when the running record
+    ends (as in ``rotate``) gets a record of its own once the previous one stopped.
+
+    Attributes
+    ----------
+    c : Cortex
+        the Cortex session to record
+    jobs : list
+        all jobs, in the order they were scheduled
+    on_job_done : callable
+        optional ``on_job_done(job)`` called when a job's record stopped or failed
+    """
+    def __init__(self, cortex, on_job_done=None, clock=time.time):
+        self.c = cortex
+        self.on_job_done = on_job_done
+        self.clock = clock
+        self.jobs = []
+        self.record = None  # {'state': 'starting'|'recording'|'stopping', 'jobs': [...], 'end_at': ...}
+        self.timers = set()
+        self.lock = threading.RLock()
+        self.c.bind(create_record_done=self.on_create_record_done)
+        self.c.bind(stop_record_done=self.on_stop_record_done)
+        self.c.bind(inform_error=self.on_inform_error)
+
+    def schedule(self, title, duration_s, start_in_s=0.0, **options):
+        """
+        To record ``duration_s`` seconds starting ``start_in_s`` from now
+
+        Parameters
+        ----------
+        title : string, required
+            title of the record
+        other optional params are passed to createRecord, e.g. description
+
+        Returns
+        -------
+        RecordingJob
+        """
+        start_at = self.clock() + start_in_s
+        job = RecordingJob(title, start_at, start_at + duration_s, options)
+        with self.lock:
+            self.jobs.append(job)
+        self._timer(start_in_s, self.start_due)
+        return job
+
+    def rotate(self, title, segment_s, total_s, start_in_s=0.0, **options):
+        """
+        To split a long recording into consecutive records of ``segment_s`` seconds
+
+        Returns
+        -------
+        list
+            one RecordingJob per segment, titled '<title> part <n>'
+        """
+        jobs = []
+        count = max(1, int(-(-total_s // segment_s)))
+        for index in range(count):
+            duration = min(segment_s, total_s - index * segment_s)
+            jobs.append(self.schedule('{0} part {1}'.format(title, index + 1), duration,
+                                      start_in_s + index * segment_s, **options))
+        return jobs
+
+    def cancel(self, job):
+        with self.lock:
+            if job.state == 'scheduled':
+                job.state = 'cancelled'
+
+    def idle(self):
+        """True when nothing is recording or waiting to record"""
+        with self.lock:
+            return self.record is None and not any(job.state == 'scheduled' for job in self.jobs)
+
+    def shutdown(self):
+        """To cancel all timers, and stop the running record if any"""
+        with self.lock:
+            for timer in self.timers:
+                timer.cancel()
+            self.timers.clear()
+            for job in self.jobs:
+                self.cancel(job)
+            if self.record is not None and self.record['state'] == 'recording':
+                self.record['state'] = 'stopping'
+                self.c.stop_record()
+
+    def _timer(self, delay_s, function, *args):
+        def run():
+            with self.lock:
+                self.timers.discard(timer)
+            function(*args)
+        timer = threading.Timer(max(0.0, delay_s), run)
+        timer.daemon = True
+        with self.lock:
+            self.timers.add(timer)
+        timer.start()
+
+    def _marker(self, job, value):
+        self.c.inject_marker_request(int(self.clock() * 1000), value, job.title)
+
+    def start_due(self):
+        with self.lock:
+            now = self.clock()
+            for job in self.jobs:
+                if job.state != 'scheduled' or job.start_at > now + 0.001:
+                    continue
+                record = self.record
+                if record is None:
+                    self.record = {'state': 'starting', 'jobs': [job], 'end_at': job.end_at}
+                    job.state = 'starting'
+                    self.c.create_record(job.title, **job.options)
+                elif record['state'] != 'stopping' and job.start_at < record['end_at'] - 0.001:
+                    # overlaps the running record: extend it and mark this job's span
+                    record['jobs'].append(job)
+                    record['end_at'] = max(record['end_at'], job.end_at)
+                    job.state = record['state']
+                    if record['state'] == 'recording':
+                        job.record_id = record['id']
+                        self._marker(job, 'start')
+                        self._timer(job.end_at - now, self.end_marker_due, job)
+                # otherwise it starts once the running record has stopped
+
+    def end_marker_due(self, job):
+        with self.lock:
+            record = self.record
+            if (record is not None and record['state'] == 'recording' and job in record['jobs']
+                    and job.end_at < record['end_at'] - 0.001):
+                self._marker(job, 'end')
+
+    def stop_due(self):
+        with self.lock:
+            record = self.record
+            if record is None or record['state'] != 'recording':
+                return
+            remaining = record['end_at'] - self.clock()
+            if remaining > 0.001:
+                # the record was extended by a merged job
+                self._timer(remaining, self.stop_due)
+                return
+            record['state'] = 'stopping'
+            self.c.stop_record()
+
+    # callbacks functions
+    def on_create_record_done(self, *args, **kwargs):
+        data = kwargs.get('data')
+        with self.lock:
+            record = self.record
+            if record is None or record['state'] != 'starting':
+                return
+            record['state'] = 'recording'
+            record['id'] = data['uuid']
+            now = self.clock()
+            for index, job in enumerate(record['jobs']):
+                job.state = 'recording'
+                job.record_id = data['uuid']
+                if index > 0:
+                    # merged while the record was starting
+                    self._marker(job, 'start')
+                # marks the end only if a merged job extends the record past it
+                self._timer(job.end_at - now, self.end_marker_due, job)
+            self._timer(record['end_at'] - now, self.stop_due)
+
+    def on_stop_record_done(self, *args, **kwargs):
+        with self.lock:
+            record = self.record
+            if record is None:
+                return
+            self.record = None
+            for job in record['jobs']:
+                job.state = 'done'
+        for job in record['jobs']:
+            if self.on_job_done:
+                self.on_job_done(job)
+        # start jobs that were waiting for this record to stop
+        self.start_due()
+
+    def on_inform_error(self, *args, **kwargs):
+        # errors of other requests, e.g. injected markers, leave the record alone
+        failed_state = {CREATE_RECORD_REQUEST_ID: 'starting',
+                        STOP_RECORD_REQUEST_ID: 'stopping'}.get(kwargs.get('request_id'))
+        if failed_state is None:
+            return
+        with self.lock:
+            record = self.record
+            if record is None or record['state'] != failed_state:
+                return
+            # createRecord or stopRecord failed; either way the scheduler moves on, so
+            # later jobs do not wait behind a record that will never report stopping
+            self.record = None
+            for job in record['jobs']:
+                job.state = 'failed'
+        for job in record['jobs']:
+            if self.on_job_done:
+                self.on_job_done(job)
+        self.start_due()
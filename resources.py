@@ -0,0 +1,87 @@
+import os
+import time
+
+from dotenv import load_dotenv
+
+
+def singlestore_url():
+    """Build the SingleStore connection string from the environment"""
+    load_dotenv()
+    return '{0}:{1}@{2}:{3}/{4}'.format(os.getenv('SINGLESTORE_USER'), os.getenv('SINGLESTORE_PASSWORD'),
+                                        os.getenv('SINGLESTORE_HOST'), os.getenv('SINGLESTORE_PORT'),
+                                        os.getenv('SINGLESTORE_DATABASE'))
+
+
+def connect_singlestore():
+    import singlestoredb as s2
+    return s2.connect(singlestore_url())
+
+
+class DuetResources():
+    """
+    Lazily created external resources of the music backend.
+
+    Nothing is imported, connected or read until first use, so modules that take a
+    DuetResources can be imported in tests, benchmarks and worker processes without
+    credentials. Any resource can be injected instead: a model only needs
+    ``generate_content(prompt, stream=False)``, the database is a DB-API connection
+    and the OSC client needs ``send_message`` and ``send``.
+
+    Attributes
+    ----------
+    startup_timings : dict
+        seconds spent creating each resource, by name
+    """
+    def __init__(self, model=None, conn=None, prompt=None, osc_client=None, model_name='gemini-pro',
+                 prompt_path='music_generation_prompt.txt', osc_ip='127.0.0.1', osc_port=4560):
+        self._model = model
+        self._conn = conn
+        self._prompt = prompt
+        self._osc_client = osc_client
+        self.model_name = model_name
+        self.prompt_path = prompt_path
+        self.osc_ip = osc_ip
+        self.osc_port = osc_port
+        self.startup_timings = {}
+
+    def _timed(self, name, factory):
+        started = time.perf_counter()
+        value = factory()
+        self.startup_timings[name] = time.perf_counter() - started
+        print(f"Created {name} in {self.startup_timings[name]:.3f}s")
+        return value
+
+    @property
+    def model(self):
+        if self._model is None:
+            def create_model():
+                import google.generativeai as genai
+                load_dotenv()
+                genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+                return genai.GenerativeModel(self.model_name)
+            self._model = self._timed('model', create_model)
+        return self._model
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = self._timed('database', connect_singlestore)
+        return self._conn
+
+    @property
+    def prompt(self):
+        if self._prompt is None:
+            def read_prompt():
+                with open(self.prompt_path, 'r') as file:
+                    return file.read()
+            self._prompt = self._timed('prompt', read_prompt)
+        return self._prompt
+
+    @property
+    def osc_client(self):
+        if self._osc_client is None:
+            def create_client():
+                from pythonosc import udp_client
+                return udp_client.SimpleUDPClient(self.osc_ip, self.osc_port)
+            self._osc_client = self._timed('osc_client', create_client)
+        return self._osc_client
@@ -0,0 +1,276 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from live_advance_pow import LivePowerBands, local_dsp_options, artifact_gate_options
+from markers import MarkerService, note_markers
+from music_generation import EEGCollector
+from metrics import serve_from_env
+import profiler
+from record_scheduler import RecordScheduler
+from shared_state import SharedFeatures
+
+
+class SharedMemoryPowerBands(LivePowerBands):
+    """
+    LivePowerBands that publishes to shared memory instead of the database.
+
+    Each pow sample is published as the latest (avg_alpha, avg_beta) features and
+    appended to the shared sample ring. Set ``write_database`` to keep the SingleStore
+    table up to date as well.
+    """
+    def __init__(self, app_client_id, app_client_secret, features, write_database=False, **kwargs):
+        super().__init__(app_client_id, app_client_secret, **kwargs)
+        self.features = features
+        self.write_database = write_database
+
+    def on_new_pow_data(self, *args, **kwargs):
+        data = kwargs.get('data')
+        averages = self.gated_averages(data)
+        if averages is None:
+            return
+        pow_values = self.focus_pow(data['pow'])
+        sample = pow_values if len(pow_values) == self.features.n_columns else None
+        self.features.publish(data['time'], averages, sample)
+        if self.write_database:
+            self.store(*averages)
+
+
+class SharedMemoryCollector(EEGCollector):
+    """EEGCollector that reads the features published by the ingestion process"""
+    def __init__(self, features, stale_after_s=2.0, **kwargs):
+        super().__init__(**kwargs)
+        self.features = features
+        self.stale_after_s = stale_after_s
+
+    def fetch_latest(self):
+        sequence, timestamp, values = self.features.latest()
+        # skip features left behind by a stalled ingestion
+        if not sequence or self.features.age() > self.stale_after_s:
+            return None
+        return values[0], values[1], sequence
+
+
+class NoteForwarder:
+    """
+    OscBundleTransport listener of the generation process that forwards the note onsets
+    of every sequence sent to the ingestion process, which owns the Cortex session.
+    """
+    def __init__(self, marker_queue):
+        self.marker_queue = marker_queue
+        self.dropped = 0
+
+    def __call__(self, segment_id, start, sequence):
+        try:
+            self.marker_queue.put_nowait(list(note_markers(segment_id, start, sequence)))
+        except queue.Full:
+            # the ingestion process is not draining, e.g. while it restarts
+            self.dropped += 1
+
+
+class SessionMarkers:
+    """
+    Mark the note onsets forwarded by the generation process in the ingestion session.
+
+    Markers are injected by a MarkerService, so they land in Cortex while a record is
+    running. With a ``record_title``, the session is recorded for ``record_s`` seconds
+    as soon as it is created.
+    """
+    def __init__(self, cortex, marker_queue, record_title=None, record_s=3600.0):
+        self.marker_queue = marker_queue
+        self.service = MarkerService(cortex)
+        self.scheduler = RecordScheduler(cortex) if record_title else None
+        self.record_title = record_title
+        self.record_s = record_s
+        cortex.bind(create_session_done=self.on_create_session_done)
+        threading.Thread(target=self.forward_loop, name='MarkerForwardThread', daemon=True).start()
+
+    def forward_loop(self):
+        while True:
+            for timestamp, label, value, extras in self.marker_queue.get():
+                self.service.mark(label, value, timestamp, **extras)
+
+    def close(self):
+        if self.scheduler is not None:
+            self.scheduler.shutdown()
+        self.service.close()
+        print('Markers:', self.service.stats)
+
+    # callbacks functions
+    def on_create_session_done(self, *args, **kwargs):
+        if self.scheduler is not None:
+            self.scheduler.schedule(self.record_title, self.record_s)
+
+
+def ingestion_main(features_name, write_database=False, marker_queue=None):
+    """Ingestion process: Cortex session and feature extraction"""
+    load_dotenv()
+    serve_from_env()
+    profiler.install()
+    features = SharedFeatures(features_name)
+    markers = None
+    try:
+        bands = SharedMemoryPowerBands(os.getenv('EMOTIV_CLIENT_ID'), os.getenv('EMOTIV_CLIENT_SECRET'),
+                                       features, write_database=write_database, local_dsp=local_dsp_options(),
+                                       artifact_gate=artifact_gate_options())
+        if marker_queue is not None:
+            markers = SessionMarkers(bands.c, marker_queue, os.getenv('DUET_RECORD_TITLE'),
+                                     float(os.getenv('DUET_RECORD_S', '3600')))
+        bands.start(os.getenv('EMOTIV_HEADSET_ID', ''))
+    finally:
+        if markers is not None:
+            markers.close()
+        features.close()
+
+
+def generation_main(features_name, marker_queue=None):
+    """Generation process: focus collection and the model loop"""
+    import music_generation
+    load_dotenv()
+    # next to the ingestion process's port
+    serve_from_env(offset=1)
+    features = SharedFeatures(features_name)
+    try:
+        collector = SharedMemoryCollector(features, user_id=os.getenv('DUET_USER_ID'))
+        note_listener = NoteForwarder(marker_queue) if marker_queue is not None else None
+        asyncio.run(music_generation.main(eeg_collector=collector, note_listener=note_listener))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        features.close()
+
+
+class Supervisor:
+    """
+    Run the ingestion and generation processes and restart either one when it fails.
+
+    A process is restarted when it exits, and the ingestion process also when it stops
+    publishing for ``stall_timeout_s`` after having published once. Restarts back off
+    exponentially while a process keeps failing quickly.
+
+    Attributes
+    ----------
+    features : SharedFeatures
+        the shared block, owned by the supervisor
+    targets : dict
+        process name to (function, args)
+    restarts : dict
+        restart count by process name
+    """
+    def __init__(self, features, targets, stall_timeout_s=10.0, min_backoff_s=1.0, max_backoff_s=30.0,
+                 healthy_after_s=60.0, poll_interval_s=0.5):
+        self.context = multiprocessing.get_context('spawn')
+        self.features = features
+        self.targets = targets
+        self.stall_timeout_s = stall_timeout_s
+        self.min_backoff_s = min_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.healthy_after_s = healthy_after_s
+        self.poll_interval_s = poll_interval_s
+        self.processes = {}
+        self.started_at = {}
+        self.backoff_s = {name: min_backoff_s for name in targets}
+        self.restart_at = {}
+        self.restarts = {name: 0 for name in targets}
+        self.running = False
+
+    def start_process(self, name):
+        function, args = self.targets[name]
+        process = self.context.Process(target=function, args=args, name=name, daemon=True)
+        process.start()
+        self.processes[name] = process
+        self.started_at[name] = time.monotonic()
+        print('Started {0} process (pid {1})'.format(name, process.pid))
+
+    def schedule_restart(self, name, reason):
+        now = time.monotonic()
+        if now - self.started_at[name] >= self.healthy_after_s:
+            self.backoff_s[name] = self.min_backoff_s
+        print('{0} process {1}, restarting in {2:.1f}s'.format(name, reason, self.backoff_s[name]))
+        self.restart_at[name] = now + self.backoff_s[name]
+        self.backoff_s[name] = min(2 * self.backoff_s[name], self.max_backoff_s)
+        self.processes.pop(name)
+
+    def check(self):
+        now = time.monotonic()
+        for name in list(self.processes):
+            process = self.processes[name]
+            if not process.is_alive():
+                self.schedule_restart(name, 'exited with code {0}'.format(process.exitcode))
+            elif (name == 'ingestion' and self.features.latest()[0] and
+                  now - self.started_at[name] > self.stall_timeout_s and self.features.age() > self.stall_timeout_s):
+                process.terminate()
+                process.join(5)
+                self.schedule_restart(name, 'stalled for {0:.1f}s'.format(self.features.age()))
+
+        for name, restart_at in list(self.restart_at.items()):
+            if now >= restart_at:
+                del self.restart_at[name]
+                self.restarts[name] += 1
+                self.start_process(name)
+
+    def run(self):
+        self.running = True
+        for name in self.targets:
+            self.start_process(name)
+        try:
+            while self.running:
+                self.check()
+                time.sleep(self.poll_interval_s)
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.running = False
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(5)
+        self.processes.clear()
+        print('Restarts:', self.restarts)
+
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Runs live_advance_pow.py and music_generation.py as two supervised processes that
+#     share the latest focus features through shared memory instead of SingleStore.
+#   - Set EMOTIV_CLIENT_ID and EMOTIV_CLIENT_SECRET (and optionally EMOTIV_HEADSET_ID)
+#     as for live_advance_pow.py, plus the music_generation.py settings.
+#   - Set DUET_WRITE_DATABASE=1 to keep writing the averages to SingleStore as well.
+#   - With DUET_METRICS_PORT set, ingestion metrics are served on that port and generation
+#     metrics on the next one.
+#   - Set DUET_MARKERS=1 to inject a Cortex marker at every note onset. Markers are only
+#     kept by Cortex while a record runs: set DUET_RECORD_TITLE to record the session
+#     (for DUET_RECORD_S seconds, 3600 by default).
+#
+# -----------------------------------------------------------
+
+def main():
+    load_dotenv()
+    # the ring holds each pow sample of a 14 channel headset: all five bands when computed
+    # locally, only the focus bands when taken from the projected Cortex pow stream
+    features = SharedFeatures(create=True, n_columns=70 if local_dsp_options() else 42)
+    write_database = os.getenv('DUET_WRITE_DATABASE') == '1'
+    # owned by the supervisor, so forwarded notes survive a restart of either process
+    marker_queue = None
+    if os.getenv('DUET_MARKERS') == '1':
+        marker_queue = multiprocessing.get_context('spawn').Queue(maxsize=1000)
+    supervisor = Supervisor(features, {
+        'ingestion': (ingestion_main, (features.name, write_database, marker_queue)),
+        'generation': (generation_main, (features.name, marker_queue)),
+    })
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        print("Program stopped by user")
+    finally:
+        features.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+import heapq
+import itertools
+import json
+import math
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+from composition_cache import CompositionCache
+from music_generation import MusicGenerator, EEGCollector
+from note_events import NoteSequence
+from osc_transport import OscBundleTransport
+from pacing import PacingScheduler
+from prompt_context import ContextBuilder
+from resources import DuetResources
+
+
+class FairLLMScheduler:
+    """
+    Shared limit on concurrent model calls across listeners.
+
+    Waiting calls are served earliest deadline first, where the deadline is the
+    moment the listener's buffered music runs out. Deadlines are compared in buckets
+    of ``deadline_tolerance_s``, since two listeners' buffers rarely run out at exactly
+    the same time; within a bucket the listener that has been served least goes
+    first, so no listener starves another.
+    """
+    def __init__(self, concurrency=2, deadline_tolerance_s=0.5):
+        self.available = concurrency
+        self.deadline_tolerance_s = deadline_tolerance_s
+        self.waiting = []  # heap of (deadline bucket, served, order, tenant, future)
+        self.order = itertools.count()
+        self.served = defaultdict(int)
+
+    async def acquire(self, tenant, deadline):
+        if self.available > 0 and not self.waiting:
+            self.available -= 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            bucket = math.floor(deadline / self.deadline_tolerance_s)
+            heapq.heappush(self.waiting, (bucket, self.served[tenant], next(self.order), tenant, future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                # the slot may have been handed over just before the cancellation
+                if future.done() and not future.cancelled():
+                    self.release()
+                raise
+        self.served[tenant] += 1
+
+    def release(self):
+        while self.waiting:
+            future = heapq.heappop(self.waiting)[-1]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.available += 1
+
+    @asynccontextmanager
+    async def slot(self, tenant, deadline):
+        await self.acquire(tenant, deadline)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class TenantResources(DuetResources):
+    """A listener's own OSC client on top of the shared model, database and prompt"""
+    def __init__(self, shared, osc_ip, osc_port):
+        super().__init__(osc_ip=osc_ip, osc_port=osc_port)
+        self.shared = shared
+
+    @property
+    def model(self):
+        return self.shared.model
+
+    @property
+    def conn(self):
+        return self.shared.conn
+
+    @property
+    def prompt(self):
+        return self.shared.prompt
+
+
+class TenantGenerator(MusicGenerator):
+    """MusicGenerator whose model calls go through the shared fair scheduler"""
+    def __init__(self, listener, llm, **kwargs):
+        super().__init__(**kwargs)
+        self.listener = listener
+        self.llm = llm
+
+    async def call_model(self, complete_prompt):
+        metrics = self.listener.metrics
+        deadline = time.monotonic() + self.listener.pacing.playback.remaining()
+        queued = time.monotonic()
+        async with self.llm.slot(self.listener.name, deadline):
+            waited = time.monotonic() - queued
+            metrics['queue_wait_s'] += waited
+            metrics['max_queue_wait_s'] = max(metrics['max_queue_wait_s'], waited)
+            started = time.monotonic()
+            try:
+                return await super().call_model(complete_prompt)
+            finally:
+                metrics['model_calls'] += 1
+                metrics['model_time_s'] += time.monotonic() - started
+
+    def compose_local(self, average_focus):
+        self.listener.metrics['local_fallbacks'] += 1
+        return super().compose_local(average_focus)
+
+    def remember(self, result, average_focus):
+        self.listener.metrics['segments'] += 1
+        super().remember(result, average_focus)
+
+
+class Listener:
+    """
+    One headset and Sonic Pi pair served by the shared backend.
+
+    Attributes
+    ----------
+    name : string
+        listener name, used in metrics and fair scheduling
+    generator : TenantGenerator
+        the listener's own generator, with its own cache and OSC transport
+    collector : EEGCollector
+        reads the listener's focus from its own table
+    pacing : PacingScheduler
+        starts the listener's generations just in time
+    """
+    def __init__(self, config, shared, llm):
+        self.name = config['name']
+        self.metrics = defaultdict(float)
+        self.resources = TenantResources(shared, config.get('osc_ip', '127.0.0.1'), config.get('osc_port', 4560))
+        self.transport = OscBundleTransport(self.resources.osc_client, ack_ip=config.get('ack_ip', '0.0.0.0'),
+                                            ack_port=config.get('ack_port'))
+        cache = CompositionCache(path=config.get('cache_path'),
+                                 encode=NoteSequence.to_prompt_text, decode=NoteSequence.parse)
+        self.generator = TenantGenerator(self, llm, cache=cache, transport=self.transport,
+                                         deadline_s=config.get('deadline_s', 6.0),
+                                         context_builder=ContextBuilder(shared.prompt),
+                                         resources=self.resources)
+        self.collector = EEGCollector(user_id=config.get('user_id'), resources=self.resources,
+                                      table=config.get('table', 'brain_wave_data'))
+        self.pacing = PacingScheduler(self.generator, self.collector, self.transport)
+
+    async def run(self):
+        self.transport.start()
+        try:
+            await asyncio.gather(self.collector.collect_data(), self.pacing.run())
+        finally:
+            self.transport.close()
+            if self.collector.calibrator:
+                self.collector.calibrator.save()
+            self.generator.cache.save()
+
+    def report(self):
+        metrics = dict(self.metrics)
+        calls = metrics.get('model_calls', 0)
+        metrics['avg_queue_wait_s'] = metrics.get('queue_wait_s', 0) / calls if calls else 0.0
+        metrics['cache_hit_rate'] = self.generator.cache.hit_rate()
+        metrics['buffer_s'] = self.pacing.playback.remaining()
+        metrics['osc_dropped'] = self.transport.stats['dropped']
+        return {key: round(value, 3) for key, value in metrics.items()}
+
+
+async def report_metrics(listeners, interval_s):
+    while True:
+        await asyncio.sleep(interval_s)
+        for listener in listeners:
+            print('[{0}] {1}'.format(listener.name, listener.report()))
+
+
+async def serve(config):
+    shared = DuetResources(model_name=config.get('model_name', 'gemini-pro'),
+                           prompt_path=config.get('prompt_path', 'music_generation_prompt.txt'))
+    llm = FairLLMScheduler(config.get('llm_concurrency', 2), config.get('deadline_tolerance_s', 0.5))
+    listeners = [Listener(listener_config, shared, llm) for listener_config in config['listeners']]
+    print('Serving {0} listeners with {1} concurrent model calls'.format(len(listeners), config.get('llm_concurrency', 2)))
+
+    try:
+        await asyncio.gather(report_metrics(listeners, config.get('report_interval_s', 10)),
+                             *(listener.run() for listener in listeners))
+    except asyncio.CancelledError:
+        print("Tasks cancelled")
+
+# -----------------------------------------------------------
+#
+# GETTING STARTED
+#   - Each listener needs its own focus table (written by live_advance_pow.py),
+#     its own Sonic Pi instance and its own acknowledgment port. Set :duet_ack_host
+#     and :duet_ack_port at the top of the transport section of sonic_pi_script.rb
+#     to this machine and the listener's ack_port.
+#   - Notes are sent with absolute play times (epoch seconds) and bundles are
+#     timetagged, so the clock of every Sonic Pi host must be synced with this
+#     machine's (e.g. NTP or chrony). A skew delays or drops notes and makes the
+#     transport resend bundles that were never late.
+#   - Example config:
+#     {
+#       "llm_concurrency": 2,
+#       "listeners": [
+#         {"name": "alice", "user_id": "alice", "table": "brain_wave_data_alice",
+#          "osc_ip": "10.0.0.11", "osc_port": 4560, "ack_port": 4561},
+#         {"name": "bob", "user_id": "bob", "table": "brain_wave_data_bob",
+#          "osc_ip": "10.0.0.12", "osc_port": 4560, "ack_port": 4562}
+#       ]
+#     }
+#     (10.0.0.11 and 10.0.0.12 keep their clocks synced with this machine)
+#   - "deadline_tolerance_s" (default 0.5) sets how close two listeners' deadlines
+#     must be for the least served listener to go first.
+#
+# -----------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive several listeners from one music generation backend')
+    parser.add_argument('config', help='JSON service configuration')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as file:
+        config = json.load(file)
+
+    try:
+        asyncio.run(serve(config))
+    except KeyboardInterrupt:
+        print("Program stopped by user")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# header words: sequence, samples written, feature count, column count, ring size
+HEADER_WORDS = 5
+
+
+class SharedFeatures:
+    """
+    Latest features and a window of recent samples in shared memory, for one writer and many readers.
+
+    The block starts with a seqlock header: the writer makes the sequence number odd
+    before it changes anything and even again afterwards, so a reader that sees the same
+    even number before and after a read knows the read was not torn. The sample ring is
+    mirrored (every row is written twice, ``ring_size`` rows apart) so any window of up to
+    ``ring_size`` samples is a single contiguous numpy view into the block.
+
+    Attributes
+    ----------
+    name : string
+        shared memory block name, passed to other processes to attach
+    n_features : int
+        number of latest feature values, e.g. 2 for average alpha and beta
+    n_columns : int
+        number of values per ring sample, e.g. the 70 pow columns of an EPOC
+    ring_size : int
+        number of recent samples kept
+    """
+    def __init__(self, name=None, create=False, n_features=2, n_columns=70, ring_size=512):
+        if create:
+            size = 8 * (HEADER_WORDS + 2 + n_features + 2 * ring_size * (1 + n_columns))
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self.header = np.ndarray((HEADER_WORDS,), dtype=np.uint64, buffer=self.shm.buf)
+            self.header[:] = (0, 0, n_features, n_columns, ring_size)
+        else:
+            # processes started by the supervisor share its resource tracker, so attaching
+            # does not unlink the block when they exit
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.header = np.ndarray((HEADER_WORDS,), dtype=np.uint64, buffer=self.shm.buf)
+        self.owner = create
+        self.name = self.shm.name
+        self.n_features, self.n_columns, self.ring_size = (int(value) for value in self.header[2:])
+
+        offset = 8 * HEADER_WORDS
+        # published_at (wall clock of the last write) and the time of the latest features
+        self.times = np.ndarray((2,), dtype=np.float64, buffer=self.shm.buf, offset=offset)
+        offset += 8 * 2
+        self.features = np.ndarray((self.n_features,), dtype=np.float64, buffer=self.shm.buf, offset=offset)
+        offset += 8 * self.n_features
+        self.ring_times = np.ndarray((2 * self.ring_size,), dtype=np.float64, buffer=self.shm.buf, offset=offset)
+        offset += 8 * 2 * self.ring_size
+        self.ring = np.ndarray((2 * self.ring_size, self.n_columns), dtype=np.float64, buffer=self.shm.buf, offset=offset)
+
+    # writer side
+
+    def publish(self, timestamp, features, sample=None):
+        """Write the latest features and optionally append one sample to the ring"""
+        header = self.header
+        header[0] += 1
+        try:
+            self.features[:] = features
+            self.times[1] = timestamp
+            if sample is not None:
+                index = int(header[1]) % self.ring_size
+                self.ring[index] = sample
+                self.ring[index + self.ring_size] = sample
+                self.ring_times[index] = timestamp
+                self.ring_times[index + self.ring_size] = timestamp
+                header[1] += 1
+            self.times[0] = time.time()
+        finally:
+            header[0] += 1
+
+    # reader side
+
+    def latest(self, retries=1000):
+        """
+        Read the latest features consistently.
+
+        Returns
+        -------
+        (sequence, timestamp, features) : (int, float, tuple)
+            sequence is 0 and features None if nothing was published yet
+        """
+        for _ in range(retries):
+            before = int(self.header[0])
+            if before % 2 == 0:
+                timestamp = float(self.times[1])
+                features = tuple(self.features.tolist())
+                if int(self.header[0]) == before:
+                    return before, timestamp, features if before else None
+            time.sleep(0)
+        raise TimeoutError('Shared features are being written continuously')
+
+    def window(self, count):
+        """
+        Zero-copy views of the last ``count`` samples.
+
+        Returns
+        -------
+        (times, values, end) : (ndarray, ndarray, int)
+            views into shared memory and the sample count they end at. Pass ``end`` and
+            ``count`` to ``is_valid`` after using the views to check the writer did not
+            overwrite them meanwhile.
+        """
+        end = int(self.header[1])
+        count = min(count, end, self.ring_size - 1)
+        start = (end - count) % self.ring_size
+        return self.ring_times[start:start + count], self.ring[start:start + count], end
+
+    def is_valid(self, end, count):
+        """True if the window ending at ``end`` has not been overwritten yet"""
+        return int(self.header[1]) - end < self.ring_size - count
+
+    def age(self):
+        """Seconds since the writer last published, infinite if it never did"""
+        published_at = float(self.times[0])
+        return time.time() - published_at if published_at else float('inf')
+
+    def close(self):
+        # drop the views before closing the mapping
+        self.header = self.times = self.features = self.ring_times = self.ring = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,166 @@
+import json
+import threading
+import time
+
+import numpy as np
+
+
+def sample_values(stream, data):
+    """The values of one new_*_data sample as a flat list, matching the stream's labels"""
+    if stream == 'dev':
+        return [data['signal']] + list(data['dev']) + [data['batteryPercent']]
+    return data[stream]
+
+
+def sample_labels(stream, labels):
+    if stream == 'dev':
+        return ['signal'] + list(labels) + ['batteryPercent']
+    return list(labels)
+
+
+class PrintSink():
+    """Print every sample, as sub_data.py always did"""
+    def set_labels(self, stream, labels):
+        print('{} labels are : {}'.format(stream, labels))
+
+    def write(self, stream, data):
+        print('{} data: {}'.format(stream, data))
+
+    def close(self):
+        pass
+
+
+class NullSink():
+    """Count samples and discard them, to measure ingestion without output cost"""
+    def __init__(self):
+        self.samples = {}
+
+    def set_labels(self, stream, labels):
+        pass
+
+    def write(self, stream, data):
+        self.samples[stream] = self.samples.get(stream, 0) + 1
+
+    def close(self):
+        print('Null sink received', self.samples)
+
+
+class ConsoleSummarySink():
+    """
+    Print one line per stream at most every ``interval_s``: samples per second and the last value.
+
+    One instance can serve several streams. Printing happens on the thread that writes
+    the sample that makes the summary due, so no sample waits on the terminal otherwise.
+    """
+    def __init__(self, interval_s=1.0, max_values=8):
+        self.interval_s = interval_s
+        self.max_values = max_values
+        self.counts = {}
+        self.last = {}
+        self.lock = threading.Lock()
+        self.since = time.monotonic()
+
+    def set_labels(self, stream, labels):
+        print('{} labels are : {}'.format(stream, labels))
+
+    def write(self, stream, data):
+        self.counts[stream] = self.counts.get(stream, 0) + 1
+        self.last[stream] = data
+        now = time.monotonic()
+        if now - self.since >= self.interval_s and self.lock.acquire(blocking=False):
+            try:
+                self.print_summary(now)
+            finally:
+                self.lock.release()
+
+    def print_summary(self, now):
+        elapsed = now - self.since
+        lines = []
+        for stream in sorted(self.counts):
+            values = sample_values(stream, self.last[stream])
+            shown = ', '.join(str(value) for value in values[:self.max_values])
+            more = ', ...' if len(values) > self.max_values else ''
+            lines.append('{0}: {1:.1f} samples/s, last [{2}{3}]'.format(
+                stream, self.counts[stream] / elapsed, shown, more))
+            self.counts[stream] = 0
+        self.since = now
+        print('\n'.join(lines))
+
+    def close(self):
+        if any(self.counts.values()):
+            self.print_summary(time.monotonic())
+
+
+class BlockFileSink():
+    """
+    Write one stream to a file in large blocks.
+
+    Samples are copied into a preallocated block of ``block_rows`` rows (time first,
+    then the stream's values) and the block is written in one call when it fills,
+    and on ``close``. 'csv' writes a header of labels; 'binary' writes raw little-endian
+    float64 rows and a ``.json`` file next to it with the column labels.
+    """
+    def __init__(self, path, file_format='csv', block_rows=4096):
+        if file_format not in ('csv', 'binary'):
+            raise ValueError('Unknown file format ' + file_format)
+        self.path = path
+        self.file_format = file_format
+        self.block_rows = block_rows
+        self.file = open(path, 'w' if file_format == 'csv' else 'wb')
+        self.block = None
+        self.rows = 0
+        self.labels = None
+        self.written = 0
+
+    def set_labels(self, stream, labels):
+        self.labels = ['time'] + sample_labels(stream, labels)
+        if self.file_format == 'csv':
+            self.file.write(','.join(self.labels) + '\n')
+        else:
+            with open(self.path + '.json', 'w') as file:
+                json.dump({'stream': stream, 'labels': self.labels, 'dtype': '<f8'}, file)
+
+    def write(self, stream, data):
+        values = sample_values(stream, data)
+        if self.block is None:
+            self.block = np.empty((self.block_rows, 1 + len(values)), dtype='<f8')
+        row = self.block[self.rows]
+        row[0] = data['time']
+        row[1:] = values
+        self.rows += 1
+        if self.rows == self.block_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        block = self.block[:self.rows]
+        if self.file_format == 'csv':
+            np.savetxt(self.file, block, delimiter=',', fmt='%.10g')
+        else:
+            self.file.write(block.tobytes())
+        self.written += self.rows
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        print('Wrote {0} samples to {1}'.format(self.written, self.path))
+
+
+def create_sink(spec, stream, shared_summary=None):
+    """
+    Create a sink from a command line spec: print, summary, null, csv[:path] or binary[:path].
+
+    File sinks default to <stream>.csv or <stream>.f64.
+    """
+    kind, _, path = spec.partition(':')
+    if kind == 'print':
+        return PrintSink()
+    if kind == 'summary':
+        return shared_summary if shared_summary is not None else ConsoleSummarySink()
+    if kind == 'null':
+        return NullSink()
+    if kind in ('csv', 'binary'):
+        return BlockFileSink(path or '{0}.{1}'.format(stream, 'csv' if kind == 'csv' else 'f64'), kind)
+    raise ValueError('Unknown sink ' + spec)
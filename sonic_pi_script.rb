@@ -35,8 +35,9 @@ define :play_notes do |note_list|
   end
 end
 
-# Global variable to store the current sequence
-set :current_sequence, []
+# Global variables to store the current sequence as a list of phrases
+set :current_phrases, []
+set :phrase_index, 0
 set :sequence_updated, false
 
 # Ambient background loop
@@ -47,36 +48,134 @@ live_loop :drifting_ambient do
   play note: note[0].to_s, release: 10, attack: 1, cutoff: rrand(60, 90), amp: 0.15
 end
 
-# OSC listener to receive and update the sequence
+# OSC listener to receive and replace the sequence
 live_loop :osc_listener do
   use_real_time
   data = sync "/osc*/synth"  # Listening for OSC messages
   
   if data.is_a?(Array)
     new_sequence = reconstruct_array(data)
-    set :current_sequence, new_sequence  # Update the global sequence
+    set :current_phrases, [new_sequence]  # Replace the global sequence
     set :sequence_updated, true  # Signal that we have a new sequence
   else
     puts "Received incorrect format"
   end
 end
 
-# Continuous player loop
+# OSC listener for continuation phrases of a streamed sequence
+live_loop :osc_append_listener do
+  use_real_time
+  data = sync "/osc*/synth_append"
+  
+  if data.is_a?(Array)
+    set :current_phrases, get[:current_phrases] + [reconstruct_array(data)]
+  else
+    puts "Received incorrect format"
+  end
+end
+
+# Continuous player loop, one phrase at a time so appended phrases are picked up
 live_loop :sequence_player do
-  # Check if we have a sequence to play
-  current_sequence = get[:current_sequence]
+  phrases = get[:current_phrases]
   
-  if current_sequence && !current_sequence.empty?
-    # Reset the update flag if this is a new sequence
+  if phrases && !phrases.empty?
+    # Restart from the first phrase if this is a new sequence
     if get[:sequence_updated]
       set :sequence_updated, false
+      set :phrase_index, 0
       puts "Playing new sequence"
     end
     
-    # Play through the sequence once
-    play_notes(current_sequence)
+    index = get[:phrase_index]
+    index = 0 if index >= phrases.length
+    phrase = phrases[index]
+    
+    # Play through the phrase once
+    play_notes(phrase)
+    set :phrase_index, index + 1
+    
+    # A phrase without any sleep would stall the loop
+    sleep 0.01 unless phrase.any? { |note_data| note_data[0] == 'sleep' }
   else
     # If no sequence available, wait a bit
     sleep 0.1
   end
-end
\ No newline at end of file
+end
+
+# ------------------------------------------------------------------
+# Timetagged bundle transport (osc_transport.py)
+# Each /duet/note carries its absolute play time, so notes are scheduled
+# at their exact onsets. Each bundle's /duet/chunk header is acknowledged.
+# ------------------------------------------------------------------
+# Where acknowledgments and heartbeats go: the machine running the generator
+# and, when it serves several listeners (service.py), this listener's ack_port
+set :duet_ack_host, "127.0.0.1"
+set :duet_ack_port, 4561
+set :duet_segment, -1
+set :duet_events, []
+set :duet_segment_span, [-1, 0, 0]  # segment id, start time, end time
+
+define :schedule_duet_event do |event|
+  # event: [event_index, play_time, instrument, note, release, amp]
+  delay = event[1] - Time.now.to_f
+  if delay >= 0
+    time_warp delay do
+      synth event[2].to_s, note: event[3].to_s, release: event[4], amp: event[5]
+    end
+  end
+end
+
+live_loop :duet_note_listener do
+  use_real_time
+  segment_id, event_index, play_time, instrument, note, release, amp = sync "/osc*/duet/note"
+  
+  if segment_id > get[:duet_segment]
+    set :duet_segment, segment_id
+    set :duet_events, []
+  end
+  
+  events = get[:duet_events]
+  # resent bundles repeat events that were already scheduled
+  if segment_id == get[:duet_segment] && events.none? { |e| e[0] == event_index }
+    event = [event_index, play_time, instrument, note, release, amp]
+    set :duet_events, events + [event]
+    schedule_duet_event event
+  end
+end
+
+live_loop :duet_chunk_listener do
+  use_real_time
+  segment_id, chunk_index, segment_start, segment_end = sync "/osc*/duet/chunk"
+  
+  span = get[:duet_segment_span]
+  if segment_id > span[0] || (segment_id == span[0] && segment_end > span[2])
+    set :duet_segment_span, [segment_id, segment_start, segment_end]
+  end
+  osc_send get[:duet_ack_host], get[:duet_ack_port], "/duet/ack", segment_id, chunk_index
+end
+
+# If no new segment arrives before the current one ends, repeat it
+live_loop :duet_looper do
+  use_real_time
+  segment_id, segment_start, segment_end = get[:duet_segment_span]
+  
+  if segment_id == get[:duet_segment] && segment_end > segment_start && Time.now.to_f >= segment_end - 0.1
+    shift = segment_end - segment_start
+    events = get[:duet_events].map { |e| [e[0], e[1] + shift, e[2], e[3], e[4], e[5]] }
+    set :duet_events, events
+    set :duet_segment_span, [segment_id, segment_end, segment_end + shift]
+    events.each { |e| schedule_duet_event e }
+  end
+  sleep 0.05
+end
+
+# Report playback position so the generator can pace itself (pacing.py)
+live_loop :duet_heartbeat do
+  use_real_time
+  segment_id, segment_start, segment_end = get[:duet_segment_span]
+  if segment_id >= 0
+    now = Time.now.to_f
+    osc_send get[:duet_ack_host], get[:duet_ack_port], "/duet/heartbeat", segment_id, now - segment_start, segment_end - now
+  end
+  sleep 0.25
+end
@@ -0,0 +1,184 @@
+import asyncio
+import time
+from collections import deque
+
+
+class SpeculativeScheduler:
+    """
+    Pre-generate upcoming segments while the current one plays.
+
+    The scheduler extrapolates the recent focus trajectory to the end of the
+    segment that is playing, launches compositions for the most likely focus
+    buckets ahead of time, and at the segment boundary plays the candidate whose
+    bucket is closest to the actual focus. Unfinished candidates are cancelled;
+    finished ones are already stored in the generator's cache.
+
+    At most ``max_concurrency`` candidates are launched per segment, and candidates
+    whose bucket drops out of the prediction are cancelled. After a failed model
+    call no candidate is launched for a backoff time that doubles while calls keep
+    failing.
+    """
+    def __init__(self, music_generator, eeg_collector, max_concurrency=3, bucket_size=5,
+                 history_s=10.0, poll_interval_s=0.1, lead_s=0.3, min_backoff_s=1.0, max_backoff_s=30.0):
+        self.music_generator = music_generator
+        self.eeg_collector = eeg_collector
+        self.max_concurrency = max_concurrency
+        if music_generator.cache is not None:
+            bucket_size = music_generator.cache.bucket_size
+        self.bucket_size = bucket_size
+        self.history_s = history_s
+        self.poll_interval_s = poll_interval_s
+        self.lead_s = lead_s  # hand over this long before the boundary so the next segment is queued in time
+
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.focus_history = deque()  # (time, focus)
+        self.candidates = {}          # bucket -> task
+        self.segment_end = 0.0
+        self.launched = 0             # candidates launched for the coming boundary
+        self.min_backoff_s = min_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def record_focus(self, now, focus):
+        self.focus_history.append((now, focus))
+        while self.focus_history and now - self.focus_history[0][0] > self.history_s:
+            self.focus_history.popleft()
+
+    def predict_focus(self, horizon_s):
+        """Extrapolate the focus trend horizon_s seconds ahead with a least-squares line"""
+        n = len(self.focus_history)
+        latest = self.focus_history[-1][1]
+        if n < 2:
+            return latest
+
+        mean_t = sum(t for t, _ in self.focus_history) / n
+        mean_f = sum(f for _, f in self.focus_history) / n
+        var_t = sum((t - mean_t) ** 2 for t, _ in self.focus_history)
+        if var_t == 0:
+            return latest
+        slope = sum((t - mean_t) * (f - mean_f) for t, f in self.focus_history) / var_t
+        return min(max(latest + slope * horizon_s, 1), 100)
+
+    def predict_buckets(self, predicted_focus):
+        """Buckets to pre-generate, nearest to the prediction first"""
+        center = int(predicted_focus // self.bucket_size)
+        last_bucket = int(100 // self.bucket_size)
+        buckets = [center]
+        offset = 1
+        while len(buckets) < self.max_concurrency and offset <= last_bucket:
+            for bucket in (center + offset, center - offset):
+                if 0 <= bucket <= last_bucket and len(buckets) < self.max_concurrency:
+                    buckets.append(bucket)
+            offset += 1
+        return buckets
+
+    def bucket_focus(self, bucket):
+        return min(max((bucket + 0.5) * self.bucket_size, 1), 100)
+
+    async def _compose(self, focus):
+        async with self.semaphore:
+            return await self.music_generator.compose(focus)
+
+    def backoff(self):
+        self.failures += 1
+        delay = min(self.max_backoff_s, self.min_backoff_s * 2 ** (self.failures - 1))
+        self.retry_at = time.monotonic() + delay
+        print(f"Model call failed, retrying in {delay:.1f}s")
+
+    def on_candidate_done(self, task):
+        if task.cancelled():
+            return
+        # retrieving the exception here also keeps asyncio from logging it as unretrieved
+        if task.exception() is not None:
+            self.backoff()
+        else:
+            self.failures = 0
+
+    def start_candidate(self, bucket):
+        task = asyncio.create_task(self._compose(self.bucket_focus(bucket)))
+        task.add_done_callback(self.on_candidate_done)
+        self.candidates[bucket] = task
+        self.launched += 1
+
+    def launch(self, buckets):
+        # candidates that are no longer predicted free their concurrency slot
+        for bucket, task in list(self.candidates.items()):
+            if bucket not in buckets and not task.done():
+                task.cancel()
+                del self.candidates[bucket]
+        if time.monotonic() < self.retry_at:
+            return
+        for bucket in buckets:
+            if bucket not in self.candidates and self.launched < self.max_concurrency:
+                self.start_candidate(bucket)
+
+    async def pick(self, focus):
+        """Choose the candidate closest to the actual focus, waiting only if none has finished"""
+        actual = int(focus // self.bucket_size)
+        ranked = sorted(self.candidates, key=lambda bucket: abs(bucket - actual))
+        ready = [bucket for bucket in ranked if self.candidates[bucket].done()
+                 and not self.candidates[bucket].cancelled()
+                 and self.candidates[bucket].exception() is None]
+        # a finished candidate one bucket away beats waiting on the exact one
+        if ready and abs(ready[0] - actual) <= abs(ranked[0] - actual) + 1:
+            chosen = ready[0]
+        else:
+            chosen = ranked[0]
+
+        task = self.candidates.pop(chosen)
+        try:
+            # the boundary is already here, so only wait as long as the generator's latency budget
+            result = await asyncio.wait_for(asyncio.shield(task), self.music_generator.deadline_s)
+        except asyncio.TimeoutError:
+            print(f"Candidate missed the {self.music_generator.deadline_s}s deadline")
+            result = None
+        except Exception as e:
+            print(f"Error generating music: {e}")
+            result = None
+
+        for task in self.candidates.values():
+            if not task.done():
+                task.cancel()
+        self.candidates.clear()
+        self.launched = 0
+        return result
+
+    async def run(self):
+        """Run continuous speculative generation based on EEG data"""
+        generator = self.music_generator
+        while True:
+            now = time.monotonic()
+            focus = await self.eeg_collector.get_average()
+            self.record_focus(now, focus)
+
+            if generator.last_generation is None:
+                # nothing is playing yet, generate the first segment directly
+                await generator.generate_music(focus)
+                if generator.last_generation is None:
+                    # the call failed, wait before trying again instead of spinning
+                    self.backoff()
+                    await asyncio.sleep(self.retry_at - time.monotonic())
+                    continue
+                self.failures = 0
+                self.segment_end = time.monotonic() + generator.last_duration
+                continue
+
+            if now < self.segment_end - self.lead_s:
+                predicted = self.predict_focus(self.segment_end - now)
+                self.launch(self.predict_buckets(predicted))
+                await asyncio.sleep(self.poll_interval_s)
+                continue
+
+            # segment boundary: play the best candidate
+            if not self.candidates:
+                self.start_candidate(int(focus // self.bucket_size))
+            result = await self.pick(focus)
+            if not result:
+                result = generator.compose_local(focus)
+            if result:
+                generator.play(result, focus)
+                # the new segment is queued behind the one still playing
+                self.segment_end = max(time.monotonic(), self.segment_end) + generator.last_duration
+            else:
+                self.segment_end = time.monotonic()
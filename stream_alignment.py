@@ -0,0 +1,248 @@
+import time
+
+import numpy as np
+
+# data key of each stream in its new_*_data event
+STREAM_KEYS = {'eeg': 'eeg', 'mot': 'mot', 'dev': 'dev', 'met': 'met', 'pow': 'pow'}
+
+# samples per second used to size buffers when no capacity is given
+DEFAULT_RATES = {'eeg': 256, 'mot': 128, 'dev': 2, 'met': 2, 'pow': 8}
+
+
+class StreamBuffer:
+    """
+    Time-ordered buffer of one stream with bounded memory.
+
+    Samples are appended to a linear array twice the capacity and the newest
+    ``capacity`` samples are moved back to the front when it fills, so the buffered
+    samples are always one sorted, contiguous view. Samples arriving out of order are
+    inserted at their place in time; samples older than everything buffered are dropped.
+    """
+    def __init__(self, n_columns, capacity):
+        self.capacity = capacity
+        self.times = np.zeros(2 * capacity)
+        self.values = np.zeros((2 * capacity, n_columns))
+        self.start = 0
+        self.end = 0
+        self.stats = {'samples': 0, 'out_of_order': 0, 'dropped': 0}
+
+    def __len__(self):
+        return self.end - self.start
+
+    def latest_time(self):
+        return self.times[self.end - 1] if self.end > self.start else -np.inf
+
+    def _make_room(self, count):
+        if self.end + count > len(self.times):
+            keep = min(self.end - self.start, self.capacity - count)
+            self.times[:keep] = self.times[self.end - keep:self.end]
+            self.values[:keep] = self.values[self.end - keep:self.end]
+            self.start, self.end = 0, keep
+        elif self.end - self.start + count > self.capacity:
+            self.start = self.end + count - self.capacity
+
+    def append(self, timestamp, values):
+        self.stats['samples'] += 1
+        if self.end > self.start and timestamp < self.times[self.end - 1]:
+            self.insert(timestamp, values)
+            return
+        self._make_room(1)
+        self.times[self.end] = timestamp
+        self.values[self.end] = values
+        self.end += 1
+
+    def append_block(self, times, values):
+        """Append many time-ordered samples at once, e.g. from a replay file"""
+        times = np.asarray(times, dtype=np.float64)[-self.capacity:]
+        values = np.asarray(values, dtype=np.float64)[-self.capacity:]
+        self.stats['samples'] += len(times)
+        if self.end > self.start and len(times) and times[0] < self.times[self.end - 1]:
+            for timestamp, row in zip(times, values):
+                self.append(timestamp, row)
+            self.stats['samples'] -= len(times)
+            return
+        self._make_room(len(times))
+        self.times[self.end:self.end + len(times)] = times
+        self.values[self.end:self.end + len(times)] = values
+        self.end += len(times)
+
+    def insert(self, timestamp, values):
+        self.stats['out_of_order'] += 1
+        if timestamp < self.times[self.start]:
+            self.stats['dropped'] += 1
+            return
+        self._make_room(1)
+        position = self.start + int(np.searchsorted(self.times[self.start:self.end], timestamp, side='right'))
+        # late samples are usually close to the end, so the shift is short
+        self.times[position + 1:self.end + 1] = self.times[position:self.end].copy()
+        self.values[position + 1:self.end + 1] = self.values[position:self.end].copy()
+        self.times[position] = timestamp
+        self.values[position] = values
+        self.end += 1
+
+    def sample_at(self, query_times, method='asof', tolerance_s=None):
+        """
+        Values of the stream at each of ``query_times``, vectorized.
+
+        Parameters
+        ----------
+        method : string
+            'asof' takes the last sample at or before each time, 'nearest' the closest
+            sample and 'linear' interpolates between the samples around each time
+        tolerance_s : float, optional
+            maximum distance to the samples used, NaN beyond it
+
+        Returns
+        -------
+        values : ndarray
+            shape (len(query_times), n_columns), NaN where there is no sample
+        """
+        query_times = np.asarray(query_times, dtype=np.float64)
+        result = np.full((len(query_times), self.values.shape[1]), np.nan)
+        times = self.times[self.start:self.end]
+        values = self.values[self.start:self.end]
+        if not len(times):
+            return result
+
+        after = np.searchsorted(times, query_times, side='right')
+        before = after - 1
+        if method == 'asof':
+            valid = before >= 0
+            index = np.clip(before, 0, None)
+            distance = query_times - times[index]
+        elif method == 'nearest':
+            prev = np.clip(before, 0, len(times) - 1)
+            nxt = np.clip(after, 0, len(times) - 1)
+            use_next = np.abs(times[nxt] - query_times) < np.abs(query_times - times[prev])
+            index = np.where(use_next, nxt, prev)
+            valid = np.ones(len(query_times), dtype=bool)
+            distance = np.abs(times[index] - query_times)
+        elif method == 'linear':
+            # the upper neighbour of a query at a sample's time is that sample itself,
+            # so a query at the newest sample is a hit rather than out of range
+            upper = np.searchsorted(times, query_times, side='left')
+            valid = (before >= 0) & (upper < len(times))
+            prev = np.clip(before, 0, len(times) - 1)
+            nxt = np.clip(upper, 0, len(times) - 1)
+            span = times[nxt] - times[prev]
+            weight = np.divide(query_times - times[prev], span, out=np.zeros_like(span), where=span > 0)
+            distance = np.maximum(query_times - times[prev], times[nxt] - query_times)
+            if tolerance_s is not None:
+                valid &= distance <= tolerance_s
+            result[valid] = (values[prev[valid]] * (1 - weight[valid, None]) +
+                             values[nxt[valid]] * weight[valid, None])
+            return result
+        else:
+            raise ValueError('Unknown alignment method ' + method)
+
+        if tolerance_s is not None:
+            valid &= distance <= tolerance_s
+        result[valid] = values[index[valid]]
+        return result
+
+
+class StreamAligner:
+    """
+    Join multi-rate Cortex streams into frames on a common clock.
+
+    Each subscribed stream has its own StreamBuffer. Frames are produced at ``rate_hz``
+    ticks once every stream has data past the tick, or once ``max_lateness_s`` of wall
+    clock time has passed it, so samples that arrive a little late still make it into
+    their frame while a silent stream cannot hold the others back forever.
+
+    Attributes
+    ----------
+    methods : dict
+        join method by stream name, 'asof', 'nearest' or 'linear'
+    tolerances : dict
+        maximum sample distance by stream name, in seconds
+    labels : dict
+        column labels by stream name, from new_data_labels
+    """
+    def __init__(self, cortex=None, methods=None, rate_hz=8.0, history_s=10.0, tolerances=None,
+                 max_lateness_s=0.5, capacities=None, callback=None):
+        self.methods = dict(methods or {'pow': 'asof', 'met': 'asof'})
+        self.rate_hz = rate_hz
+        self.history_s = history_s
+        self.tolerances = dict(tolerances or {})
+        self.max_lateness_s = max_lateness_s
+        self.capacities = dict(capacities or {})
+        self.callback = callback
+        self.buffers = {}
+        self.labels = {}
+        self.next_tick = None
+        self.stats = {'frames': 0, 'late': 0}
+
+        if cortex is not None:
+            cortex.bind(new_data_labels=self.on_new_data_labels)
+            for stream in self.methods:
+                cortex.bind(**{'new_{0}_data'.format(stream): self.handler(stream)})
+
+    def on_new_data_labels(self, *args, **kwargs):
+        data = kwargs.get('data')
+        stream = data['streamName']
+        if stream in self.methods:
+            self.add_stream(stream, data['labels'])
+
+    def add_stream(self, stream, labels):
+        capacity = self.capacities.get(stream, int(DEFAULT_RATES.get(stream, 128) * self.history_s))
+        self.labels[stream] = list(labels)
+        self.buffers[stream] = StreamBuffer(len(labels), capacity)
+
+    def handler(self, stream):
+        key = STREAM_KEYS[stream]
+
+        def on_new_data(*args, **kwargs):
+            data = kwargs.get('data')
+            self.append(stream, data['time'], data[key])
+        return on_new_data
+
+    def append(self, stream, timestamp, values):
+        buffer = self.buffers.get(stream)
+        if buffer is None:
+            return
+        if self.next_tick is not None and self.next_tick - 1 / self.rate_hz >= timestamp:
+            # the frame at or after it was already produced without it
+            self.stats['late'] += 1
+        # met reports None for metrics that are not computed yet
+        buffer.append(timestamp, np.array(values, dtype=np.float64))
+        if self.callback is not None:
+            times, frames = self.poll()
+            if len(times):
+                self.callback(times, frames)
+
+    def watermark(self, now=None):
+        """Time up to which frames can be produced"""
+        latest = min((buffer.latest_time() for buffer in self.buffers.values()), default=-np.inf)
+        now = time.time() if now is None else now
+        return max(latest, now - self.max_lateness_s)
+
+    def poll(self, now=None, max_frames=None):
+        """
+        Frames for every tick that is ready.
+
+        Returns
+        -------
+        (times, frames) : (ndarray, dict)
+            tick times and, by stream name, an array of shape (len(times), n_columns)
+        """
+        if len(self.buffers) < len(self.methods) or not all(len(buffer) for buffer in self.buffers.values()):
+            return np.empty(0), {}
+        if self.next_tick is None:
+            first = max(buffer.times[buffer.start] for buffer in self.buffers.values() if len(buffer))
+            self.next_tick = np.ceil(first * self.rate_hz) / self.rate_hz
+        watermark = self.watermark(now)
+        if watermark < self.next_tick:
+            return np.empty(0), {}
+
+        count = int(np.floor((watermark - self.next_tick) * self.rate_hz)) + 1
+        # never produce more frames than the history can back
+        count = min(count, int(self.history_s * self.rate_hz), max_frames or count)
+        times = self.next_tick + np.arange(count) / self.rate_hz
+        self.next_tick = times[-1] + 1 / self.rate_hz
+        self.stats['frames'] += count
+        return times, self.frame_at(times)
+
+    def frame_at(self, times):
+        return {stream: buffer.sample_at(times, self.methods[stream], self.tolerances.get(stream))
+                for stream, buffer in self.buffers.items()}
@@ -1,4 +1,8 @@
+import argparse
+
 from cortex import Cortex
+from sinks import ConsoleSummarySink, create_sink
+import profiler
 
 class Subcribe():
     """
@@ -8,6 +12,8 @@ class Subcribe():
     ----------
     c : Cortex
         Cortex communicate with Emotiv Cortex Service
+    sinks : dict
+        output sink of each stream (sinks.py), a shared console summary by default
 
     Methods
     -------
@@ -28,12 +34,14 @@ class Subcribe():
     on_new_pow_data(*args, **kwargs):
         To handle band power data emitted from Cortex
     """
-    def __init__(self, app_client_id, app_client_secret, **kwargs):
+    def __init__(self, app_client_id, app_client_secret, sinks=None, default_sink=None, **kwargs):
         """
         Constructs cortex client and bind a function to handle subscribed data streams
         If you do not want to log request and response message , set debug_mode = False. The default is True
         """
         print("Subscribe __init__")
+        self.sinks = dict(sinks or {})
+        self.default_sink = default_sink or ConsoleSummarySink()
         self.c = Cortex(app_client_id, app_client_secret, debug_mode=True, **kwargs)
         self.c.bind(create_session_done=self.on_create_session_done)
         self.c.bind(new_data_labels=self.on_new_data_labels)
@@ -132,7 +140,7 @@ class Subcribe():
         data = kwargs.get('data')
         stream_name = data['streamName']
         stream_labels = data['labels']
-        print('{} labels are : {}'.format(stream_name, stream_labels))
+        self.sink(stream_name).set_labels(stream_name, stream_labels)
 
     def on_new_eeg_data(self, *args, **kwargs):
         """
@@ -146,7 +154,7 @@ class Subcribe():
            {'eeg': [99, 0, 4291.795, 4371.795, 4078.461, 4036.41, 4231.795, 0.0, 0], 'time': 1627457774.5166}
         """
         data = kwargs.get('data')
-        print('eeg data: {}'.format(data))
+        self.sink('eeg').write('eeg', data)
 
     def on_new_mot_data(self, *args, **kwargs):
         """
@@ -159,7 +167,7 @@ class Subcribe():
         For example: {'mot': [33, 0, 0.493859, 0.40625, 0.46875, -0.609375, 0.968765, 0.187503, -0.250004, -76.563667, -19.584995, 38.281834], 'time': 1627457508.2588}
         """
         data = kwargs.get('data')
-        print('motion data: {}'.format(data))
+        self.sink('mot').write('mot', data)
 
     def on_new_dev_data(self, *args, **kwargs):
         """
@@ -172,7 +180,7 @@ class Subcribe():
         For example:  {'signal': 1.0, 'dev': [4, 4, 4, 4, 4, 100], 'batteryPercent': 80, 'time': 1627459265.4463}
         """
         data = kwargs.get('data')
-        print('dev data: {}'.format(data))
+        self.sink('dev').write('dev', data)
 
     def on_new_met_data(self, *args, **kwargs):
         """
@@ -185,7 +193,7 @@ class Subcribe():
         For example: {'met': [True, 0.5, True, 0.5, 0.0, True, 0.5, True, 0.5, True, 0.5, True, 0.5], 'time': 1627459390.4229}
         """
         data = kwargs.get('data')
-        print('pm data: {}'.format(data))
+        self.sink('met').write('met', data)
 
     def on_new_pow_data(self, *args, **kwargs):
         """
@@ -198,7 +206,17 @@ class Subcribe():
         For example: {'pow': [5.251, 4.691, 3.195, 1.193, 0.282, 0.636, 0.929, 0.833, 0.347, 0.337, 7.863, 3.122, 2.243, 0.787, 0.496, 5.723, 2.87, 3.099, 0.91, 0.516, 5.783, 4.818, 2.393, 1.278, 0.213], 'time': 1627459390.1729}
         """
         data = kwargs.get('data')
-        print('pow data: {}'.format(data))
+        self.sink('pow').write('pow', data)
+
+    def sink(self, stream):
+        return self.sinks.get(stream, self.default_sink)
+
+    def close_sinks(self):
+        """
+        To flush and close every sink, once the session has ended
+        """
+        for sink in set(self.sinks.values()) | {self.default_sink}:
+            sink.close()
 
     # callbacks functions
     def on_create_session_done(self, *args, **kwargs):
@@ -221,20 +239,42 @@ class Subcribe():
 # RESULT
 #   - the data labels will be retrieved at on_new_data_labels
 #   - the data will be retreived at on_new_[dataStream]_data
+#   - each stream goes to its sink: a console summary once per second by default, or
+#     chosen per stream, e.g.
+#       python sub_data.py --sink eeg=binary:eeg.f64 --sink mot=csv --sink pow=print
+#     sinks: summary, print (every sample), null (count only), csv[:path], binary[:path]
 # 
 # -----------------------------------------------------------
 
 def main():
+    parser = argparse.ArgumentParser(description='Subscribe to Cortex data streams')
+    parser.add_argument('--streams', default='eeg,mot,met,pow', help='comma separated streams to subscribe')
+    parser.add_argument('--sink', action='append', default=[], metavar='STREAM=SINK',
+                        help='output of one stream: summary, print, null, csv[:path] or binary[:path]')
+    args = parser.parse_args()
+    # SIGUSR1 or DUET_PROFILE_PORT start and stop a sampling profiler (profiler.py)
+    profiler.install()
 
     # Please fill your application clientId and clientSecret before running script
     your_app_client_id = 'JFnPljMcfueBxLeSWjJxfBCH43JBMNqSI2eNqCzM'
     your_app_client_secret = 'OIJ7kTaA6XughEgNJI9eENenKhcKlgiDTuYnIKCkxWjMQNEEYdXYHGOKNoH5wd59l7q90MxgisGw0smAhKtNqGE8PuemH55vQztJf6QCP0sytnKhPBSztOOk8rio88yQ'
 
-    s = Subcribe(your_app_client_id, your_app_client_secret)
+    summary = ConsoleSummarySink()
+    sinks = {}
+    for spec in args.sink:
+        stream, _, sink = spec.partition('=')
+        sinks[stream] = create_sink(sink, stream, summary)
+
+    s = Subcribe(your_app_client_id, your_app_client_secret, sinks=sinks, default_sink=summary)
 
     # list data streams
-    streams = ['eeg','mot','met','pow']
-    s.start(streams)
+    streams = args.streams.split(',')
+    try:
+        s.start(streams)
+    except KeyboardInterrupt:
+        print("Program stopped by user")
+    finally:
+        s.close_sinks()
 
 if __name__ =='__main__':
     main()